@@ -0,0 +1,86 @@
+import argparse
+import random
+import time
+from typing import Callable, List
+
+from vector_store.chunker import iter_document_chunks
+from vector_store.utils import extract_document_chunks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the rolling window chunker with the single pass chunking engine"
+    )
+    parser.add_argument("--num-pages", type=int, default=500)
+    parser.add_argument("--page-length", type=int, default=3000)
+    parser.add_argument("--chunk-size", type=int, default=1536)
+    parser.add_argument("--overlap-ratio", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--no-periods",
+        action="store_true",
+        help="Generate text without periods, e.g. tables or extracted slides, where split points fall back to spaces",
+    )
+    return parser.parse_args()
+
+
+def make_synthetic_pages(
+    num_pages: int, page_length: int, no_periods: bool = False, seed: int = 0
+) -> List[str]:
+    rng = random.Random(seed)
+    words = [
+        "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 10)))
+        for _ in range(2000)
+    ]
+    pages = []
+    for _ in range(num_pages):
+        page = []
+        length = 0
+        while length < page_length:
+            sentence = " ".join(rng.choices(words, k=rng.randint(5, 25))) + (
+                " " if no_periods else ". "
+            )
+            if rng.random() < 0.1:
+                sentence += "\n"
+            page.append(sentence)
+            length += len(sentence)
+        pages.append("".join(page)[:page_length])
+    return pages
+
+
+def best_time(run: Callable[[], list], repeat: int) -> tuple[float, int]:
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        chunks = run()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings), len(chunks)
+
+
+def main():
+    args = parse_args()
+    pages = make_synthetic_pages(args.num_pages, args.page_length, args.no_periods)
+    implementations = {
+        "rolling_window": lambda: extract_document_chunks(
+            pages, "benchmark.pdf", args.chunk_size, args.overlap_ratio
+        ),
+        "single_pass": lambda: list(
+            iter_document_chunks(
+                pages, "benchmark.pdf", args.chunk_size, args.overlap_ratio
+            )
+        ),
+    }
+    print(
+        f"{args.num_pages} pages of {args.page_length} characters, "
+        f"{args.chunk_size=}, {args.overlap_ratio=}, best of {args.repeat} runs"
+    )
+    for name, run in implementations.items():
+        seconds, num_chunks = best_time(run, args.repeat)
+        print(
+            f"{name:>15}: {seconds * 1000:8.1f} ms, {num_chunks} chunks, "
+            f"{args.num_pages / seconds:10.0f} pages/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import fitz
+import numpy as np
+from benchmarks.chunking_benchmark import make_synthetic_pages
+from benchmarks.stand_ins import (
+    EchoGeneratorModel,
+    HashingEmbedder,
+    LocalWebServer,
+    WordOverlapReRanker,
+)
+from common.model_registry import ModelRegistry
+from common.tracing import tracer
+from common.utils import load_config
+from data.data_classes import GenerationStats
+from data_store.uploaded_files import UploadedFilesDB
+from pipelines.async_chat_completion import (
+    AsyncChatCompletionPipeline,
+    use_worker_threads,
+)
+from pipelines.chat_completion import ChatCompletionPipeline
+from pipelines.ingestion import IngestionEngine
+from vector_store.base_vector_store import load_vector_store
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time ingestion and chat turns end to end, with local stand-ins for OpenSearch and the models"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="001_base_config.yml",
+        help="provide the name of the config yaml file (to be placed on the path 'src/common/configs')",
+    )
+    parser.add_argument("--num-documents", type=int, default=4)
+    parser.add_argument("--pages-per-document", type=int, default=50)
+    parser.add_argument("--page-length", type=int, default=3000)
+    parser.add_argument("--embedding-dimension", type=int, default=256)
+    parser.add_argument("--num-sessions", type=int, default=8)
+    parser.add_argument("--turns-per-session", type=int, default=10)
+    parser.add_argument("--embedding-latency-ms", type=float, default=5.0)
+    parser.add_argument("--embedding-latency-per-text-ms", type=float, default=0.5)
+    parser.add_argument("--reranker-latency-per-document-ms", type=float, default=0.2)
+    parser.add_argument("--time-to-first-token-ms", type=float, default=100.0)
+    parser.add_argument("--latency-per-token-ms", type=float, default=5.0)
+    parser.add_argument("--num-output-tokens", type=int, default=32)
+    parser.add_argument(
+        "--query-length",
+        type=int,
+        default=8,
+        help="number of consecutive words of a document page in every query",
+    )
+    parser.add_argument(
+        "--retrieval-cache",
+        action="store_true",
+        help="keep the retrieval cache enabled, repeated queries are then answered from the cache",
+    )
+    parser.add_argument(
+        "--async-sessions",
+        action="store_true",
+        help="serve the sessions as tasks of one event loop with the async pipeline, instead of a thread each",
+    )
+    parser.add_argument(
+        "--answer-cache",
+        action="store_true",
+        help="keep the answer cache enabled, similar queries are then answered without generation",
+    )
+    parser.add_argument(
+        "--web-search",
+        action="store_true",
+        help="search the web alongside the vector store, with a local http server standing in for the web",
+    )
+    parser.add_argument("--num-web-pages", type=int, default=20)
+    parser.add_argument("--web-page-latency-ms", type=float, default=50.0)
+    parser.add_argument(
+        "--tracing",
+        action="store_true",
+        help="record the pipeline spans and add their latency per stage to the results",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", type=Path, default=None, help="write the results to this json file"
+    )
+    return parser.parse_args()
+
+
+def write_synthetic_pdfs(
+    docs_dir: Path,
+    num_documents: int,
+    pages_per_document: int,
+    page_length: int,
+    seed: int,
+) -> List[List[str]]:
+    documents = []
+    for i in range(num_documents):
+        pages = make_synthetic_pages(pages_per_document, page_length, seed=seed + i)
+        with fitz.open() as doc:
+            for page_text in pages:
+                page = doc.new_page()
+                page.insert_textbox(
+                    page.rect + (36, 36, -36, -36), page_text, fontsize=7
+                )
+            doc.save(docs_dir / f"document_{i:04d}.pdf")
+        documents.append(pages)
+    return documents
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "mean": float(np.mean(latencies)),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(np.max(latencies)),
+    }
+
+
+def main():
+    args = parse_args()
+    # the progress of the models and the ingestion goes to stderr, so that stdout only holds the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmark(args)
+
+    results_json = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(results_json)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(results_json)
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict:
+    work_dir = Path(tempfile.mkdtemp(prefix="llm_chat_app_benchmark_"))
+
+    config = load_config(config_name=args.config)
+    config.root_storage_dir = work_dir
+    config.file_storage_dir = work_dir / "files"
+    config.vector_store_backend = "local"
+    config.local_vector_store_config.storage_dir = work_dir / "vector_store"
+    config.database_config.root_dir = work_dir / "db"
+    config.embedding_model_config.embedding_cache_config.enabled = False
+    config.embedding_model_config.embedding_dimension = args.embedding_dimension
+    config.opensearch_config.embedding_dimension = args.embedding_dimension
+    config.opensearch_config.retrieval_cache_config.enabled = args.retrieval_cache
+    # the scores of the hashing embedder are not calibrated like those of a model, every turn
+    # retrieves top_k documents so that the reranking and the prompt are part of the measured turns
+    config.opensearch_config.filter_confidence_threshold = 0.0
+    config.answer_cache_config.enabled = args.answer_cache
+    config.use_rag = True
+    config.use_web_search = args.web_search
+    config.web_search_config.page_cache_config.cache_dir = work_dir / "web_page_cache"
+
+    tracer.configure(enabled=args.tracing, max_traces=config.tracing_config.max_traces)
+    model_registry = ModelRegistry(config)
+    model_registry.register_loader(
+        "embedder",
+        lambda: HashingEmbedder(
+            args.embedding_dimension,
+            latency_per_call=args.embedding_latency_ms / 1000,
+            latency_per_text=args.embedding_latency_per_text_ms / 1000,
+        ),
+    )
+    model_registry.register_loader(
+        "reranker",
+        lambda: WordOverlapReRanker(
+            top_k=config.reranker_config.top_k,
+            latency_per_document=args.reranker_latency_per_document_ms / 1000,
+        ),
+    )
+    model_registry.register_loader(
+        "generator",
+        lambda: EchoGeneratorModel(
+            num_output_tokens=args.num_output_tokens,
+            time_to_first_token=args.time_to_first_token_ms / 1000,
+            latency_per_token=args.latency_per_token_ms / 1000,
+        ),
+    )
+    model_registry.warm_up()
+
+    docs_dir = work_dir / "documents"
+    docs_dir.mkdir(parents=True)
+    documents = write_synthetic_pdfs(
+        docs_dir,
+        args.num_documents,
+        args.pages_per_document,
+        args.page_length,
+        args.seed,
+    )
+
+    vector_db = load_vector_store(config, model_registry=model_registry)
+    engine = IngestionEngine(
+        config, vector_db=vector_db, db=UploadedFilesDB(config.database_config)
+    )
+    start_time = time.perf_counter()
+    engine.run(sorted(docs_dir.glob("*.pdf")))
+    stage_stats = {stats.stage: stats for stats in engine.stage_stats()}
+    ingestion_time = time.perf_counter() - start_time
+    num_pages = stage_stats["extract"].num_items
+    num_chunks = stage_stats["chunk"].num_items
+
+    web_server = None
+    if args.web_search:
+        # the web pages are pages of the documents, so that the queries find them
+        web_server = LocalWebServer(
+            [page for pages in documents for page in pages][: args.num_web_pages],
+            latency_per_page=args.web_page_latency_ms / 1000,
+        )
+        web_server.start()
+        config.web_search_config.search_url = web_server.search_url
+        # the stand-in serves its pages on localhost
+        config.web_search_config.allow_private_hosts = True
+
+    pipeline = ChatCompletionPipeline(
+        config, vector_store=vector_db, model_registry=model_registry
+    )
+    pages = [page.split() for pages in documents for page in pages]
+    turn_latencies = []
+    time_to_first_tokens = []
+    num_retrieved_documents = []
+    num_context_documents = []
+    errors = []
+    results_lock = threading.Lock()
+
+    # a passage of an ingested page, so that the query shares its words with the chunks of the page
+    def make_query(rng: random.Random) -> str:
+        words = rng.choice(pages)
+        start_idx = rng.randrange(max(len(words) - args.query_length, 1))
+        return " ".join(words[start_idx : start_idx + args.query_length]).strip(".")
+
+    # the number of retrieved documents is recorded per search, before reranking and the token budget cut them
+    search, asearch = vector_db.search, vector_db.asearch
+
+    def counted_search(*search_args, **search_kwargs):
+        retrieved_documents = search(*search_args, **search_kwargs)
+        with results_lock:
+            num_retrieved_documents.append(len(retrieved_documents))
+        return retrieved_documents
+
+    async def counted_asearch(*search_args, **search_kwargs):
+        retrieved_documents = await asearch(*search_args, **search_kwargs)
+        with results_lock:
+            num_retrieved_documents.append(len(retrieved_documents))
+        return retrieved_documents
+
+    vector_db.search, vector_db.asearch = counted_search, counted_asearch
+
+    def record_turn(turn_latency: float, stats: GenerationStats, num_documents: int):
+        with results_lock:
+            turn_latencies.append(turn_latency)
+            time_to_first_tokens.append(
+                turn_latency - stats.total_time + stats.time_to_first_token
+            )
+            num_context_documents.append(num_documents)
+
+    def run_session(session_idx: int):
+        rng = random.Random(args.seed + session_idx)
+        chat_history = []
+        for _ in range(args.turns_per_session):
+            chat_history.append({"role": "user", "content": make_query(rng)})
+            start_time = time.perf_counter()
+            try:
+                response_stream, context_documents = (
+                    pipeline.stream_completion_pipeline(chat_history)
+                )
+                for _ in response_stream:
+                    pass
+            except Exception as e:
+                with results_lock:
+                    errors.append(repr(e))
+                return
+            record_turn(
+                time.perf_counter() - start_time,
+                response_stream.stats,
+                len(context_documents),
+            )
+            chat_history.append({"role": "assistant", "content": response_stream.text})
+
+    async def arun_session(session_idx: int):
+        rng = random.Random(args.seed + session_idx)
+        chat_history = []
+        for _ in range(args.turns_per_session):
+            chat_history.append({"role": "user", "content": make_query(rng)})
+            start_time = time.perf_counter()
+            try:
+                response_stream, context_documents = (
+                    await async_pipeline.astream_completion_pipeline(chat_history)
+                )
+                async for _ in response_stream:
+                    pass
+            except Exception as e:
+                with results_lock:
+                    errors.append(repr(e))
+                return
+            record_turn(
+                time.perf_counter() - start_time,
+                response_stream.stats,
+                len(context_documents),
+            )
+            chat_history.append({"role": "assistant", "content": response_stream.text})
+
+    async def arun_sessions():
+        use_worker_threads(
+            asyncio.get_running_loop(), config.async_pipeline_config.worker_threads
+        )
+        await asyncio.gather(*(arun_session(i) for i in range(args.num_sessions)))
+
+    start_time = time.perf_counter()
+    if args.async_sessions:
+        async_pipeline = AsyncChatCompletionPipeline(
+            config,
+            vector_store=vector_db,
+            model_registry=model_registry,
+            web_retriever=pipeline.web_retriever,
+        )
+        asyncio.run(arun_sessions())
+    else:
+        sessions = [
+            threading.Thread(target=run_session, args=(i,))
+            for i in range(args.num_sessions)
+        ]
+        for session in sessions:
+            session.start()
+        for session in sessions:
+            session.join()
+    chat_time = time.perf_counter() - start_time
+    if web_server is not None:
+        web_server.stop()
+
+    results = {
+        "arguments": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+        },
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        },
+        "ingestion": {
+            "num_files": stage_stats["metadata"].num_items,
+            "num_pages": num_pages,
+            "num_chunks": num_chunks,
+            "seconds": ingestion_time,
+            "pages_per_second": num_pages / ingestion_time,
+            "chunks_per_second": num_chunks / ingestion_time,
+            "stages": [
+                {
+                    "stage": stats.stage,
+                    "num_items": stats.num_items,
+                    "busy_time": stats.busy_time,
+                    "items_per_second": stats.items_per_second,
+                }
+                for stats in stage_stats.values()
+            ],
+        },
+        "chat": {
+            "num_sessions": args.num_sessions,
+            "num_turns": len(turn_latencies),
+            "num_errors": len(errors),
+            "errors": errors[:10],
+            "seconds": chat_time,
+            "turns_per_second": len(turn_latencies) / chat_time,
+            # time from sending the query until the first token of the answer, including retrieval
+            "time_to_first_token": latency_summary(time_to_first_tokens),
+            "turn_latency": latency_summary(turn_latencies),
+            # documents found by the vector search, and those of them that made it into the prompt
+            "mean_retrieved_documents": (
+                float(np.mean(num_retrieved_documents))
+                if num_retrieved_documents
+                else 0.0
+            ),
+            "mean_context_documents": (
+                float(np.mean(num_context_documents)) if num_context_documents else 0.0
+            ),
+        },
+    }
+    if args.tracing:
+        results["spans"] = tracer.metrics.summary()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    main()
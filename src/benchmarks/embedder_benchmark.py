@@ -0,0 +1,109 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from benchmarks.chunking_benchmark import make_synthetic_pages
+from benchmarks.stand_ins import HashingEmbedder, LocalEmbeddingServer
+from vector_store.embedder import load_embedder
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare one request per text with the batched, concurrent requests of the remote embedders, "
+        "against a local stub of the embedding api that can answer with rate limits"
+    )
+    parser.add_argument("--provider", choices=["open_ai", "hf_api"], default="open_ai")
+    parser.add_argument("--num-texts", type=int, default=512)
+    parser.add_argument("--text-length", type=int, default=1536)
+    parser.add_argument("--embedding-dimension", type=int, default=256)
+    parser.add_argument("--request-batch-size", type=int, default=64)
+    parser.add_argument("--max-concurrent-requests", type=int, default=4)
+    parser.add_argument("--request-latency-ms", type=float, default=20.0)
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the requests answered with --error-status instead of the embeddings",
+    )
+    parser.add_argument(
+        "--error-status",
+        type=int,
+        default=429,
+        help="429 and 5xx are retried, other statuses fail the encoding",
+    )
+    parser.add_argument(
+        "--retry-after-ms",
+        type=float,
+        default=0.0,
+        help="Retry-After of the error responses",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def run(
+    args: argparse.Namespace,
+    texts: list,
+    request_batch_size: int,
+    max_concurrent_requests: int,
+) -> dict:
+    server = LocalEmbeddingServer(
+        args.embedding_dimension,
+        latency_per_request=args.request_latency_ms / 1000,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after_ms / 1000,
+        seed=args.seed,
+    )
+    server.start()
+    try:
+        embedder = load_embedder(
+            args.provider,
+            "stand-in",
+            base_url=server.base_url,
+            request_batch_size=request_batch_size,
+            max_concurrent_requests=max_concurrent_requests,
+        )
+        start_time = time.perf_counter()
+        embeddings = embedder.encode(texts)
+        seconds = time.perf_counter() - start_time
+    finally:
+        server.stop()
+
+    expected = HashingEmbedder(args.embedding_dimension).encode(texts)
+    return {
+        "request_batch_size": request_batch_size,
+        "max_concurrent_requests": max_concurrent_requests,
+        "seconds": seconds,
+        "texts_per_second": len(texts) / seconds,
+        "num_requests": server.num_requests,
+        "num_errors": server.num_errors,
+        "in_order": bool(np.allclose(embeddings, expected, atol=1e-6)),
+    }
+
+
+def main():
+    args = parse_args()
+    # the openai client needs a key, the stand-in does not check it
+    os.environ.setdefault("OPENAI_API_KEY", "stand-in")
+    texts = make_synthetic_pages(args.num_texts, args.text_length, seed=args.seed)
+    print(
+        f"{args.num_texts} texts of {args.text_length} characters, {args.provider=}, "
+        f"{args.request_latency_ms=}, {args.error_rate=}, {args.error_status=}"
+    )
+    for name, request_batch_size, max_concurrent_requests in [
+        ("one_per_request", 1, 1),
+        ("batched", args.request_batch_size, args.max_concurrent_requests),
+    ]:
+        result = run(args, texts, request_batch_size, max_concurrent_requests)
+        print(
+            f"{name:>15}: {result['seconds']:8.2f} s, {result['texts_per_second']:8.1f} texts/s, "
+            f"{result['num_requests']} requests, {result['num_errors']} errors, "
+            f"output in order: {result['in_order']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+import asyncio
+import base64
+import hashlib
+import html
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from data.data_classes import VectorDocumentChunk, WebDocumentChunk
+from generator.generator_model import GeneratorModel
+from reranker.reranker import ReRanker
+from vector_store.embedder import Embedder
+
+
+def _word_hash(word: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(word.encode(), digest_size=8).digest(), "little"
+    )
+
+
+# Deterministic embedder that hashes the words of a text into a normalized bag of words vector, so that texts
+# sharing words are close. Every call sleeps for the configured latency to stand in for a model or an API.
+class HashingEmbedder(Embedder):
+    def __init__(
+        self,
+        embedding_dimension: int,
+        latency_per_call: float = 0.0,
+        latency_per_text: float = 0.0,
+    ):
+        self.embedding_dimension = embedding_dimension
+        self.latency_per_call = latency_per_call
+        self.latency_per_text = latency_per_text
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.embedding_dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.casefold()):
+            word_hash = _word_hash(word)
+            sign = 1.0 if word_hash & 1 else -1.0
+            vector[(word_hash >> 1) % self.embedding_dimension] += sign
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def encode(self, sentences: str | List[str]) -> np.array:
+        texts = [sentences] if isinstance(sentences, str) else sentences
+        time.sleep(self.latency_per_call + self.latency_per_text * len(texts))
+        embeddings = np.stack([self._embed(text) for text in texts])
+        return embeddings[0] if isinstance(sentences, str) else embeddings
+
+
+# Streams a fixed number of words taken from the last user message, after a simulated time to first token.
+class EchoGeneratorModel(GeneratorModel):
+    def __init__(
+        self,
+        num_output_tokens: int = 64,
+        time_to_first_token: float = 0.0,
+        latency_per_token: float = 0.0,
+    ):
+        self.num_output_tokens = num_output_tokens
+        self.time_to_first_token = time_to_first_token
+        self.latency_per_token = latency_per_token
+
+    def generate_deltas(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> Iterator[str]:
+        words = chat_history[-1]["content"].split() or ["..."]
+        time.sleep(self.time_to_first_token)
+        for i in range(self.num_output_tokens):
+            if i > 0:
+                time.sleep(self.latency_per_token)
+            yield words[i % len(words)] + " "
+
+    # stands in for an async api client, waiting does not hold a thread
+    async def agenerate_deltas(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> AsyncIterator[str]:
+        words = chat_history[-1]["content"].split() or ["..."]
+        await asyncio.sleep(self.time_to_first_token)
+        for i in range(self.num_output_tokens):
+            if i > 0:
+                await asyncio.sleep(self.latency_per_token)
+            yield words[i % len(words)] + " "
+
+    def generate_response(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ):
+        return "".join(self.generate_deltas(chat_history, generation_args))
+
+
+# Orders the documents by the number of query words they contain, after a simulated scoring latency.
+class WordOverlapReRanker(ReRanker):
+    def __init__(self, top_k: int = None, latency_per_document: float = 0.0):
+        self.top_k = top_k
+        self.latency_per_document = latency_per_document
+
+    def run_reranker(
+        self,
+        query: str,
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> List[VectorDocumentChunk | WebDocumentChunk]:
+        time.sleep(self.latency_per_document * len(documents))
+        query_words = set(re.findall(r"\w+", query.casefold()))
+        ranked_documents = sorted(
+            documents,
+            key=lambda doc: len(
+                query_words & set(re.findall(r"\w+", doc.text.casefold()))
+            ),
+            reverse=True,
+        )
+        return ranked_documents[: self.top_k] if self.top_k else ranked_documents
+
+
+# Serves a fixed set of pages over http on localhost, together with a search endpoint that answers like the json
+# api of searxng, ranking the pages by the number of query words they contain. Every page is sent after the
+# configured latency, to stand in for remote web servers.
+class LocalWebServer:
+    def __init__(self, pages: List[str], latency_per_page: float = 0.0):
+        self.pages = pages
+        self.latency_per_page = latency_per_page
+        self.page_words = [set(re.findall(r"\w+", page.casefold())) for page in pages]
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def search_url(self) -> str:
+        return f"{self.base_url}/search"
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        query_words = set(re.findall(r"\w+", query.casefold()))
+        ranked_pages = sorted(
+            range(len(self.pages)),
+            key=lambda i: len(query_words & self.page_words[i]),
+            reverse=True,
+        )
+        return [
+            {
+                "url": f"{self.base_url}/pages/{i}",
+                "title": f"Page {i}",
+                "content": self.pages[i][:160],
+            }
+            for i in ranked_pages
+        ]
+
+    def _make_handler(self):
+        web_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, body: str, content_type: str):
+                content = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                try:
+                    self.wfile.write(content)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client stopped waiting for the page
+                    pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/search":
+                    query = parse_qs(url.query).get("q", [""])[0]
+                    self._send(
+                        json.dumps({"results": web_server.search(query)}),
+                        "application/json",
+                    )
+                    return
+                page_idx = url.path.removeprefix("/pages/")
+                if not page_idx.isdigit() or int(page_idx) >= len(web_server.pages):
+                    self.send_error(404)
+                    return
+                time.sleep(web_server.latency_per_page)
+                page = html.escape(web_server.pages[int(page_idx)])
+                self._send(
+                    f"<html><head><title>Page {page_idx}</title></head>"
+                    f"<body><nav>Home</nav><p>{page}</p></body></html>",
+                    "text/html",
+                )
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Answers embedding requests over http on localhost, in the formats of the OpenAI embeddings api (POST /embeddings
+# with "input") and of the Hugging Face feature extraction api (POST with "inputs"), so the remote embedders can be
+# pointed at it through api_base_url. The vectors come from a `HashingEmbedder`. Every request takes the configured
+# latency, and the given fraction of requests is answered with an error status instead, by default a rate limit
+# with a Retry-After header.
+class LocalEmbeddingServer:
+    def __init__(
+        self,
+        embedding_dimension: int,
+        latency_per_request: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after: float = 0.0,
+        seed: int = 0,
+    ):
+        self.embedder = HashingEmbedder(embedding_dimension)
+        self.latency_per_request = latency_per_request
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.num_requests = 0
+        self.num_errors = 0
+        self.batch_sizes: List[int] = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            self.num_requests += 1
+            fail = self._rng.random() < self.error_rate
+            self.num_errors += fail
+            return fail
+
+    def _make_handler(self):
+        embedding_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status: int, body: Any, headers: Dict[str, str] = None):
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_POST(self):
+                request = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                time.sleep(embedding_server.latency_per_request)
+                if embedding_server._should_fail():
+                    self._send(
+                        embedding_server.error_status,
+                        {"error": f"stand-in error {embedding_server.error_status}"},
+                        {"Retry-After": str(embedding_server.retry_after)},
+                    )
+                    return
+
+                texts = request["input"] if "input" in request else request["inputs"]
+                texts = [texts] if isinstance(texts, str) else texts
+                with embedding_server._lock:
+                    embedding_server.batch_sizes.append(len(texts))
+                embeddings = embedding_server.embedder.encode(texts)
+
+                if "inputs" in request:
+                    self._send(200, embeddings.tolist())
+                    return
+                # the openai client asks for base64 encoded float32 vectors when numpy is installed
+                if request.get("encoding_format") == "base64":
+                    vectors = [
+                        base64.b64encode(
+                            embedding.astype(np.float32).tobytes()
+                        ).decode()
+                        for embedding in embeddings
+                    ]
+                else:
+                    vectors = embeddings.tolist()
+                self._send(
+                    200,
+                    {
+                        "object": "list",
+                        "model": request.get("model", ""),
+                        "data": [
+                            {"object": "embedding", "index": i, "embedding": vector}
+                            for i, vector in enumerate(vectors)
+                        ],
+                        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                    },
+                )
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
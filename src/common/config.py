@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Literal, List, Optional, Any
+from typing import Literal, List, Optional, Any, Union
 
 from pydantic import BaseModel
 
@@ -7,30 +7,126 @@ from common.constants import (
     DEFAULT_DATA_DIR,
     DEFAULT_DB_DIR,
     DEFAULT_EMBEDDING_MODEL_CACHE_DIR,
+    DEFAULT_EMBEDDING_CACHE_DIR,
     DEFAULT_GENERATOR_MODEL_CACHE_DIR,
     DEFAULT_FILE_STORAGE_DIR,
+    DEFAULT_LOCAL_VECTOR_STORE_DIR,
+    DEFAULT_WEB_PAGE_CACHE_DIR,
 )
 
 
+class EmbeddingCacheConfig(BaseModel):
+    enabled: bool = True
+    cache_dir: Path = DEFAULT_EMBEDDING_CACHE_DIR
+    memory_cache_size: int = 10_000  # number of vectors kept in the in-memory LRU tier
+    max_disk_size_mb: int = 1024
+
+
 class EmbeddingModelConfig(BaseModel):
     cache_dir: Path = DEFAULT_EMBEDDING_MODEL_CACHE_DIR
     model_provider: Literal["sentence_transformer", "hf_api", "open_ai"]
     model_name: str
     embedding_dimension: int
     trust_remote_code: bool = False  # some hf models need this to be set True
+    # overrides the endpoint of the hf_api and open_ai providers
+    api_base_url: Optional[str] = None
+    request_batch_size: int = 64
+    max_concurrent_requests: int = 4
+    embedding_cache_config: EmbeddingCacheConfig = EmbeddingCacheConfig()
+
+
+class KVCacheConfig(BaseModel):
+    enabled: bool = True
+    # memory of the kv states kept for all conversations together
+    max_size_mb: int = 2048
+    max_sessions: int = 16
+    # a conversation whose state is larger than this is not cached
+    max_session_size_mb: int = 512
 
 
 class GeneratorModelConfig(BaseModel):
     cache_dir: Path = DEFAULT_GENERATOR_MODEL_CACHE_DIR
-    model_provider: Literal["hf_api"]
+    model_provider: Literal["hf_api", "llama_cpp"]
+    # llama_cpp: path of a gguf file, or a hf repo id together with model_file
     model_name: str
     max_output_tokens: int
     temperature: float = 0.0
+    # the prompt is cut to fit into the window together with max_output_tokens
+    context_window_tokens: int = 8192
+    # llama_cpp: file name or glob pattern of the gguf file in the hf repo, e.g. "*Q4_K_M.gguf"
+    model_file: Optional[str] = None
+    # llama_cpp: all cores are used if not set
+    num_threads: Optional[int] = None
+    # llama_cpp: the kv states of recent conversations, so that a turn only prefills its new tokens
+    kv_cache_config: KVCacheConfig = KVCacheConfig()
 
 
 class ReRankerConfig(BaseModel):
     model_provider: Optional[str] = "default"
     top_k: Optional[int] = None
+    model_name: str = "cross-encoder"
+    batch_size: int = 16
+    # passages are cut to this many tokens before scoring, to fit the window of the cross-encoder
+    max_passage_tokens: int = 384
+    score_cache_size: int = 50_000
+
+
+class RetrievalCacheConfig(BaseModel):
+    enabled: bool = True
+    max_entries: int = 1024
+    ttl_seconds: float = 300.0
+
+
+class HybridSearchConfig(BaseModel):
+    enabled: bool = False
+    fusion_method: Literal["rrf", "weighted"] = "rrf"
+    lexical_weight: float = 0.5
+    vector_weight: float = 0.5
+    rrf_k: int = 60
+
+
+# HNSW parameters of the faiss knn index and how the vectors are stored.
+class KNNIndexProfile(BaseModel):
+    m: int
+    ef_construction: int
+    ef_search: int
+    # fp16 halves the memory of the index with faiss scalar quantization, byte quantizes the vectors to int8
+    vector_encoding: Literal["float", "fp16", "byte"] = "float"
+    # vectors are multiplied by the scale before rounding to int8, 127 fits vectors with components in [-1, 1]
+    byte_quantization_scale: float = 127.0
+    # number of nearest neighbours searched per query, relative to top_k
+    k_multiplier: float = 1.0
+
+
+KNN_INDEX_PROFILES = {
+    "fast": KNNIndexProfile(
+        m=8, ef_construction=64, ef_search=32, vector_encoding="byte"
+    ),
+    "balanced": KNNIndexProfile(
+        m=16,
+        ef_construction=128,
+        ef_search=100,
+        vector_encoding="fp16",
+        k_multiplier=1.5,
+    ),
+    "high_recall": KNNIndexProfile(
+        m=32,
+        ef_construction=256,
+        ef_search=256,
+        vector_encoding="float",
+        k_multiplier=2.0,
+    ),
+}
+
+
+# Reduces the embeddings before they are indexed and queried, see `vector_store.embedding_reduction`.
+# Changing the reduction requires indexing the documents again, e.g. into a new index_name.
+class EmbeddingReductionConfig(BaseModel):
+    # matryoshka keeps the leading dimensions, which only works for models trained with a matryoshka loss.
+    # pca projects on the principal components of a corpus sample, fitted with `pipelines.embedding_reduction_cli`
+    method: Optional[Literal["matryoshka", "pca"]] = None
+    reduced_dimension: Optional[int] = None
+    pca_sample_size: int = 20_000  # number of chunks the projection is fitted on
 
 
 class OpenSearchConfig(BaseModel):
@@ -42,6 +138,64 @@ class OpenSearchConfig(BaseModel):
     chunk_size: int
     overlap_ratio: float
     filter_confidence_threshold: float = 0.5
+    embedding_batch_size: int = 32
+    upload_batch_size: int = 256
+    # a scope of more files is searched without the file names, whose hits are filtered afterwards. Both backends
+    # limit the terms of a query, sqlite to 32766 variables and OpenSearch to index.max_terms_count, 65536 by default.
+    max_filter_file_names: int = 10_000
+    # factor of top_k searched when the hits are filtered afterwards, as some of them are out of scope
+    post_filter_oversampling: int = 4
+    retrieval_cache_config: RetrievalCacheConfig = RetrievalCacheConfig()
+    hybrid_search_config: HybridSearchConfig = HybridSearchConfig()
+    # one of the KNN_INDEX_PROFILES, or custom parameters. m, ef_construction and the vector encoding
+    # only take effect when the index is created.
+    index_profile: Union[
+        Literal["fast", "balanced", "high_recall"], KNNIndexProfile
+    ] = "balanced"
+    # reduced vectors are no longer normalized, normalize them again to compare them by cosine similarity
+    # in the innerproduct space. Both only take effect for newly indexed documents.
+    normalize_embeddings: bool = False
+    space_type: Literal["l2", "innerproduct"] = "l2"
+    embedding_reduction_config: EmbeddingReductionConfig = EmbeddingReductionConfig()
+
+    # dimension of the indexed vectors, embedding_dimension is the dimension of the embedder
+    @property
+    def index_dimension(self) -> int:
+        if self.embedding_reduction_config.method is None:
+            return self.embedding_dimension
+        return self.embedding_reduction_config.reduced_dimension
+
+    @property
+    def knn_index_profile(self) -> KNNIndexProfile:
+        if isinstance(self.index_profile, KNNIndexProfile):
+            return self.index_profile
+        return KNN_INDEX_PROFILES[self.index_profile]
+
+
+class LocalVectorStoreConfig(BaseModel):
+    storage_dir: Path = DEFAULT_LOCAL_VECTOR_STORE_DIR
+    vector_dtype: Literal["float32", "float16"] = "float32"
+    segment_size: int = 65_536  # number of vectors per memory mapped segment file
+    # larger corpora are searched with an approximate IVF index
+    exact_search_max_vectors: int = 50_000
+    ivf_num_lists: Optional[int] = None  # defaults to sqrt(number of vectors)
+    ivf_num_probes: int = 8
+
+
+class PDFExtractionConfig(BaseModel):
+    # documents with fewer pages are extracted serially, as starting the worker processes costs more
+    parallel_min_pages: int = 64
+    num_workers: Optional[int] = None  # defaults to the number of cpus
+    pages_per_task: int = 16
+    # bounds the extracted text held in memory to max_pending_tasks * pages_per_task pages
+    max_pending_tasks: int = 8
+
+
+class IngestionConfig(BaseModel):
+    # capacities of the queues between the stages, which bound the memory used when a later stage is slower
+    page_queue_size: int = 64
+    chunk_queue_size: int = 1024
+    batch_queue_size: int = 2
 
 
 class DataBaseConfig(BaseModel):
@@ -49,6 +203,78 @@ class DataBaseConfig(BaseModel):
     db_name: str
 
 
+class ModelRegistryConfig(BaseModel):
+    # models are never evicted if no budget is set
+    memory_budget_mb: Optional[int] = None
+    warm_up_on_start: bool = False
+
+
+class AnswerCacheConfig(BaseModel):
+    enabled: bool = True
+    # cosine similarity of the query embeddings above which a cached answer is reused
+    similarity_threshold: float = 0.95
+    max_entries: int = 1024
+    ttl_seconds: float = 3600.0
+
+
+class PromptConfig(BaseModel):
+    # the most recent chat history is kept up to this many tokens before any documents are added
+    history_reserve_tokens: int = 1024
+    # tokens are estimated from the number of characters, unless the tokenizer of the generator is given
+    tokenizer_name: Optional[str] = None
+    chars_per_token: float = 4.0
+    merge_overlapping_chunks: bool = True
+
+
+class WebPageCacheConfig(BaseModel):
+    enabled: bool = True
+    cache_dir: Path = DEFAULT_WEB_PAGE_CACHE_DIR
+    # a page fetched longer ago than this is fetched again
+    ttl_seconds: float = 24 * 3600.0
+
+
+class WebSearchConfig(BaseModel):
+    search_engine: Literal["searxng"] = "searxng"
+    # the searxng instance needs the json format to be enabled in its settings
+    search_url: str = "http://localhost:8888/search"
+    num_results: int = 5
+    search_timeout_seconds: float = 5.0
+    # the result pages are fetched concurrently, each one has to arrive within the timeout
+    max_concurrent_fetches: int = 8
+    fetch_timeout_seconds: float = 5.0
+    max_page_size_mb: float = 5.0
+    # redirects are followed one at a time, every location is checked like the url of the result
+    max_redirects: int = 5
+    # the result urls come from the web, by default they may not point to loopback, link-local or private hosts
+    allow_private_hosts: bool = False
+    user_agent: str = "llm-chat-app"
+    chunk_size: int = 1536
+    overlap_ratio: float = 0.2
+    # the first chunks of every page are reranked together with the vector store documents
+    max_chunks_per_page: int = 8
+    page_cache_config: WebPageCacheConfig = WebPageCacheConfig()
+
+
+class AsyncPipelineConfig(BaseModel):
+    # a retrieval source that does not answer in time is left out of the context
+    retrieval_timeout_seconds: float = 5.0
+    # the documents are kept in retrieval order when reranking does not finish in time
+    rerank_timeout_seconds: float = 10.0
+    time_to_first_token_timeout_seconds: float = 30.0
+    generation_timeout_seconds: float = 120.0
+    # threads of the event loop's default executor, which runs the blocking calls of the local models and the
+    # embedder. Set by the owner of the event loop, see `use_worker_threads`.
+    worker_threads: int = 32
+
+
+class TracingConfig(BaseModel):
+    # spans cost a single method call while tracing is disabled
+    enabled: bool = False
+    # number of recent chat turns and uploads shown in the debug panel
+    max_traces: int = 20
+    show_debug_panel: bool = True
+
+
 class LLMChatConfig(BaseModel):
     root_storage_dir: Path = DEFAULT_DATA_DIR
     file_storage_dir: Optional[Path] = None
@@ -56,8 +282,18 @@ class LLMChatConfig(BaseModel):
     embedding_model_config: EmbeddingModelConfig
     generator_model_config: GeneratorModelConfig
     opensearch_config: OpenSearchConfig
+    vector_store_backend: Literal["opensearch", "local"] = "opensearch"
+    local_vector_store_config: LocalVectorStoreConfig = LocalVectorStoreConfig()
+    pdf_extraction_config: PDFExtractionConfig = PDFExtractionConfig()
+    ingestion_config: IngestionConfig = IngestionConfig()
     database_config: DataBaseConfig
     reranker_config: ReRankerConfig
+    model_registry_config: ModelRegistryConfig = ModelRegistryConfig()
+    prompt_config: PromptConfig = PromptConfig()
+    answer_cache_config: AnswerCacheConfig = AnswerCacheConfig()
+    async_pipeline_config: AsyncPipelineConfig = AsyncPipelineConfig()
+    tracing_config: TracingConfig = TracingConfig()
+    web_search_config: WebSearchConfig = WebSearchConfig()
 
     use_rag: Optional[bool] = False
     use_web_search: Optional[bool] = False
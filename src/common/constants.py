@@ -8,9 +8,16 @@ DEFAULT_FILE_STORAGE_DIR = DEFAULT_DATA_DIR / "file_storage"
 
 # Embeddings model constants
 DEFAULT_EMBEDDING_MODEL_CACHE_DIR = DEFAULT_DATA_DIR / "embedding_model_cache_dir"
+DEFAULT_EMBEDDING_CACHE_DIR = DEFAULT_DATA_DIR / "embedding_cache"
 
 # Generator model constants
 DEFAULT_GENERATOR_MODEL_CACHE_DIR = DEFAULT_DATA_DIR / "generator_model_cache_dir"
 
+# Local vector store constants
+DEFAULT_LOCAL_VECTOR_STORE_DIR = DEFAULT_DATA_DIR / "local_vector_store"
+
+# Web search constants
+DEFAULT_WEB_PAGE_CACHE_DIR = DEFAULT_DATA_DIR / "web_page_cache"
+
 # Database constants
 DEFAULT_DB_DIR = DEFAULT_DATA_DIR / "database"
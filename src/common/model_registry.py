@@ -0,0 +1,224 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel
+
+from common.config import LLMChatConfig
+from generator.generator_model import load_generator
+from reranker.reranker import load_reranker
+from vector_store.embedder import load_embedder
+
+
+class ModelLoadInfo(BaseModel):
+    name: str
+    load_time_seconds: float
+    size_bytes: int
+    last_used: float
+
+
+# Models keep their weights in torch modules, which can be nested a few attributes deep
+# (e.g. CachedEmbedder -> SentenceTransformerEmbedder -> SentenceTransformer). Remote clients hold no weights.
+# Models whose weights are not in torch modules report their size in `model_size_bytes`.
+def estimate_model_size_bytes(model: Any, max_depth: int = 4) -> int:
+    visited = set()
+
+    def _size(obj: Any, depth: int) -> int:
+        if id(obj) in visited or depth > max_depth:
+            return 0
+        visited.add(id(obj))
+        if isinstance(getattr(obj, "model_size_bytes", None), int):
+            return obj.model_size_bytes
+        if callable(getattr(obj, "parameters", None)) and hasattr(obj, "buffers"):
+            return sum(p.numel() * p.element_size() for p in obj.parameters()) + sum(
+                b.numel() * b.element_size() for b in obj.buffers()
+            )
+        if not hasattr(obj, "__dict__"):
+            return 0
+        return sum(_size(attribute, depth + 1) for attribute in vars(obj).values())
+
+    return _size(model, 0)
+
+
+# Process wide owner of the embedder, reranker and generator instances, shared by all sessions.
+# Models are loaded lazily on first use (or warmed up at startup). When a memory budget is configured,
+# the least recently used models that are not currently in use are evicted to stay within the budget.
+class ModelRegistry:
+    def __init__(self, config: LLMChatConfig):
+        self.config = config
+        memory_budget_mb = config.model_registry_config.memory_budget_mb
+        self.memory_budget_bytes = (
+            memory_budget_mb * 1024 * 1024 if memory_budget_mb is not None else None
+        )
+        self._loaders: Dict[str, Callable[[], Any]] = {
+            "embedder": self._load_embedder,
+            "reranker": self._load_reranker,
+            "generator": self._load_generator,
+        }
+        self._models: Dict[str, Any] = {}
+        self._load_info: Dict[str, ModelLoadInfo] = {}
+        self._active_users: Dict[str, int] = {name: 0 for name in self._loaders}
+        self._lock = threading.RLock()
+
+    # Replaces how a model is loaded, e.g. with stand-ins for benchmarks. An already loaded model is evicted.
+    def register_loader(self, name: str, loader: Callable[[], Any]):
+        with self._lock:
+            self._loaders[name] = loader
+            self._active_users.setdefault(name, 0)
+            if name in self._models:
+                self.evict(name)
+
+    def _load_embedder(self):
+        embedding_model_config = self.config.embedding_model_config
+        return load_embedder(
+            provider=embedding_model_config.model_provider,
+            model_name=embedding_model_config.model_name,
+            cache_config=embedding_model_config.embedding_cache_config,
+            base_url=embedding_model_config.api_base_url,
+            request_batch_size=embedding_model_config.request_batch_size,
+            max_concurrent_requests=embedding_model_config.max_concurrent_requests,
+            model_cache_dir=embedding_model_config.cache_dir,
+            trust_remote_code=embedding_model_config.trust_remote_code,
+        )
+
+    def _load_reranker(self):
+        reranker_config = self.config.reranker_config
+        return load_reranker(
+            provider=reranker_config.model_provider,
+            top_k=reranker_config.top_k,
+            model_name=reranker_config.model_name,
+            batch_size=reranker_config.batch_size,
+            max_passage_tokens=reranker_config.max_passage_tokens,
+            score_cache_size=reranker_config.score_cache_size,
+        )
+
+    def _load_generator(self):
+        generator_model_config = self.config.generator_model_config
+        return load_generator(
+            provider=generator_model_config.model_provider,
+            model_name=generator_model_config.model_name,
+            max_output_tokens=generator_model_config.max_output_tokens,
+            temperature=generator_model_config.temperature,
+            context_window_tokens=generator_model_config.context_window_tokens,
+            model_file=generator_model_config.model_file,
+            model_cache_dir=generator_model_config.cache_dir,
+            num_threads=generator_model_config.num_threads,
+            kv_cache_config=generator_model_config.kv_cache_config,
+        )
+
+    def _load(self, name: str) -> Any:
+        start_time = time.perf_counter()
+        model = self._loaders[name]()
+        load_time = time.perf_counter() - start_time
+        size_bytes = estimate_model_size_bytes(model)
+        print(
+            f"Loaded {name=} in {load_time:.2f}s, estimated size {size_bytes / 1024 ** 2:.0f} MB"
+        )
+        self._models[name] = model
+        self._load_info[name] = ModelLoadInfo(
+            name=name,
+            load_time_seconds=load_time,
+            size_bytes=size_bytes,
+            last_used=time.time(),
+        )
+        self._enforce_memory_budget(keep=name)
+        return model
+
+    def _enforce_memory_budget(self, keep: str):
+        if self.memory_budget_bytes is None:
+            return
+        total_size_bytes = sum(info.size_bytes for info in self._load_info.values())
+        eviction_candidates = sorted(
+            (
+                info
+                for info in self._load_info.values()
+                if info.name != keep and self._active_users[info.name] == 0
+            ),
+            key=lambda info: info.last_used,
+        )
+        for info in eviction_candidates:
+            if total_size_bytes <= self.memory_budget_bytes:
+                break
+            self.evict(info.name)
+            total_size_bytes -= info.size_bytes
+        if total_size_bytes > self.memory_budget_bytes:
+            print(
+                f"Loaded models use {total_size_bytes / 1024 ** 2:.0f} MB, "
+                f"which exceeds the memory budget of {self.memory_budget_bytes / 1024 ** 2:.0f} MB"
+            )
+
+    def get(self, name: str) -> Any:
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                model = self._load(name)
+            self._load_info[name].last_used = time.time()
+            return model
+
+    def _acquire(self, name: str) -> Any:
+        with self._lock:
+            model = self.get(name)
+            self._active_users[name] += 1
+            return model
+
+    def _release(self, name: str):
+        with self._lock:
+            self._active_users[name] -= 1
+
+    # Models borrowed through `use` are protected from eviction until the block is left.
+    @contextmanager
+    def use(self, name: str) -> Iterator[Any]:
+        model = self._acquire(name)
+        try:
+            yield model
+        finally:
+            self._release(name)
+
+    # Acquires a model without blocking, returns None if it is not loaded or the lock is held by another thread.
+    def _try_acquire_loaded(self, name: str) -> Optional[Any]:
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            if name not in self._models:
+                return None
+            return self._acquire(name)
+        finally:
+            self._lock.release()
+
+    def _try_release(self, name: str) -> bool:
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._release(name)
+            return True
+        finally:
+            self._lock.release()
+
+    # Async variant of `use`. Loading a model, or waiting for another thread that holds the lock while it loads
+    # one, happens in a worker thread, so that the event loop keeps serving the other sessions meanwhile.
+    @asynccontextmanager
+    async def ause(self, name: str) -> AsyncIterator[Any]:
+        model = self._try_acquire_loaded(name)
+        if model is None:
+            model = await asyncio.to_thread(self._acquire, name)
+        try:
+            yield model
+        finally:
+            if not self._try_release(name):
+                await asyncio.to_thread(self._release, name)
+
+    def evict(self, name: str):
+        with self._lock:
+            self._models.pop(name, None)
+            self._load_info.pop(name, None)
+        print(f"Evicted {name=} from the model registry")
+
+    def warm_up(self, names: Optional[List[str]] = None):
+        for name in names if names is not None else self._loaders:
+            self.get(name)
+
+    def load_stats(self) -> List[ModelLoadInfo]:
+        with self._lock:
+            return [info.model_copy() for info in self._load_info.values()]
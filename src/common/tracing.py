@@ -0,0 +1,239 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# upper bounds of the duration histogram buckets in seconds, the same as the default buckets of prometheus clients
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_PREFIX = "llm_chat_app"
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+# In-process store of the span metrics, exported in the prometheus text format.
+# Every span feeds a duration histogram, labeled with the span name, and a counter per numeric attribute,
+# e.g. the total number of retrieved documents.
+class MetricsRegistry:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms: Dict[str, _Histogram] = {}
+        self._counters: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, span_name: str, duration: float, attributes: Dict):
+        with self._lock:
+            histogram = self._histograms.get(span_name)
+            if histogram is None:
+                histogram = self._histograms[span_name] = _Histogram(self.buckets)
+            histogram.bucket_counts[bisect_left(self.buckets, duration)] += 1
+            histogram.sum += duration
+            histogram.count += 1
+            for attribute, value in attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    key = (span_name, attribute)
+                    self._counters[key] = self._counters.get(key, 0) + value
+
+    def summary(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "span": span_name,
+                    "count": histogram.count,
+                    "mean (ms)": round(1000 * histogram.sum / histogram.count, 1),
+                    "total (s)": round(histogram.sum, 2),
+                }
+                for span_name, histogram in sorted(self._histograms.items())
+            ]
+
+    def to_prometheus_text(self) -> str:
+        duration_metric = f"{METRIC_PREFIX}_span_duration_seconds"
+        attribute_metric = f"{METRIC_PREFIX}_span_attribute_total"
+        lines = [
+            f"# HELP {duration_metric} Duration of the pipeline stages.",
+            f"# TYPE {duration_metric} histogram",
+        ]
+        with self._lock:
+            for span_name, histogram in sorted(self._histograms.items()):
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(
+                    self.buckets + (float("inf"),), histogram.bucket_counts
+                ):
+                    cumulative_count += bucket_count
+                    le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                    lines.append(
+                        f'{duration_metric}_bucket{{span="{span_name}",le="{le}"}} {cumulative_count}'
+                    )
+                lines.append(
+                    f'{duration_metric}_sum{{span="{span_name}"}} {histogram.sum!r}'
+                )
+                lines.append(
+                    f'{duration_metric}_count{{span="{span_name}"}} {histogram.count}'
+                )
+            lines.append(
+                f"# HELP {attribute_metric} Sum of the numeric attributes of the pipeline stages."
+            )
+            lines.append(f"# TYPE {attribute_metric} counter")
+            for (span_name, attribute), value in sorted(self._counters.items()):
+                lines.append(
+                    f'{attribute_metric}{{span="{span_name}",attribute="{attribute}"}} {value!r}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+# Spans of a single chat turn or upload, in the order they ended.
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.start_time = time.time()
+        self.spans: List["Span"] = []
+
+
+class Span:
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.duration: Optional[float] = None
+        self.trace: Optional[Trace] = None
+        self.start_time = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        if self.trace is None:
+            self.trace = _current_trace.get()
+        # a span outside of any trace starts a new trace, which its nested spans are added to
+        if self.trace is None:
+            self.trace = Trace(self.name)
+            self.tracer.add_trace(self.trace)
+            self._token = _current_trace.set(self.trace)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = time.perf_counter() - self.start_time
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        if self._token is not None:
+            _current_trace.reset(self._token)
+        self.tracer.end_span(self)
+
+
+# Returned while tracing is disabled, so that an instrumented stage only pays for a method call.
+class _NoOpSpan:
+    recording = False
+    trace = None
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self) -> "_NoOpSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+class _TraceContext:
+    def __init__(self, trace: Optional[Trace]):
+        self.trace = trace
+        self._token = None
+
+    def __enter__(self) -> Optional[Trace]:
+        if self.trace is not None:
+            self._token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._token is not None:
+            _current_trace.reset(self._token)
+
+
+_NO_OP_TRACE_CONTEXT = _TraceContext(None)
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+# Times the stages of the pipelines. Spans opened within a trace, or another span, belong to it. The most recent
+# traces are kept for the debug panel and every span is recorded in the metrics registry.
+# A span that ends outside of the context it was started in, e.g. while a response is streamed, is attached to
+# its trace explicitly with `trace=`.
+class Tracer:
+    def __init__(self, enabled: bool = False, max_traces: int = 20):
+        self.enabled = enabled
+        self.metrics = MetricsRegistry()
+        self._traces: Deque[Trace] = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool, max_traces: int):
+        self.enabled = enabled
+        if max_traces != self._traces.maxlen:
+            with self._lock:
+                self._traces = deque(self._traces, maxlen=max_traces)
+
+    # Groups the spans opened within it into a new trace, which is None while tracing is disabled.
+    def trace(self, name: str) -> _TraceContext:
+        if not self.enabled:
+            return _NO_OP_TRACE_CONTEXT
+        trace = Trace(name)
+        self.add_trace(trace)
+        return _TraceContext(trace)
+
+    def span(self, name: str, trace: Optional[Trace] = None, **attributes):
+        if not self.enabled:
+            return _NO_OP_SPAN
+        span = Span(self, name, attributes)
+        span.trace = trace
+        return span
+
+    # Records a stage that was timed elsewhere, e.g. the busy time of an ingestion stage.
+    def record(self, name: str, duration: float, **attributes):
+        if not self.enabled:
+            return
+        span = Span(self, name, attributes)
+        span.duration = duration
+        span.trace = _current_trace.get()
+        self.end_span(span)
+
+    @staticmethod
+    def current_trace() -> Optional[Trace]:
+        return _current_trace.get()
+
+    def add_trace(self, trace: Trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def end_span(self, span: Span):
+        if span.trace is not None:
+            with self._lock:
+                span.trace.spans.append(span)
+        self.metrics.observe(span.name, span.duration, span.attributes)
+
+    def recent_traces(self) -> List[Trace]:
+        with self._lock:
+            return list(reversed(self._traces))
+
+
+tracer = Tracer()
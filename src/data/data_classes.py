@@ -1,8 +1,8 @@
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import List, Optional
 from uuid import uuid4
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 
 
 class UploadedFileMetadata(BaseModel):
@@ -14,6 +14,7 @@ class UploadedFileMetadata(BaseModel):
     num_chunks: Optional[int] = 0
     num_chunks_error_upload: Optional[int] = 0
     upload_time: Optional[datetime] = None
+    content_hash: Optional[str] = None
 
 
 class VectorDocumentChunk(BaseModel):
@@ -25,8 +26,83 @@ class VectorDocumentChunk(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid4()))
 
 
+# Restricts a vector store search to a document scope, applied inside the knn query rather than to its results.
+# Unset fields don't restrict the search, the page range is inclusive and counts from 0 like page_num.
+# The upload times are those of the files in `UploadedFilesDB`, in UTC.
+class SearchFilter(BaseModel):
+    file_names: Optional[List[str]] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+    min_page_num: Optional[int] = None
+    max_page_num: Optional[int] = None
+
+    @field_validator("uploaded_after", "uploaded_before")
+    @classmethod
+    def _to_naive_utc(cls, value: Optional[datetime]) -> Optional[datetime]:
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    @property
+    def is_empty(self) -> bool:
+        return all(value is None for value in self.model_dump().values())
+
+
+class WebSearchResult(BaseModel):
+    url: str
+    title: str = ""
+    snippet: str = ""
+
+
 class WebDocumentChunk(BaseModel):
     user_query: str
-    url: int
+    url: str
+    text: str
+    # the snippet of the search result the page was found with
+    summary: str = ""
+    title: str = ""
+    id: str = Field(default_factory=lambda: str(uuid4()))
+
+
+# Text of one or more overlapping chunks of the same file, merged so that the overlap is sent only once.
+class ContextPassage(BaseModel):
     text: str
-    summary: int
+    documents: List[VectorDocumentChunk | WebDocumentChunk]
+
+
+class GenerationStats(BaseModel):
+    time_to_first_token: Optional[float] = None
+    total_time: float = 0.0
+    # streamed text deltas, a delta may hold several tokens
+    num_deltas: int = 0
+    # tokens of the response, None if the stream had no token counter
+    num_tokens: Optional[int] = None
+    from_cache: bool = False
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.num_tokens is None:
+            return None
+        return self.num_tokens / self.total_time if self.total_time > 0 else 0.0
+
+    @property
+    def deltas_per_second(self) -> float:
+        return self.num_deltas / self.total_time if self.total_time > 0 else 0.0
+
+
+class RerankerStats(BaseModel):
+    latency: float = 0.0
+    num_documents: int = 0
+    num_scored: int = 0
+    num_cache_hits: int = 0
+
+
+class IngestionStageStats(BaseModel):
+    stage: str
+    num_items: int = 0
+    # time spent processing, excluding the time waiting on the neighbouring stages
+    busy_time: float = 0.0
+
+    @property
+    def items_per_second(self) -> float:
+        return self.num_items / self.busy_time if self.busy_time > 0 else 0.0
@@ -1,20 +1,34 @@
+import hashlib
+import shutil
 from pathlib import Path
-from typing import Dict
+from typing import BinaryIO, Dict
 
-import streamlit as st
-from streamlit.runtime.uploaded_file_manager import UploadedFile
+from common.config import LLMChatConfig
 
 
-def save_file(uploaded_file: UploadedFile, meta_data: Dict) -> Path:
+# The content is either the complete file, e.g. the buffer of a streamlit upload, or a file object that is copied
+# in blocks, e.g. the spooled file of an http upload.
+def save_file(
+    file_content: bytes | memoryview | BinaryIO, meta_data: Dict, config: LLMChatConfig
+) -> Path:
     assert (
-        meta_data["file_type"] in st.session_state.config.supported_file_formats
-    ), f"File type {meta_data['filetype']} is not in {st.session_state.config.supported_file_formats=}"
-    save_dir = st.session_state.config.file_storage_dir
-    save_dir.mkdir(exist_ok=True)
+        meta_data["file_type"] in config.supported_file_formats
+    ), f"File type {meta_data['file_type']} is not in {config.supported_file_formats=}"
+    save_dir = config.file_storage_dir
+    save_dir.mkdir(parents=True, exist_ok=True)
     file_path = save_dir / meta_data["file_name"]
-    if file_path.exists():
-        print("file already exists...")
-    else:
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+    # an existing file is overwritten, the ingestion decides by the content hash whether anything changed
+    with open(file_path, "wb") as f:
+        if hasattr(file_content, "read"):
+            shutil.copyfileobj(file_content, f)
+        else:
+            f.write(file_content)
     return file_path
+
+
+def compute_file_hash(file_path: Path, block_size: int = 1024 * 1024) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            file_hash.update(block)
+    return file_hash.hexdigest()
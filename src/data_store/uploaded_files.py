@@ -1,26 +1,58 @@
 import sqlite3
-from datetime import datetime
-from typing import List
+import threading
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
 
 import pandas as pd
-import streamlit as st
 
+from common.config import DataBaseConfig
 from data.data_classes import UploadedFileMetadata
 
+COLUMNS = [
+    "id",
+    "file_name",
+    "file_type",
+    "size_on_disk",
+    "num_pages",
+    "num_chunks",
+    "num_chunks_error_upload",
+    "upload_time",
+]
+# format of CURRENT_TIMESTAMP, the upload times are stored in UTC
+UPLOAD_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+
+def _format_upload_time(upload_time: Optional[datetime]) -> Optional[str]:
+    return upload_time.strftime(UPLOAD_TIME_FORMAT) if upload_time is not None else None
+
+
+# Every thread keeps one persistent connection to the database, instead of connecting per query.
+# The database runs in WAL mode, so readers are not blocked while an upload writes, and concurrent
+# writers wait for each other up to busy_timeout_ms instead of failing.
 class UploadedFilesDB:
-    def __init__(self):
-        self.db_dir = st.session_state.config.database_config.root_dir
-        self.db_name = st.session_state.config.database_config.db_name
+    def __init__(self, database_config: DataBaseConfig, busy_timeout_ms: int = 5000):
+        self.db_dir = database_config.root_dir
+        self.db_name = database_config.db_name
         self.db_path = self.db_dir / self.db_name
         self.db_dir.mkdir(exist_ok=True)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
 
         self.create_table()
 
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
     def create_table(self):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        with self.conn as conn:
+            conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS uploaded_files(
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -30,39 +62,118 @@ class UploadedFilesDB:
                     num_pages INTEGER NOT NULL,
                     num_chunks INTEGER,
                     num_chunks_error_upload INTEGER,
-                    upload_time DATETIME DEFAULT CURRENT_TIMESTAMP
+                    upload_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    content_hash TEXT
                 )
                 """
             )
+            # databases created before files were identified by their content have no hash column
+            columns = [
+                row[1] for row in conn.execute("PRAGMA table_info(uploaded_files)")
+            ]
+            if "content_hash" not in columns:
+                conn.execute("ALTER TABLE uploaded_files ADD COLUMN content_hash TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_uploaded_files_content_hash ON uploaded_files(content_hash)"
+            )
+            # the listing is ordered by upload time
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_uploaded_files_upload_time ON uploaded_files(upload_time)"
+            )
+            # a single row, counting the changes of the indexed documents, see `VectorStore.invalidate_retrieval_caches`
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS index_generation(
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    generation INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO index_generation (id, generation) VALUES (0, 0)"
+            )
 
     def insert_file(self, uploaded_file_meta_data: UploadedFileMetadata):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        self.insert_files([uploaded_file_meta_data])
+
+    # All files are inserted in a single transaction.
+    def insert_files(self, uploaded_files_meta_data: List[UploadedFileMetadata]):
+        with self.conn as conn:
+            conn.executemany(
                 """
-                INSERT INTO uploaded_files (file_name, file_type, size_on_disk, num_pages, num_chunks, num_chunks_error_upload)
-                VALUES (?, ?, ?, ?, ?, ?)
+                INSERT INTO uploaded_files (
+                    file_name, file_type, size_on_disk, num_pages, num_chunks, num_chunks_error_upload, content_hash,
+                    upload_time
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                """,
+                [
+                    (
+                        meta_data.file_name,
+                        meta_data.file_type,
+                        meta_data.size_on_disk,
+                        meta_data.num_pages,
+                        meta_data.num_chunks,
+                        meta_data.num_chunks_error_upload,
+                        meta_data.content_hash,
+                        _format_upload_time(meta_data.upload_time),
+                    )
+                    for meta_data in uploaded_files_meta_data
+                ],
+            )
+
+    def update_file(self, uploaded_file_meta_data: UploadedFileMetadata):
+        with self.conn as conn:
+            conn.execute(
+                """
+                UPDATE uploaded_files
+                SET file_type = ?, size_on_disk = ?, num_pages = ?, num_chunks = ?, num_chunks_error_upload = ?,
+                    content_hash = ?, upload_time = COALESCE(?, CURRENT_TIMESTAMP)
+                WHERE file_name = ?
                 """,
                 (
-                    uploaded_file_meta_data.file_name,
                     uploaded_file_meta_data.file_type,
                     uploaded_file_meta_data.size_on_disk,
                     uploaded_file_meta_data.num_pages,
                     uploaded_file_meta_data.num_chunks,
                     uploaded_file_meta_data.num_chunks_error_upload,
+                    uploaded_file_meta_data.content_hash,
+                    _format_upload_time(uploaded_file_meta_data.upload_time),
+                    uploaded_file_meta_data.file_name,
                 ),
             )
 
-    def read_all_files(self) -> List[UploadedFileMetadata]:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, file_name, file_type, size_on_disk, num_pages, num_chunks, num_chunks_error_upload, upload_time
-                FROM uploaded_files
-                """
-            )
-            rows = cursor.fetchall()
+    @staticmethod
+    def _filter_clause(file_name_filter: Optional[str]) -> Tuple[str, list]:
+        if not file_name_filter:
+            return "", []
+        escaped_filter = (
+            file_name_filter.replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_")
+        )
+        return " WHERE file_name LIKE ? ESCAPE '\\'", [f"%{escaped_filter}%"]
+
+    def _listing_query(
+        self, limit: Optional[int], offset: int, file_name_filter: Optional[str]
+    ) -> Tuple[str, list]:
+        filter_clause, params = self._filter_clause(file_name_filter)
+        query = f"SELECT {', '.join(COLUMNS)} FROM uploaded_files{filter_clause} ORDER BY upload_time DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params.extend([limit, offset])
+        return query, params
+
+    # Files are listed from the most recent upload, a page of `limit` files at a time.
+    # file_name_filter matches any part of the file name.
+    def read_files(
+        self,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        file_name_filter: Optional[str] = None,
+    ) -> List[UploadedFileMetadata]:
+        query, params = self._listing_query(limit, offset, file_name_filter)
+        rows = self.conn.execute(query, params).fetchall()
 
         files = [
             UploadedFileMetadata(
@@ -73,48 +184,77 @@ class UploadedFilesDB:
                 num_pages=row[4],
                 num_chunks=row[5],
                 num_chunks_error_upload=row[6],
-                upload_time=datetime.strptime(row[7], "%Y-%m-%d %H:%M:%S"),
+                upload_time=datetime.strptime(row[7], UPLOAD_TIME_FORMAT),
             )
             for row in rows
         ]
 
         return files
 
+    def read_all_files(self) -> List[UploadedFileMetadata]:
+        return self.read_files()
+
+    def read_files_as_df(
+        self,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        file_name_filter: Optional[str] = None,
+    ) -> pd.DataFrame:
+        query, params = self._listing_query(limit, offset, file_name_filter)
+        rows = self.conn.execute(query, params).fetchall()
+        return pd.DataFrame(data=rows, columns=COLUMNS)
+
     def read_all_files_as_df(self) -> pd.DataFrame:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, file_name, file_type, size_on_disk, num_pages, num_chunks, num_chunks_error_upload, upload_time
-                FROM uploaded_files
-                """
-            )
-            rows = cursor.fetchall()
-
-        columns = [
-            "id",
-            "file_name",
-            "file_type",
-            "size_on_disk",
-            "num_pages",
-            "num_chunks",
-            "num_chunks_error_upload",
-            "upload_time",
-        ]
-        df = pd.DataFrame(data=rows, columns=columns)
+        return self.read_files_as_df()
 
-        return df
+    def count_files(self, file_name_filter: Optional[str] = None) -> int:
+        filter_clause, params = self._filter_clause(file_name_filter)
+        query = f"SELECT COUNT(*) FROM uploaded_files{filter_clause}"
+        return self.conn.execute(query, params).fetchone()[0]
 
-    def file_exists(self, file_name: str) -> bool:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT id, file_name, file_type, size_on_disk, num_pages, num_chunks, num_chunks_error_upload, upload_time
-                FROM uploaded_files
-                WHERE file_name = ?
-                """,
-                (file_name,),
+    def find_file_names(
+        self,
+        uploaded_after: Optional[datetime] = None,
+        uploaded_before: Optional[datetime] = None,
+    ) -> List[str]:
+        conditions, params = [], []
+        if uploaded_after is not None:
+            # the upload times are stored in seconds, a file uploaded in the same second was uploaded before
+            if uploaded_after.microsecond:
+                uploaded_after = uploaded_after.replace(microsecond=0) + timedelta(
+                    seconds=1
+                )
+            conditions.append("upload_time >= ?")
+            params.append(_format_upload_time(uploaded_after))
+        if uploaded_before is not None:
+            conditions.append("upload_time <= ?")
+            params.append(_format_upload_time(uploaded_before))
+        where_clause = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.conn.execute(
+            f"SELECT file_name FROM uploaded_files{where_clause}", params
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def read_index_generation(self) -> int:
+        return self.conn.execute(
+            "SELECT generation FROM index_generation WHERE id = 0"
+        ).fetchone()[0]
+
+    def bump_index_generation(self):
+        with self.conn as conn:
+            conn.execute(
+                "UPDATE index_generation SET generation = generation + 1 WHERE id = 0"
             )
-            rows = cursor.fetchall()
-            return len(rows) > 0
+
+    def file_exists(self, file_name: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM uploaded_files WHERE file_name = ? LIMIT 1", (file_name,)
+        ).fetchone()
+        return row is not None
+
+    def find_file_name_by_hash(self, content_hash: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT file_name FROM uploaded_files WHERE content_hash = ? LIMIT 1",
+            (content_hash,),
+        ).fetchone()
+        return row[0] if row is not None else None
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+from data.data_classes import VectorDocumentChunk, WebDocumentChunk
+
+
+class AnswerCacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+class _CachedAnswer:
+    def __init__(
+        self,
+        context_key: Tuple,
+        query_embedding: np.ndarray,
+        answer: str,
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ):
+        self.context_key = context_key
+        self.query_embedding = query_embedding
+        self.answer = answer
+        self.documents = documents
+        self.created_at = time.monotonic()
+
+
+# Caches generated answers by the similarity of the query embedding. An answer is only reused for a query whose
+# context is the same as the one it was generated with: the same preceding chat history, the same generator
+# settings and the same set of retrieved chunks. Chunk ids are derived from the chunk content, so an answer whose
+# source chunks were re-indexed with different text, or deleted, is never returned.
+class AnswerCache:
+    def __init__(
+        self,
+        similarity_threshold: float = 0.95,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600.0,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = AnswerCacheStats()
+
+        self._entries: OrderedDict[int, _CachedAnswer] = OrderedDict()
+        # entries are looked up by their context first, the query similarity is only computed for those
+        self._entries_by_context: Dict[Tuple, Set[int]] = {}
+        self._next_entry_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_context_key(
+        chat_history: List[Dict[str, str]],
+        document_ids: Iterable[str],
+        generator_settings: Dict,
+    ) -> Tuple:
+        history_hash = hashlib.sha256(
+            json.dumps(chat_history, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        settings_hash = hashlib.sha256(
+            json.dumps(generator_settings, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        return history_hash, settings_hash, frozenset(document_ids)
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        context_entries = self._entries_by_context[entry.context_key]
+        context_entries.discard(entry_id)
+        if not context_entries:
+            del self._entries_by_context[entry.context_key]
+
+    def get(
+        self, query_embedding: np.ndarray, context_key: Tuple
+    ) -> Optional[Tuple[str, List[VectorDocumentChunk | WebDocumentChunk]]]:
+        query_embedding = self._normalize(query_embedding)
+        with self._lock:
+            best_entry_id, best_similarity = None, self.similarity_threshold
+            for entry_id in list(self._entries_by_context.get(context_key, ())):
+                entry = self._entries[entry_id]
+                if time.monotonic() - entry.created_at > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+                similarity = float(np.dot(query_embedding, entry.query_embedding))
+                if similarity >= best_similarity:
+                    best_entry_id, best_similarity = entry_id, similarity
+
+            if best_entry_id is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(best_entry_id)
+            self.stats.hits += 1
+            entry = self._entries[best_entry_id]
+            return entry.answer, list(entry.documents)
+
+    def put(
+        self,
+        query_embedding: np.ndarray,
+        context_key: Tuple,
+        answer: str,
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ):
+        entry = _CachedAnswer(
+            context_key, self._normalize(query_embedding), answer, list(documents)
+        )
+        with self._lock:
+            entry_id = self._next_entry_id
+            self._next_entry_id += 1
+            self._entries[entry_id] = entry
+            self._entries_by_context.setdefault(context_key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._entries_by_context.clear()
@@ -1,9 +1,76 @@
+import asyncio
 import os
+import time
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any
+from pathlib import Path
+from typing import List, Dict, Any, AsyncIterator, Callable, Iterator, Optional
 
-import streamlit as st
-from huggingface_hub import InferenceClient
+from huggingface_hub import AsyncInferenceClient, InferenceClient
+
+from common.config import KVCacheConfig
+from common.constants import DEFAULT_GENERATOR_MODEL_CACHE_DIR
+from data.data_classes import GenerationStats
+
+
+# Iterator over the text deltas of a streamed response. Time to first token and tokens/sec are recorded in
+# `stats` while the stream is consumed, the complete response is available as `text` once it is exhausted.
+# A delta may hold several tokens, so the tokens of the response are counted with count_tokens at the end,
+# e.g. the token counter of the context builder. Without it only the deltas are counted.
+class ResponseStream:
+    def __init__(
+        self,
+        deltas: Iterator[str],
+        count_tokens: Optional[Callable[[str], int]] = None,
+    ):
+        self._deltas = deltas
+        self.count_tokens = count_tokens
+        self.stats = GenerationStats()
+        self._text_parts = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._text_parts)
+
+    def __iter__(self) -> Iterator[str]:
+        start_time = time.perf_counter()
+        for delta in self._deltas:
+            if self.stats.time_to_first_token is None:
+                self.stats.time_to_first_token = time.perf_counter() - start_time
+            self.stats.num_deltas += 1
+            self._text_parts.append(delta)
+            yield delta
+        self.stats.total_time = time.perf_counter() - start_time
+        if self.count_tokens is not None:
+            self.stats.num_tokens = self.count_tokens(self.text)
+
+
+# Async counterpart of `ResponseStream`, for the async chat pipeline.
+class AsyncResponseStream:
+    def __init__(
+        self,
+        deltas: AsyncIterator[str],
+        count_tokens: Optional[Callable[[str], int]] = None,
+    ):
+        self._deltas = deltas
+        self.count_tokens = count_tokens
+        self.stats = GenerationStats()
+        self._text_parts = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._text_parts)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        start_time = time.perf_counter()
+        async for delta in self._deltas:
+            if self.stats.time_to_first_token is None:
+                self.stats.time_to_first_token = time.perf_counter() - start_time
+            self.stats.num_deltas += 1
+            self._text_parts.append(delta)
+            yield delta
+        self.stats.total_time = time.perf_counter() - start_time
+        if self.count_tokens is not None:
+            self.stats.num_tokens = self.count_tokens(self.text)
 
 
 class GeneratorModel(ABC):
@@ -13,18 +80,48 @@ class GeneratorModel(ABC):
     ):
         pass
 
+    # Providers without a streaming API yield the complete response as a single delta.
+    def generate_deltas(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> Iterator[str]:
+        yield self.generate_response(chat_history, generation_args)
+
+    def stream_response(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> ResponseStream:
+        return ResponseStream(self.generate_deltas(chat_history, generation_args))
+
+    # Providers without an async client stream the deltas of `generate_deltas` from a worker thread, one delta at
+    # a time, so that the event loop is not blocked while waiting for the next one.
+    async def agenerate_deltas(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> AsyncIterator[str]:
+        deltas = self.generate_deltas(chat_history, generation_args)
+        end_of_stream = object()
+        while True:
+            delta = await asyncio.to_thread(next, deltas, end_of_stream)
+            if delta is end_of_stream:
+                break
+            yield delta
+
 
 class HFAPIGeneratorModel(GeneratorModel):
-    def __init__(self, hf_identifier: str):
+    def __init__(
+        self, hf_identifier: str, max_output_tokens: int, temperature: float = 0.0
+    ):
         self.hf_identifier = hf_identifier
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
         hf_api_token = os.getenv("LLM_CHAT_APP_HF_API_TOKEN")
         self.client = InferenceClient(model=self.hf_identifier, token=hf_api_token)
+        self.async_client = AsyncInferenceClient(
+            model=self.hf_identifier, token=hf_api_token
+        )
 
-    @staticmethod
-    def _get_default_generation_args():
+    def _get_default_generation_args(self):
         generation_args = {
-            "max_tokens": st.session_state.config.generator_model_config.max_output_tokens,
-            "temperature": st.session_state.config.generator_model_config.temperature,
+            "max_tokens": self.max_output_tokens,
+            "temperature": self.temperature,
         }
         return generation_args
 
@@ -40,9 +137,63 @@ class HFAPIGeneratorModel(GeneratorModel):
 
         return response
 
+    def generate_deltas(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> Iterator[str]:
+        if generation_args is None:
+            generation_args = self._get_default_generation_args()
+
+        for chunk in self.client.chat_completion(
+            chat_history, stream=True, **generation_args
+        ):
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
 
-def load_generator(provider: str, model_name: str) -> GeneratorModel:
+    async def agenerate_deltas(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> AsyncIterator[str]:
+        if generation_args is None:
+            generation_args = self._get_default_generation_args()
+
+        async for chunk in await self.async_client.chat_completion(
+            chat_history, stream=True, **generation_args
+        ):
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+
+def load_generator(
+    provider: str,
+    model_name: str,
+    max_output_tokens: int,
+    temperature: float = 0.0,
+    context_window_tokens: int = 8192,
+    model_file: Optional[str] = None,
+    model_cache_dir: Path = DEFAULT_GENERATOR_MODEL_CACHE_DIR,
+    num_threads: Optional[int] = None,
+    kv_cache_config: Optional[KVCacheConfig] = None,
+) -> GeneratorModel:
     if provider == "hf_api":
-        return HFAPIGeneratorModel(model_name)
+        return HFAPIGeneratorModel(model_name, max_output_tokens, temperature)
+    elif provider == "llama_cpp":
+        # imported here, as llama-cpp-python is only needed for local generation
+        from generator.llama_cpp_generator import LlamaCppGeneratorModel
+
+        return LlamaCppGeneratorModel(
+            model_name,
+            max_output_tokens,
+            temperature,
+            context_window_tokens=context_window_tokens,
+            model_file=model_file,
+            model_cache_dir=model_cache_dir,
+            num_threads=num_threads,
+            kv_cache_config=kv_cache_config,
+        )
     else:
         print(f"No generator implemented for {provider=}")
@@ -0,0 +1,171 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from llama_cpp import Llama, LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+
+from common.config import KVCacheConfig
+from common.constants import DEFAULT_GENERATOR_MODEL_CACHE_DIR
+from generator.generator_model import GeneratorModel
+
+
+# The user and assistant messages of a conversation, the system prompt and the retrieved context left out.
+Dialogue = Tuple[Tuple[str, str], ...]
+
+
+def dialogue_key(chat_history: List[Dict[str, str]]) -> Dialogue:
+    return tuple(
+        (message["role"], message["content"])
+        for message in chat_history
+        if message["role"] != "system"
+    )
+
+
+# The logits saved with a state are not part of llama_state_size, but take n_batch x n_vocab floats.
+def _state_size_bytes(state: LlamaState) -> int:
+    return state.llama_state_size + state.scores.nbytes
+
+
+# Keeps the kv states of recent conversations, keyed by the tokens a state holds: the prompt and the answer of the
+# last turn. Before a completion, llama.cpp loads the state with the longest common prefix and only prefills the
+# tokens after it. The retrieved context is inserted right before the query, so the state of the previous turn is
+# reused up to its context message and the history after it is prefilled again. A state is also tagged with the
+# dialogue it was generated for, the user and assistant messages without the system ones, and the next turn of a
+# conversation replaces the states whose dialogue it continues, so every conversation holds at most one state.
+# The system prompt is a prefix of every conversation, so even the first turn of a new one reuses the state of
+# another conversation. Conversations are evicted least recently used first, to stay within max_sessions and
+# max_size_mb.
+class SessionKVCache(BaseLlamaCache):
+    def __init__(self, cache_config: KVCacheConfig):
+        super().__init__(capacity_bytes=cache_config.max_size_mb * 1024 * 1024)
+        self.max_sessions = cache_config.max_sessions
+        self.max_session_size_bytes = cache_config.max_session_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+        self._states: OrderedDict[Tuple[int, ...], LlamaState] = OrderedDict()
+        self._dialogues: Dict[Tuple[int, ...], Dialogue] = {}
+        self._size_bytes = 0
+        # set by the generator before each completion, the state saved after it belongs to this dialogue
+        self.dialogue: Dialogue = ()
+
+    @property
+    def cache_size(self) -> int:
+        return self._size_bytes
+
+    def _find_longest_prefix_key(
+        self, key: Tuple[int, ...]
+    ) -> Optional[Tuple[int, ...]]:
+        longest_prefix_key, longest_prefix_len = None, 0
+        for cached_key in self._states:
+            prefix_len = Llama.longest_token_prefix(cached_key, key)
+            if prefix_len > longest_prefix_len:
+                longest_prefix_key, longest_prefix_len = cached_key, prefix_len
+        return longest_prefix_key
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        cached_key = self._find_longest_prefix_key(tuple(key))
+        if cached_key is None:
+            self.misses += 1
+            raise KeyError("No cached state shares a prefix with the prompt")
+        self.hits += 1
+        self._states.move_to_end(cached_key)
+        return self._states[cached_key]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def _remove(self, key: Tuple[int, ...]):
+        self._size_bytes -= _state_size_bytes(self._states.pop(key))
+        self._dialogues.pop(key, None)
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        key = tuple(key)
+        size_bytes = _state_size_bytes(value)
+        # a conversation that outgrew the limit keeps the state of its last turn that fit
+        if size_bytes > self.max_session_size_bytes:
+            return
+        # the states of earlier turns of the same conversation, or of the same turn generated again
+        dialogue = self.dialogue
+        for cached_key, cached_dialogue in list(self._dialogues.items()):
+            if dialogue[: len(cached_dialogue)] == cached_dialogue:
+                self._remove(cached_key)
+        if key in self._states:
+            self._remove(key)
+        self._states[key] = value
+        self._dialogues[key] = dialogue
+        self._size_bytes += size_bytes
+        while self._states and (
+            len(self._states) > self.max_sessions
+            or self._size_bytes > self.capacity_bytes
+        ):
+            self._remove(next(iter(self._states)))
+
+
+# Generates on the cpu with llama.cpp from a gguf file, without a network round trip. The model holds the kv state
+# of a single sequence, so the sessions generate one at a time, and the states of recent conversations are kept
+# in a `SessionKVCache` to switch between them without prefilling their history again.
+class LlamaCppGeneratorModel(GeneratorModel):
+    def __init__(
+        self,
+        model_name: str,
+        max_output_tokens: int,
+        temperature: float = 0.0,
+        context_window_tokens: int = 8192,
+        model_file: Optional[str] = None,
+        model_cache_dir: Path = DEFAULT_GENERATOR_MODEL_CACHE_DIR,
+        num_threads: Optional[int] = None,
+        kv_cache_config: Optional[KVCacheConfig] = None,
+    ):
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+        llama_args = {
+            "n_ctx": context_window_tokens,
+            "n_threads": num_threads,
+            "verbose": False,
+        }
+        if model_file is None:
+            self.llm = Llama(model_path=model_name, **llama_args)
+        else:
+            self.llm = Llama.from_pretrained(
+                model_name, model_file, cache_dir=model_cache_dir, **llama_args
+            )
+        # the weights are memory mapped from the gguf file, see `estimate_model_size_bytes`
+        self.model_size_bytes = Path(self.llm.model_path).stat().st_size
+
+        self.kv_cache = None
+        if kv_cache_config is not None and kv_cache_config.enabled:
+            self.kv_cache = SessionKVCache(kv_cache_config)
+            self.llm.set_cache(self.kv_cache)
+        self._lock = threading.Lock()
+
+    def _get_default_generation_args(self):
+        generation_args = {
+            "max_tokens": self.max_output_tokens,
+            "temperature": self.temperature,
+        }
+        return generation_args
+
+    def generate_response(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ):
+        return "".join(self.generate_deltas(chat_history, generation_args))
+
+    # The state of the conversation is cached once its answer was generated completely.
+    def generate_deltas(
+        self, chat_history: List[Dict[str, str]], generation_args: Dict[str, Any] = None
+    ) -> Iterator[str]:
+        if generation_args is None:
+            generation_args = self._get_default_generation_args()
+
+        with self._lock:
+            if self.kv_cache is not None:
+                self.kv_cache.dialogue = dialogue_key(chat_history)
+            for chunk in self.llm.create_chat_completion(
+                chat_history, stream=True, **generation_args
+            ):
+                delta = chunk["choices"][0]["delta"].get("content")
+                if delta:
+                    yield delta
@@ -0,0 +1,219 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from common.config import LLMChatConfig
+from common.model_registry import ModelRegistry
+from common.tracing import Trace, tracer
+from data.data_classes import SearchFilter, VectorDocumentChunk, WebDocumentChunk
+from generator.generator_model import AsyncResponseStream
+from pipelines.chat_completion import ChatCompletionPipeline
+from vector_store.base_vector_store import VectorStore
+from web_search.web_retriever import WebRetriever
+
+
+# The default executor of asyncio is sized by the number of cpus, which is too small when the blocking calls mostly
+# wait on remote apis.
+def use_worker_threads(loop: asyncio.AbstractEventLoop, worker_threads: int):
+    loop.set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=worker_threads, thread_name_prefix="chat-pipeline-worker"
+        )
+    )
+
+
+async def _single_delta(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+# Async variant of the chat pipeline, so that one event loop serves many concurrent sessions without a thread
+# per session. The vector search and the generation use the async clients of OpenSearch and the hf inference
+# api, the local models (embedder, reranker) run in worker threads. The retrieval sources are queried
+# concurrently, and every stage has a timeout:
+# - a retrieval source that times out is left out of the context
+# - documents whose reranking times out are kept in retrieval order
+# - a generation that times out raises `TimeoutError` to the consumer of the stream
+class AsyncChatCompletionPipeline(ChatCompletionPipeline):
+    def __init__(
+        self,
+        config: LLMChatConfig,
+        vector_store: VectorStore,
+        model_registry: ModelRegistry,
+        web_retriever: Optional[WebRetriever] = None,
+    ):
+        super().__init__(
+            config=config,
+            vector_store=vector_store,
+            model_registry=model_registry,
+            web_retriever=web_retriever,
+        )
+        self.timeouts = self.config.async_pipeline_config
+
+    async def _aretrieve_from_source(
+        self, span_name: str, retrieval: Awaitable[List]
+    ) -> List[VectorDocumentChunk | WebDocumentChunk]:
+        with tracer.span(span_name) as span:
+            try:
+                documents = await asyncio.wait_for(
+                    retrieval, self.timeouts.retrieval_timeout_seconds
+                )
+            except asyncio.TimeoutError:
+                print(
+                    f"{span_name} timed out after {self.timeouts.retrieval_timeout_seconds}s, "
+                    f"its documents are left out of the context"
+                )
+                span.set(timed_out=1)
+                return []
+            span.set(num_documents=len(documents))
+            return documents
+
+    async def _aretrieve_documents(
+        self, query_text: str, search_filter: Optional[SearchFilter] = None
+    ) -> Tuple[List[VectorDocumentChunk], List[WebDocumentChunk]]:
+        retrievals = {}
+        if self.config.use_rag:
+            retrievals["chat.retrieval"] = self.vector_store.asearch(
+                query_text=query_text, search_filter=search_filter
+            )
+        if self.config.use_web_search and self.web_retriever is not None:
+            retrievals["chat.web_search"] = self.web_retriever.asearch(query_text)
+
+        retrieved_documents = dict(
+            zip(
+                retrievals,
+                await asyncio.gather(
+                    *(
+                        self._aretrieve_from_source(span_name, retrieval)
+                        for span_name, retrieval in retrievals.items()
+                    )
+                ),
+            )
+        )
+        return retrieved_documents.get("chat.retrieval", []), retrieved_documents.get(
+            "chat.web_search", []
+        )
+
+    async def _arerank_documents(
+        self,
+        query_text: str,
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> List[VectorDocumentChunk | WebDocumentChunk]:
+        try:
+            return await asyncio.wait_for(
+                asyncio.to_thread(self._rerank_documents, query_text, documents),
+                self.timeouts.rerank_timeout_seconds,
+            )
+        except asyncio.TimeoutError:
+            print(
+                f"Reranking timed out after {self.timeouts.rerank_timeout_seconds}s, "
+                f"the documents are kept in retrieval order"
+            )
+            return documents
+
+    async def _aprepare_turn(
+        self,
+        chat_history: List[Dict[str, str]],
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[
+        Optional[Tuple[str, List[VectorDocumentChunk | WebDocumentChunk]]],
+        Optional[Tuple[np.ndarray, Tuple]],
+        List[Dict[str, str]],
+        List[VectorDocumentChunk | WebDocumentChunk],
+    ]:
+        query_text = chat_history[-1]["content"]
+        vector_documents, web_documents = await self._aretrieve_documents(
+            query_text, search_filter
+        )
+        documents = vector_documents + web_documents
+        cached_answer, answer_cache_key = await asyncio.to_thread(
+            self._lookup_answer, chat_history, documents
+        )
+        if cached_answer is not None:
+            return cached_answer, answer_cache_key, [], []
+
+        documents = await self._arerank_documents(query_text, documents)
+        model_input, documents = self._build_prompt(chat_history, documents)
+        return None, answer_cache_key, model_input, documents
+
+    async def arun_completion_pipeline(
+        self,
+        chat_history: List[Dict[str, str]],
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[str, List[VectorDocumentChunk | WebDocumentChunk]]:
+        response_stream, documents = await self.astream_completion_pipeline(
+            chat_history, search_filter
+        )
+        async for _ in response_stream:
+            pass
+        return response_stream.text, documents
+
+    async def astream_completion_pipeline(
+        self,
+        chat_history: List[Dict[str, str]],
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[AsyncResponseStream, List[VectorDocumentChunk | WebDocumentChunk]]:
+
+        with tracer.trace("chat") as trace:
+            cached_answer, answer_cache_key, model_input, documents = (
+                await self._aprepare_turn(chat_history, search_filter)
+            )
+        if cached_answer is not None:
+            answer, documents = cached_answer
+            response_stream = AsyncResponseStream(_single_delta(answer))
+            response_stream.stats.from_cache = True
+            return response_stream, documents
+
+        response_stream = AsyncResponseStream(
+            self._agenerate_deltas(
+                model_input,
+                trace,
+                answer_cache_key=answer_cache_key,
+                documents=documents,
+            ),
+            count_tokens=self.context_builder.token_counter.count,
+        )
+
+        return response_stream, documents
+
+    # Waits at most time_to_first_token_timeout_seconds for the first delta, and generation_timeout_seconds for
+    # the complete response. Like the sync pipeline, the answer is cached once it was streamed completely.
+    async def _agenerate_deltas(
+        self,
+        model_input: List[Dict[str, str]],
+        trace: Optional[Trace] = None,
+        answer_cache_key: Optional[Tuple[np.ndarray, Tuple]] = None,
+        documents: List[VectorDocumentChunk | WebDocumentChunk] = None,
+    ) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        deadline = start_time + self.timeouts.generation_timeout_seconds
+        first_token_deadline = (
+            start_time + self.timeouts.time_to_first_token_timeout_seconds
+        )
+        deltas = []
+        async with self.model_registry.ause("generator") as generator:
+            with tracer.span("chat.generate", trace=trace) as span:
+                delta_stream = generator.agenerate_deltas(model_input)
+                try:
+                    while True:
+                        # a timer per delta is much cheaper than wrapping every delta into a task with wait_for
+                        delta_deadline = deadline
+                        if not deltas:
+                            delta_deadline = min(deadline, first_token_deadline)
+                        try:
+                            async with asyncio.timeout_at(delta_deadline):
+                                delta = await anext(delta_stream)
+                        except StopAsyncIteration:
+                            break
+                        if not deltas and span.recording:
+                            span.set(time_to_first_token=loop.time() - start_time)
+                        deltas.append(delta)
+                        yield delta
+                finally:
+                    await delta_stream.aclose()
+                span.set(num_deltas=len(deltas))
+
+        if answer_cache_key is not None:
+            self.answer_cache.put(*answer_cache_key, "".join(deltas), documents or [])
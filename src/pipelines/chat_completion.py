@@ -1,93 +1,275 @@
-from typing import List, Dict, Tuple
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import List, Dict, Iterator, Optional, Tuple
 
-import streamlit as st
+import numpy as np
 
-from data.data_classes import VectorDocumentChunk, WebDocumentChunk
-from generator.generator_model import load_generator
-from reranker.reranker import load_reranker
-from vector_store.document_vector_store import VectorDB
+from data.data_classes import SearchFilter, VectorDocumentChunk, WebDocumentChunk
+from common.config import LLMChatConfig
+from common.model_registry import ModelRegistry
+from common.tracing import Trace, tracer
+from generator.answer_cache import AnswerCache
+from generator.generator_model import ResponseStream
+from pipelines.context_builder import ContextBuilder
+from vector_store.base_vector_store import VectorStore
+from web_search.web_retriever import WebRetriever, load_web_retriever
 
 
 class ChatCompletionPipeline:
-    def __init__(self, vector_store: VectorDB):
+    def __init__(
+        self,
+        config: LLMChatConfig,
+        vector_store: VectorStore,
+        model_registry: ModelRegistry,
+        web_retriever: Optional[WebRetriever] = None,
+    ):
+        self.config = config
         self.vector_store = vector_store
-        self.reranker = self._load_reranker()
-        self.generator = self._load_generator()
-
-    def _load_generator(self):
-        return load_generator(
-            provider=st.session_state.config.generator_model_config.model_provider,
-            model_name=st.session_state.config.generator_model_config.model_name,
-        )
-
-    def _load_reranker(self):
-        return load_reranker(
-            provider=st.session_state.config.reranker_config.model_provider,
-            top_k=st.session_state.config.reranker_config.top_k,
+        self.model_registry = model_registry
+        self.web_retriever = web_retriever
+        if self.web_retriever is None and self.config.use_web_search:
+            self.web_retriever = load_web_retriever(self.config.web_search_config)
+        # runs the web search of a turn while the calling thread queries the vector store
+        self.web_search_executor = ThreadPoolExecutor(thread_name_prefix="web-search")
+        self.answer_cache = self._init_answer_cache()
+        generator_model_config = self.config.generator_model_config
+        self.context_builder = ContextBuilder(
+            self.config.prompt_config,
+            context_window_tokens=generator_model_config.context_window_tokens,
+            max_output_tokens=generator_model_config.max_output_tokens,
         )
 
+    # Returns the model input together with the documents that made it into the prompt. Overlapping chunks are
+    # merged and the history and documents are cut to the token budget of the generator, see `ContextBuilder`.
     def enrich_prompt(
         self,
         system_prompt: str,
         chat_history: List[Dict[str, str]],
         query: Dict[str, str],
-        vector_documents: List[VectorDocumentChunk],
-        web_documents: List[WebDocumentChunk],
-    ) -> List[Dict[str, str]]:
-        model_input = [{"role": "system", "content": system_prompt}]
-        model_input.extend(chat_history)
-
-        context_document_texts = []
-        for doc in vector_documents:
-            context_document_texts.append(doc.text)
-        for doc in web_documents:
-            context_document_texts.append(doc.text)
-
-        if len(context_document_texts) > 0:
-            context_string = (
-                f"Use the following documents to answer the useer query: {'##'.join(context_document_texts)} "
-                f"### Use the provided documents only if the help you answer the user query."
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> Tuple[List[Dict[str, str]], List[VectorDocumentChunk | WebDocumentChunk]]:
+        return self.context_builder.build(
+            system_prompt=system_prompt,
+            chat_history=chat_history,
+            query=query,
+            documents=documents,
+        )
+
+    def _init_answer_cache(self) -> Optional[AnswerCache]:
+        cache_config = self.config.answer_cache_config
+        if not cache_config.enabled:
+            return None
+        return AnswerCache(
+            similarity_threshold=cache_config.similarity_threshold,
+            max_entries=cache_config.max_entries,
+            ttl_seconds=cache_config.ttl_seconds,
+        )
+
+    def _search_web(self, query_text: str) -> List[WebDocumentChunk]:
+        with tracer.span("chat.web_search") as span:
+            web_documents = self.web_retriever.search(query_text)
+            span.set(num_documents=len(web_documents))
+        return web_documents
+
+    # The search filter scopes the vector store search, the web search is not scoped.
+    def _retrieve_documents(
+        self, query_text: str, search_filter: Optional[SearchFilter] = None
+    ) -> Tuple[List[VectorDocumentChunk], List[WebDocumentChunk]]:
+        vector_documents = []
+        web_documents = []
+
+        web_search = None
+        if self.config.use_web_search and self.web_retriever is not None:
+            # the span of the web search is recorded in the trace of the turn
+            web_search = self.web_search_executor.submit(
+                copy_context().run, self._search_web, query_text
+            )
+        if self.config.use_rag:
+            # retrieve documents
+            with tracer.span("chat.retrieval") as span:
+                vector_documents = self.vector_store.search(
+                    query_text=query_text, search_filter=search_filter
+                )
+                span.set(num_documents=len(vector_documents))
+        if web_search is not None:
+            web_documents = web_search.result()
+
+        return vector_documents, web_documents
+
+    # Looks the answer up by the query embedding, in the context of the preceding history, the retrieved chunks
+    # and the generator settings. Also returns the key to store the generated answer with on a miss.
+    def _lookup_answer(
+        self,
+        chat_history: List[Dict[str, str]],
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> Tuple[
+        Optional[Tuple[str, List[VectorDocumentChunk | WebDocumentChunk]]],
+        Optional[Tuple[np.ndarray, Tuple]],
+    ]:
+        if self.answer_cache is None:
+            return None, None
+
+        with tracer.span("chat.answer_cache") as span:
+            with self.model_registry.use("embedder") as embedder:
+                query_embedding = embedder.encode(chat_history[-1]["content"])
+            document_ids = [
+                getattr(document, "id", None)
+                or hashlib.sha256(document.text.encode("utf-8")).hexdigest()
+                for document in documents
+            ]
+            generator_settings = {
+                "generator": self.config.generator_model_config.model_dump(),
+                "prompt": self.config.prompt_config.model_dump(),
+                "system_prompt": self.config.system_prompt,
+            }
+            context_key = self.answer_cache.make_context_key(
+                chat_history[:-1], document_ids, generator_settings
             )
-            model_input.append({"role": "system", "content": context_string})
+            cached_answer = self.answer_cache.get(query_embedding, context_key)
+            span.set(hit=int(cached_answer is not None))
 
-        model_input.append(query)
+        return cached_answer, (query_embedding, context_key)
 
-        return model_input
+    # The vector store and web documents are reranked together, so that the prompt holds the best of both.
+    def _rerank_documents(
+        self,
+        query_text: str,
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> List[VectorDocumentChunk | WebDocumentChunk]:
+        if len(documents) <= 1:
+            return documents
+        with tracer.span(
+            "chat.rerank", num_input_documents=len(documents)
+        ) as span, self.model_registry.use("reranker") as reranker:
+            documents = reranker.run_reranker(query=query_text, documents=documents)
+            span.set(num_documents=len(documents))
+        return documents
 
-    def run_completion_pipeline(
+    def _prepare_model_input(
         self,
         chat_history: List[Dict[str, str]],
-    ) -> Tuple[str, List[VectorDocumentChunk | WebDocumentChunk]]:
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> Tuple[List[Dict[str, str]], List[VectorDocumentChunk | WebDocumentChunk]]:
+        documents = self._rerank_documents(chat_history[-1]["content"], documents)
+        return self._build_prompt(chat_history, documents)
+
+    def _build_prompt(
+        self,
+        chat_history: List[Dict[str, str]],
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> Tuple[List[Dict[str, str]], List[VectorDocumentChunk | WebDocumentChunk]]:
 
         user_query = chat_history[-1]
         chat_history = chat_history[:-1]
 
-        vector_documents = []
-        web_documents = []
-
-        if st.session_state.config.use_rag:
-            # retrieve documents
-            vector_documents = self.vector_store.search(
-                query_text=user_query["content"]
+        with tracer.span("chat.prompt") as span:
+            model_input, documents = self.enrich_prompt(
+                system_prompt=self.config.system_prompt,
+                chat_history=chat_history,
+                query=user_query,
+                documents=documents,
             )
-            # rerank documents
-            if len(vector_documents) > 1:
-                vector_documents = self.reranker.run_reranker(
-                    query=user_query["content"], documents=vector_documents
+            if span.recording:
+                span.set(
+                    num_messages=len(model_input),
+                    # the system prompt, the query and the context are not part of the history
+                    num_dropped_messages=len(chat_history)
+                    - (len(model_input) - 2 - bool(documents)),
+                    num_context_documents=len(documents),
+                    prompt_tokens=sum(
+                        self.context_builder.token_counter.count_message(message)
+                        for message in model_input
+                    ),
                 )
-        if st.session_state.config.use_web_search:
-            pass
 
-        model_input = self.enrich_prompt(
-            system_prompt=st.session_state.config.system_prompt,
-            chat_history=chat_history,
-            query=user_query,
-            vector_documents=vector_documents,
-            web_documents=web_documents,
-        )
+        return model_input, documents
+
+    def run_completion_pipeline(
+        self,
+        chat_history: List[Dict[str, str]],
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[str, List[VectorDocumentChunk | WebDocumentChunk]]:
+
+        with tracer.trace("chat"):
+            vector_documents, web_documents = self._retrieve_documents(
+                chat_history[-1]["content"], search_filter
+            )
+            documents = vector_documents + web_documents
+            cached_answer, answer_cache_key = self._lookup_answer(
+                chat_history, documents
+            )
+            if cached_answer is not None:
+                return cached_answer
+
+            model_input, documents = self._prepare_model_input(chat_history, documents)
 
-        model_response = self.generator.generate_response(model_input)
+            with tracer.span("chat.generate") as span, self.model_registry.use(
+                "generator"
+            ) as generator:
+                model_response = generator.generate_response(model_input)
+                span.set(response_chars=len(model_response))
 
-        documents = vector_documents + web_documents
+        if answer_cache_key is not None:
+            self.answer_cache.put(*answer_cache_key, model_response, documents)
 
         return model_response, documents
+
+    def stream_completion_pipeline(
+        self,
+        chat_history: List[Dict[str, str]],
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[ResponseStream, List[VectorDocumentChunk | WebDocumentChunk]]:
+
+        with tracer.trace("chat") as trace:
+            vector_documents, web_documents = self._retrieve_documents(
+                chat_history[-1]["content"], search_filter
+            )
+            documents = vector_documents + web_documents
+            cached_answer, answer_cache_key = self._lookup_answer(
+                chat_history, documents
+            )
+            if cached_answer is not None:
+                answer, documents = cached_answer
+                response_stream = ResponseStream(iter([answer]))
+                response_stream.stats.from_cache = True
+                return response_stream, documents
+
+            model_input, documents = self._prepare_model_input(chat_history, documents)
+
+        response_stream = ResponseStream(
+            self._generate_deltas(
+                model_input,
+                trace,
+                answer_cache_key=answer_cache_key,
+                documents=documents,
+            ),
+            count_tokens=self.context_builder.token_counter.count,
+        )
+
+        return response_stream, documents
+
+    # The generator is held for as long as the response is being streamed. The stream is consumed after the
+    # trace of the turn was left, so the generation span is attached to it explicitly.
+    # The answer is cached once it was streamed completely.
+    def _generate_deltas(
+        self,
+        model_input: List[Dict[str, str]],
+        trace: Optional[Trace] = None,
+        answer_cache_key: Optional[Tuple[np.ndarray, Tuple]] = None,
+        documents: List[VectorDocumentChunk | WebDocumentChunk] = None,
+    ) -> Iterator[str]:
+        deltas = []
+        with tracer.span("chat.generate", trace=trace) as span, self.model_registry.use(
+            "generator"
+        ) as generator:
+            for delta in generator.generate_deltas(model_input):
+                if not deltas and span.recording:
+                    span.set(time_to_first_token=time.perf_counter() - span.start_time)
+                deltas.append(delta)
+                yield delta
+            span.set(num_deltas=len(deltas))
+
+        if answer_cache_key is not None:
+            self.answer_cache.put(*answer_cache_key, "".join(deltas), documents or [])
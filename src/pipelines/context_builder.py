@@ -0,0 +1,204 @@
+from itertools import groupby
+from typing import Dict, List, Optional, Tuple
+
+from common.config import PromptConfig
+from data.data_classes import ContextPassage, VectorDocumentChunk, WebDocumentChunk
+
+# formatting tokens the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+CONTEXT_PREFIX = "Use the following documents to answer the useer query: "
+CONTEXT_SUFFIX = (
+    " ### Use the provided documents only if the help you answer the user query."
+)
+PASSAGE_SEPARATOR = "##"
+
+
+class TokenCounter:
+    def __init__(self, tokenizer_name: Optional[str] = None, chars_per_token=4.0):
+        self.chars_per_token = chars_per_token
+        self.tokenizer = None
+        if tokenizer_name is not None:
+            from transformers import AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    def count(self, text: str) -> int:
+        if self.tokenizer is None:
+            return int(len(text) / self.chars_per_token) + 1
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        return self.count(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+# Returns the part of `chunk` that follows the text of `previous`, or None if the two chunks neither overlap nor
+# touch. Offsets are only comparable within a page, so a chunk that starts on a later page than a chunk spanning
+# pages is matched by the overlapping text instead.
+def _continuation(
+    previous: VectorDocumentChunk, chunk: VectorDocumentChunk
+) -> Optional[str]:
+    if chunk.page_num == previous.page_num:
+        offset = chunk.start_idx - previous.start_idx
+        if 0 <= offset <= len(previous.text):
+            return chunk.text[len(previous.text) - offset :]
+    elif previous.paginated_text and chunk.page_num > previous.page_num:
+        overlap_start = previous.text.find(chunk.text[:32])
+        while chunk.text and overlap_start >= 0:
+            overlap = previous.text[overlap_start:]
+            if chunk.text.startswith(overlap):
+                return chunk.text[len(overlap) :]
+            overlap_start = previous.text.find(chunk.text[:32], overlap_start + 1)
+    return None
+
+
+# Merges the chunks of the same file that overlap or touch into a single passage, so that the overlap between
+# consecutive chunks is sent to the model once. The passages keep the order of their best ranked chunk and the
+# chunks within a passage are ordered by their position in the file.
+def merge_overlapping_chunks(
+    documents: List[VectorDocumentChunk | WebDocumentChunk],
+) -> List[ContextPassage]:
+    ranked_passages: List[Tuple[int, ContextPassage]] = []
+    vector_documents = []
+    for rank, document in enumerate(documents):
+        if isinstance(document, VectorDocumentChunk):
+            vector_documents.append((rank, document))
+        else:
+            ranked_passages.append(
+                (rank, ContextPassage(text=document.text, documents=[document]))
+            )
+
+    vector_documents.sort(
+        key=lambda item: (item[1].file_name, item[1].page_num, item[1].start_idx)
+    )
+    for _, file_documents in groupby(
+        vector_documents, key=lambda item: item[1].file_name
+    ):
+        passage_rank, passage_parts, passage_documents, last_chunk = None, [], [], None
+        for rank, chunk in file_documents:
+            continuation = (
+                _continuation(last_chunk, chunk) if last_chunk is not None else None
+            )
+            if continuation is None:
+                if passage_documents:
+                    ranked_passages.append(
+                        (
+                            passage_rank,
+                            ContextPassage(
+                                text="".join(passage_parts),
+                                documents=passage_documents,
+                            ),
+                        )
+                    )
+                passage_rank, passage_parts, passage_documents = rank, [], []
+                continuation = chunk.text
+            passage_rank = min(passage_rank, rank)
+            passage_documents.append(chunk)
+            # a chunk contained in the previous one does not extend the passage
+            if continuation:
+                passage_parts.append(continuation)
+                last_chunk = chunk
+        if passage_documents:
+            ranked_passages.append(
+                (
+                    passage_rank,
+                    ContextPassage(
+                        text="".join(passage_parts), documents=passage_documents
+                    ),
+                )
+            )
+
+    ranked_passages.sort(key=lambda item: item[0])
+    return [passage for _, passage in ranked_passages]
+
+
+# Assembles the model input within the token budget of the generator, which is its context window minus the
+# tokens reserved for the output. The system prompt and the user query are always sent. The rest of the budget
+# is filled by priority:
+#   1. the most recent chat history, up to history_reserve_tokens
+#   2. the retrieved passages, from the best ranked one
+#   3. older chat history, as long as it fits
+# The chat history is cut from its oldest message, so that the kept history stays contiguous.
+class ContextBuilder:
+    def __init__(
+        self,
+        prompt_config: PromptConfig,
+        context_window_tokens: int,
+        max_output_tokens: int,
+    ):
+        self.prompt_config = prompt_config
+        self.max_prompt_tokens = context_window_tokens - max_output_tokens
+        self.token_counter = TokenCounter(
+            tokenizer_name=prompt_config.tokenizer_name,
+            chars_per_token=prompt_config.chars_per_token,
+        )
+
+    def _fit_history(
+        self, chat_history: List[Dict[str, str]], num_kept: int, budget: int
+    ) -> Tuple[int, int]:
+        used_tokens = 0
+        for message in reversed(chat_history[: len(chat_history) - num_kept]):
+            message_tokens = self.token_counter.count_message(message)
+            if used_tokens + message_tokens > budget:
+                break
+            used_tokens += message_tokens
+            num_kept += 1
+        return num_kept, used_tokens
+
+    def build(
+        self,
+        system_prompt: str,
+        chat_history: List[Dict[str, str]],
+        query: Dict[str, str],
+        documents: List[VectorDocumentChunk | WebDocumentChunk],
+    ) -> Tuple[List[Dict[str, str]], List[VectorDocumentChunk | WebDocumentChunk]]:
+        count = self.token_counter.count
+        budget = (
+            self.max_prompt_tokens
+            - self.token_counter.count_message({"content": system_prompt})
+            - self.token_counter.count_message(query)
+        )
+
+        num_history_kept, history_tokens = self._fit_history(
+            chat_history, 0, min(self.prompt_config.history_reserve_tokens, budget)
+        )
+        budget -= history_tokens
+
+        if self.prompt_config.merge_overlapping_chunks:
+            passages = merge_overlapping_chunks(documents)
+        else:
+            passages = [
+                ContextPassage(text=document.text, documents=[document])
+                for document in documents
+            ]
+        context_passages = []
+        if passages:
+            context_tokens = (
+                count(CONTEXT_PREFIX + CONTEXT_SUFFIX) + MESSAGE_OVERHEAD_TOKENS
+            )
+            for passage in passages:
+                passage_tokens = count(PASSAGE_SEPARATOR + passage.text)
+                # a passage that does not fit is skipped, a shorter one further down may still fit
+                if context_tokens + passage_tokens <= budget:
+                    context_passages.append(passage)
+                    context_tokens += passage_tokens
+            if context_passages:
+                budget -= context_tokens
+
+        num_history_kept, _ = self._fit_history(chat_history, num_history_kept, budget)
+
+        model_input = [{"role": "system", "content": system_prompt}]
+        model_input.extend(chat_history[len(chat_history) - num_history_kept :])
+        if context_passages:
+            context_string = (
+                CONTEXT_PREFIX
+                + PASSAGE_SEPARATOR.join(passage.text for passage in context_passages)
+                + CONTEXT_SUFFIX
+            )
+            model_input.append({"role": "system", "content": context_string})
+        model_input.append(query)
+
+        context_documents = [
+            document for passage in context_passages for document in passage.documents
+        ]
+        return model_input, context_documents
@@ -1,60 +1,59 @@
-from typing import Dict
+from pathlib import Path
+from typing import Dict, List
 
 import streamlit as st
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
-from data.data_classes import UploadedFileMetadata
+from common.config import LLMChatConfig
+from common.tracing import tracer
+from data.data_classes import IngestionStageStats
 from data.utils import save_file
 from data_store.uploaded_files import UploadedFilesDB
-from vector_store.document_vector_store import VectorDB
-from vector_store.utils import extract_text_pages_from_pdf, extract_document_chunks
+from pipelines.ingestion import IngestionEngine, describe_job
+from vector_store.base_vector_store import VectorStore
 
 
-def pdf_upload_pipeline(
-    uploaded_file: UploadedFile,
-    meta_data: Dict,
-    vector_db: VectorDB,
+def ingestion_pipeline(
+    config: LLMChatConfig,
+    file_paths: List[Path],
+    vector_db: VectorStore,
     db: UploadedFilesDB,
-):
-    if db.file_exists(uploaded_file.name):
-        st.warning(f"{uploaded_file.name=} already exists.")
-    else:
-        file_path = save_file(uploaded_file, meta_data)
-        st.write(f"File saved to {file_path=}")
-        pages = extract_text_pages_from_pdf(file_path)
-        st.write("Chunking document..")
-        documents = extract_document_chunks(
-            pages,
-            meta_data["file_name"],
-            chunk_size=st.session_state.config.opensearch_config.chunk_size,
-            overlap_ratio=st.session_state.config.opensearch_config.overlap_ratio,
-        )
-        st.write("Adding embeddings to vector database..")
-        error = vector_db.add_documents(documents)
-
-        uploaded_file_meta_data = UploadedFileMetadata(
-            file_name=meta_data["file_name"],
-            file_type=meta_data["file_type"],
-            size_on_disk=meta_data["file_size"],
-            num_pages=len(pages),
-            num_chunks=len(documents),
-            num_chunks_error_upload=error,
-        )
-
-        st.write("Writing metadata to database..")
-        db.insert_file(uploaded_file_meta_data)
+) -> List[IngestionStageStats]:
+    engine = IngestionEngine(config, vector_db=vector_db, db=db)
+    engine.run(file_paths, on_file_done=lambda job: st.write(describe_job(job)))
+    return engine.stage_stats()
+
 
+# Files are saved even if they were uploaded before. The ingestion skips them if their content is unchanged,
+# and re-indexes only the changed chunks otherwise.
+def pdf_upload_pipeline(
+    config: LLMChatConfig, uploaded_file: UploadedFile, meta_data: Dict
+) -> List[Path]:
+    with tracer.span("upload.save_file", size_bytes=uploaded_file.size):
+        file_path = save_file(uploaded_file.getbuffer(), meta_data, config)
+    st.write(f"File saved to {file_path=}")
+    return [file_path]
 
+
+# The uploaded files are saved first and then ingested together, so that their stages overlap.
 def run_document_upload_pipeline(
-    uploaded_file: UploadedFile, vector_db: VectorDB, db: UploadedFilesDB
-):
-    meta_data = {
-        "file_name": uploaded_file.name,
-        "file_type": uploaded_file.type.split("/")[-1],
-        "file_size": uploaded_file.size,
-    }
-
-    if uploaded_file.type == "application/pdf":
-        pdf_upload_pipeline(uploaded_file, meta_data, vector_db, db)
-    else:
-        st.warning(f"{uploaded_file.type=} is not supported.")
+    config: LLMChatConfig,
+    uploaded_files: List[UploadedFile],
+    vector_db: VectorStore,
+    db: UploadedFilesDB,
+) -> List[IngestionStageStats]:
+    with tracer.trace("upload"):
+        file_paths = []
+        for uploaded_file in uploaded_files:
+            meta_data = {
+                "file_name": uploaded_file.name,
+                "file_type": uploaded_file.type.split("/")[-1],
+                "file_size": uploaded_file.size,
+            }
+
+            if uploaded_file.type == "application/pdf":
+                file_paths.extend(pdf_upload_pipeline(config, uploaded_file, meta_data))
+            else:
+                st.warning(f"{uploaded_file.type=} is not supported.")
+
+        return ingestion_pipeline(config, file_paths, vector_db, db)
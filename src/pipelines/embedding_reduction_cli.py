@@ -0,0 +1,346 @@
+import argparse
+import json
+import random
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from common.config import LLMChatConfig
+from common.model_registry import ModelRegistry
+from common.utils import load_config
+from pipelines.ingestion import find_supported_files
+from vector_store.chunker import iter_document_chunks
+from vector_store.embedding_reduction import (
+    PCA_PROJECTION_FILE_NAME,
+    EmbeddingReducer,
+    MatryoshkaReducer,
+    PCAReducer,
+    embedding_reduction_dir,
+    normalize_vectors,
+)
+from vector_store.utils import iter_text_pages_from_pdf
+
+_BYTES_PER_COMPONENT = {"float": 4, "float32": 4, "fp16": 2, "float16": 2, "byte": 1}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fit the pca projection of the embeddings on a corpus sample, or report the recall "
+        "of reduced embeddings against the index size they save"
+    )
+    parser.add_argument(
+        "command",
+        choices=["fit", "report"],
+        help="fit saves the projection configured in embedding_reduction_config next to the index, "
+        "report compares reductions to several dimensions without changing the index",
+    )
+    parser.add_argument(
+        "paths", type=Path, nargs="+", help="files or directories of the corpus"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="001_base_config.yml",
+        help="provide the name of the config yaml file (to be placed on the path 'src/common/configs')",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default=None,
+        help="vector store backend the projection is saved for, defaults to the one of the config",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="replace a fitted projection, the documents indexed with it have to be indexed again",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=None,
+        help="number of chunks to sample, defaults to pca_sample_size",
+    )
+    parser.add_argument(
+        "--methods", nargs="+", choices=["matryoshka", "pca"], default=["pca"]
+    )
+    parser.add_argument(
+        "--dimensions",
+        type=int,
+        nargs="+",
+        default=None,
+        help="reduced dimensions to report, defaults to halving the embedding dimension three times",
+    )
+    parser.add_argument(
+        "--queries-file",
+        type=Path,
+        default=None,
+        help="text file with one query per line, by default sampled chunks are held out as queries",
+    )
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument(
+        "--num-vectors",
+        type=int,
+        default=None,
+        help="number of indexed vectors the index size is projected for, defaults to the sample size",
+    )
+    parser.add_argument("--output", type=Path, default=None, help="write a json report")
+    return parser.parse_args()
+
+
+# Reservoir sample of the chunk texts of the corpus, chunked like the ingestion does.
+def sample_chunk_texts(
+    config: LLMChatConfig, file_paths: List[Path], sample_size: int, seed: int = 0
+) -> List[str]:
+    rng = random.Random(seed)
+    extraction_config = config.pdf_extraction_config
+    sample = []
+    num_chunks = 0
+    for file_path in file_paths:
+        pages = iter_text_pages_from_pdf(
+            file_path,
+            parallel_min_pages=extraction_config.parallel_min_pages,
+            num_workers=extraction_config.num_workers,
+            pages_per_task=extraction_config.pages_per_task,
+            max_pending_tasks=extraction_config.max_pending_tasks,
+        )
+        for chunk in iter_document_chunks(
+            pages,
+            file_name=file_path.name,
+            chunk_size=config.opensearch_config.chunk_size,
+            overlap_ratio=config.opensearch_config.overlap_ratio,
+        ):
+            num_chunks += 1
+            if len(sample) < sample_size:
+                sample.append(chunk.text)
+            elif (idx := rng.randrange(num_chunks)) < sample_size:
+                sample[idx] = chunk.text
+    print(f"Sampled {len(sample)} of {num_chunks} chunks from {len(file_paths)} files")
+    return sample
+
+
+def embed_texts(
+    config: LLMChatConfig, model_registry: ModelRegistry, texts: List[str]
+) -> np.ndarray:
+    batch_size = config.opensearch_config.embedding_batch_size
+    embeddings = []
+    with model_registry.use("embedder") as embedder:
+        for i in range(0, len(texts), batch_size):
+            embeddings.append(
+                np.asarray(embedder.encode(texts[i : i + batch_size]), np.float32)
+            )
+    return np.concatenate(embeddings)
+
+
+def fit(
+    config: LLMChatConfig,
+    model_registry: ModelRegistry,
+    file_paths: List[Path],
+    backend: str,
+    sample_size: int,
+    overwrite: bool = False,
+):
+    reduction_config = config.opensearch_config.embedding_reduction_config
+    if reduction_config.method != "pca":
+        print(f"Nothing to fit for {reduction_config.method=}")
+        return
+    projection_path = (
+        embedding_reduction_dir(config, backend) / PCA_PROJECTION_FILE_NAME
+    )
+    if projection_path.exists() and not overwrite:
+        print(
+            f"{projection_path} exists, the documents indexed with it would no longer match the queries. "
+            f"Pass --overwrite and index them again to replace it."
+        )
+        return
+
+    embeddings = embed_texts(
+        config, model_registry, sample_chunk_texts(config, file_paths, sample_size)
+    )
+    reducer = PCAReducer.fit(embeddings, reduction_config.reduced_dimension)
+    reducer.save(projection_path)
+    print(
+        f"Saved the projection to {reduction_config.reduced_dimension} dimensions to {projection_path}, "
+        f"it explains {reducer.explained_variance_ratio:.1%} of the variance of the sample"
+    )
+
+
+# Approximate size of one indexed vector: its components and, for the OpenSearch hnsw graph, the neighbour
+# ids of the bottom layer. The upper layers hold a small fraction of the vectors and are left out.
+def index_bytes_per_vector(config: LLMChatConfig, backend: str, dimension: int) -> int:
+    if backend == "local":
+        vector_dtype = config.local_vector_store_config.vector_dtype
+        # the squared norm and the ivf list of every vector are kept in memory
+        return dimension * _BYTES_PER_COMPONENT[vector_dtype] + 8
+    index_profile = config.opensearch_config.knn_index_profile
+    return (
+        dimension * _BYTES_PER_COMPONENT[index_profile.vector_encoding]
+        + 2 * index_profile.m * 4
+    )
+
+
+def exact_top_k(
+    vectors: np.ndarray, queries: np.ndarray, top_k: int, space_type: str
+) -> np.ndarray:
+    if space_type == "innerproduct":
+        distances = -(queries @ vectors.T)
+    else:
+        distances = np.sum(vectors**2, axis=1)[None, :] - 2 * queries @ vectors.T
+    return np.argpartition(distances, top_k - 1, axis=1)[:, :top_k]
+
+
+def recall_at_k(true_top_k: np.ndarray, top_k: np.ndarray) -> float:
+    return float(
+        np.mean(
+            [
+                len(set(true_rows) & set(rows)) / len(true_rows)
+                for true_rows, rows in zip(true_top_k, top_k)
+            ]
+        )
+    )
+
+
+# The nearest neighbours of the reduced vectors are compared with those of the full embeddings, both searched
+# exactly in the configured space, so the recall loss is the one of the reduction alone. The pca projection is
+# fitted on the corpus vectors the queries are searched in.
+def report(
+    config: LLMChatConfig,
+    model_registry: ModelRegistry,
+    file_paths: List[Path],
+    backend: str,
+    sample_size: int,
+    methods: List[str],
+    dimensions: List[int],
+    queries_file: Optional[Path],
+    num_queries: int,
+    top_k: int,
+    num_vectors: Optional[int],
+) -> List[Dict]:
+    opensearch_config = config.opensearch_config
+    texts = sample_chunk_texts(config, file_paths, sample_size)
+    if queries_file is not None:
+        query_texts = [
+            line.strip()
+            for line in queries_file.read_text(encoding="utf-8").splitlines()
+            if line.strip()
+        ]
+    else:
+        num_queries = min(num_queries, len(texts) // 2)
+        query_texts, texts = texts[:num_queries], texts[num_queries:]
+    top_k = min(top_k, len(texts))
+    embeddings = embed_texts(config, model_registry, texts)
+    query_embeddings = embed_texts(config, model_registry, query_texts)
+    if num_vectors is None:
+        num_vectors = len(embeddings)
+
+    def prepare(vectors: np.ndarray) -> np.ndarray:
+        if opensearch_config.normalize_embeddings:
+            return normalize_vectors(vectors)
+        return vectors
+
+    space_type = opensearch_config.space_type
+    true_top_k = exact_top_k(
+        prepare(embeddings), prepare(query_embeddings), top_k, space_type
+    )
+    full_bytes = index_bytes_per_vector(
+        config, backend, opensearch_config.embedding_dimension
+    )
+    rows = [
+        {
+            "method": "none",
+            "dimension": opensearch_config.embedding_dimension,
+            "recall": 1.0,
+            "bytes_per_vector": full_bytes,
+            "index_size_mb": full_bytes * num_vectors / 1024**2,
+            "size_saved": 0.0,
+        }
+    ]
+    for method in methods:
+        for dimension in dimensions:
+            if dimension >= opensearch_config.embedding_dimension:
+                continue
+            reducer: EmbeddingReducer
+            if method == "pca":
+                if len(embeddings) < dimension:
+                    print(f"Skipping pca to {dimension=}, the sample is too small")
+                    continue
+                reducer = PCAReducer.fit(embeddings, dimension)
+            else:
+                reducer = MatryoshkaReducer(dimension)
+            reduced_top_k = exact_top_k(
+                prepare(reducer.reduce(embeddings)),
+                prepare(reducer.reduce(query_embeddings)),
+                top_k,
+                space_type,
+            )
+            reduced_bytes = index_bytes_per_vector(config, backend, dimension)
+            rows.append(
+                {
+                    "method": method,
+                    "dimension": dimension,
+                    "recall": recall_at_k(true_top_k, reduced_top_k),
+                    "bytes_per_vector": reduced_bytes,
+                    "index_size_mb": reduced_bytes * num_vectors / 1024**2,
+                    "size_saved": 1 - reduced_bytes / full_bytes,
+                }
+            )
+
+    print(
+        f"recall@{top_k} of {len(query_embeddings)} queries in {len(embeddings)} chunks, {space_type=}, "
+        f"normalized={opensearch_config.normalize_embeddings}, index size for {num_vectors} vectors ({backend})"
+    )
+    for row in rows:
+        print(
+            f"{row['method']:>10} {row['dimension']:5d}: recall {row['recall']:6.1%}, "
+            f"{row['bytes_per_vector']:6d} bytes/vector, {row['index_size_mb']:10.1f} MB, "
+            f"{row['size_saved']:6.1%} saved"
+        )
+    if "matryoshka" in methods:
+        print("matryoshka truncation only keeps the recall of models trained for it")
+    return rows
+
+
+def main():
+    args = parse_args()
+    config = load_config(config_name=args.config)
+    backend = args.backend or config.vector_store_backend
+    reduction_config = config.opensearch_config.embedding_reduction_config
+    sample_size = args.sample_size or reduction_config.pca_sample_size
+
+    file_paths = find_supported_files(args.paths, config.supported_file_formats)
+    model_registry = ModelRegistry(config)
+    if args.command == "fit":
+        fit(
+            config,
+            model_registry,
+            file_paths,
+            backend,
+            sample_size,
+            overwrite=args.overwrite,
+        )
+        return
+
+    dimensions = args.dimensions
+    if dimensions is None:
+        embedding_dimension = config.opensearch_config.embedding_dimension
+        dimensions = [embedding_dimension // 2**i for i in range(1, 4)]
+    rows = report(
+        config,
+        model_registry,
+        file_paths,
+        backend,
+        sample_size,
+        methods=args.methods,
+        dimensions=dimensions,
+        queries_file=args.queries_file,
+        num_queries=args.num_queries,
+        top_k=args.top_k or config.opensearch_config.use_top_k_embeddings,
+        num_vectors=args.num_vectors,
+    )
+    if args.output is not None:
+        args.output.write_text(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
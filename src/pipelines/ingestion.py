@@ -0,0 +1,391 @@
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+from pydantic import BaseModel
+
+from common.config import LLMChatConfig
+from common.tracing import tracer
+from data.data_classes import IngestionStageStats, UploadedFileMetadata
+from data.utils import compute_file_hash
+from data_store.uploaded_files import UploadedFilesDB
+from vector_store.base_vector_store import VectorStore
+from vector_store.chunker import iter_document_chunks
+from vector_store.utils import iter_text_pages_from_pdf
+
+
+STAGES = ["extract", "chunk", "embed", "index", "metadata"]
+
+# Marks the end of a file in the queues. Items are (job, payload) tuples, the payload is
+# a page, a chunk or an embedded batch depending on the queue.
+_END_OF_FILE = object()
+# Marks the end of all files.
+_END_OF_INPUT = object()
+
+
+class IngestionCancelled(Exception):
+    pass
+
+
+# State of one file while it passes through the stages. When a file with the same name was ingested before,
+# only its chunks whose ids are not in existing_chunk_ids are embedded, and the ids that no longer occur are deleted.
+class IngestionJob(BaseModel):
+    file_path: Path
+    metadata: UploadedFileMetadata
+    is_update: bool = False
+    existing_chunk_ids: Set[str] = set()
+    chunk_ids: Set[str] = set()
+    num_chunks_unchanged: int = 0
+    num_chunks_deleted: int = 0
+
+
+# Summary of an ingested file, as shown by the upload page and the cli.
+def describe_job(job: IngestionJob) -> str:
+    metadata = job.metadata
+    description = (
+        f"{'Updated' if job.is_update else 'Ingested'} {metadata.file_name=}: {metadata.num_pages} pages, "
+        f"{metadata.num_chunks} chunks, {metadata.num_chunks_error_upload} upload errors"
+    )
+    if job.is_update:
+        description += f", {job.num_chunks_unchanged} chunks unchanged, {job.num_chunks_deleted} stale chunks deleted"
+    return description
+
+
+# Expands directories into the files with a supported format they contain, recursively.
+def find_supported_files(
+    paths: Iterable[Path], supported_file_formats: List[str]
+) -> List[Path]:
+    file_paths = []
+    for path in paths:
+        candidates = sorted(path.rglob("*")) if path.is_dir() else [path]
+        for candidate in candidates:
+            if (
+                candidate.is_file()
+                and candidate.suffix.lstrip(".").lower() in supported_file_formats
+            ):
+                file_paths.append(candidate)
+            elif not path.is_dir():
+                print(f"{candidate=} is not a supported file.")
+    return file_paths
+
+
+# Ingests many files through the stages extract -> chunk -> embed -> index -> metadata. Every stage runs in
+# its own thread and is connected to the next one by a bounded queue, so that pdf extraction, embedding
+# and the bulk requests overlap, while a slow stage applies back-pressure to the stages before it.
+# All settings are read when the engine is created. An engine runs one ingestion at a time.
+class IngestionEngine:
+    def __init__(
+        self, config: LLMChatConfig, vector_db: VectorStore, db: UploadedFilesDB
+    ):
+        self.vector_db = vector_db
+        self.db = db
+        self.chunk_size = config.opensearch_config.chunk_size
+        self.overlap_ratio = config.opensearch_config.overlap_ratio
+        self.embedding_batch_size = config.opensearch_config.embedding_batch_size
+        self.upload_batch_size = config.opensearch_config.upload_batch_size
+        self.extraction_config = config.pdf_extraction_config
+        self.ingestion_config = config.ingestion_config
+
+        self.stats: Dict[str, IngestionStageStats] = {}
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self._page_wait_time = 0.0
+
+    def _put(self, target: queue.Queue, item: Any):
+        while True:
+            if self._stop.is_set():
+                raise IngestionCancelled()
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, source: queue.Queue) -> Any:
+        while True:
+            if self._stop.is_set():
+                raise IngestionCancelled()
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _timed(
+        self, stage: str, num_items: int, start_time: float, waited: float = 0.0
+    ):
+        stats = self.stats[stage]
+        stats.num_items += num_items
+        stats.busy_time += time.perf_counter() - start_time - waited
+
+    def _run_stage(self, target: Callable, *args):
+        try:
+            target(*args)
+        except IngestionCancelled:
+            pass
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _extract(self, jobs: List[IngestionJob], pages_queue: queue.Queue):
+        for job in jobs:
+            pages = iter_text_pages_from_pdf(
+                job.file_path,
+                parallel_min_pages=self.extraction_config.parallel_min_pages,
+                num_workers=self.extraction_config.num_workers,
+                pages_per_task=self.extraction_config.pages_per_task,
+                max_pending_tasks=self.extraction_config.max_pending_tasks,
+            )
+            while True:
+                start_time = time.perf_counter()
+                page = next(pages, None)
+                if page is None:
+                    break
+                job.metadata.num_pages += 1
+                self._timed("extract", 1, start_time)
+                self._put(pages_queue, (job, page))
+            self._put(pages_queue, (job, _END_OF_FILE))
+        self._put(pages_queue, (None, _END_OF_INPUT))
+
+    # Consumes the pages of one file from the queue, until its end marker. The time spent waiting for pages
+    # is tracked, as it is not part of the time spent chunking.
+    def _iter_file_pages(self, pages_queue: queue.Queue) -> Iterator[str]:
+        while True:
+            start_time = time.perf_counter()
+            _, page = self._get(pages_queue)
+            self._page_wait_time += time.perf_counter() - start_time
+            if page is _END_OF_FILE:
+                return
+            yield page
+
+    def _chunk(self, pages_queue: queue.Queue, chunks_queue: queue.Queue):
+        while True:
+            job, page = self._get(pages_queue)
+            if page is _END_OF_INPUT:
+                break
+            if page is _END_OF_FILE:
+                self._put(chunks_queue, (job, _END_OF_FILE))
+                continue
+
+            def file_pages() -> Iterator[str]:
+                yield page
+                yield from self._iter_file_pages(pages_queue)
+
+            chunks = iter_document_chunks(
+                file_pages(),
+                job.metadata.file_name,
+                chunk_size=self.chunk_size,
+                overlap_ratio=self.overlap_ratio,
+            )
+            while True:
+                start_time = time.perf_counter()
+                page_wait_time = self._page_wait_time
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                job.metadata.num_chunks += 1
+                self._timed(
+                    "chunk", 1, start_time, self._page_wait_time - page_wait_time
+                )
+                self._put(chunks_queue, (job, chunk))
+            self._put(chunks_queue, (job, _END_OF_FILE))
+        self._put(chunks_queue, (None, _END_OF_INPUT))
+
+    # Chunks are embedded in upload sized batches, which never span two files.
+    # Chunks that are already indexed with the same content and position are skipped.
+    def _embed(self, chunks_queue: queue.Queue, batches_queue: queue.Queue):
+        batch = []
+
+        def flush(job: IngestionJob):
+            start_time = time.perf_counter()
+            embeddings = self.vector_db.encode_documents(
+                batch, self.embedding_batch_size
+            )
+            self._timed("embed", len(batch), start_time)
+            self._put(batches_queue, (job, (list(batch), embeddings)))
+            batch.clear()
+
+        while True:
+            job, chunk = self._get(chunks_queue)
+            if chunk is _END_OF_INPUT:
+                break
+            if chunk is _END_OF_FILE:
+                if batch:
+                    flush(job)
+                self._put(batches_queue, (job, _END_OF_FILE))
+                continue
+            job.chunk_ids.add(chunk.id)
+            if chunk.id in job.existing_chunk_ids:
+                job.num_chunks_unchanged += 1
+                continue
+            batch.append(chunk)
+            if len(batch) >= self.upload_batch_size:
+                flush(job)
+        self._put(batches_queue, (None, _END_OF_INPUT))
+
+    def _index(self, batches_queue: queue.Queue, metadata_queue: queue.Queue):
+        while True:
+            job, batch = self._get(batches_queue)
+            if batch is _END_OF_INPUT:
+                break
+            if batch is _END_OF_FILE:
+                # chunks of the previous version of the file that no longer occur
+                stale_chunk_ids = list(job.existing_chunk_ids - job.chunk_ids)
+                if stale_chunk_ids:
+                    job.num_chunks_deleted = self.vector_db.delete_documents(
+                        stale_chunk_ids
+                    )
+                self._put(metadata_queue, job)
+                continue
+            documents, embeddings = batch
+            start_time = time.perf_counter()
+            job.metadata.num_chunks_error_upload += self.vector_db.index_documents(
+                documents, embeddings
+            )
+            self._timed("index", len(documents), start_time)
+        self._put(metadata_queue, _END_OF_INPUT)
+
+    def _record_metadata(
+        self,
+        metadata_queue: queue.Queue,
+        ingested_files: List[IngestionJob],
+        on_file_done: Optional[Callable[[IngestionJob], None]],
+    ):
+        done = False
+        while not done:
+            # all files finished since the last write are recorded in one transaction
+            jobs = [self._get(metadata_queue)]
+            while True:
+                try:
+                    jobs.append(metadata_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if jobs[-1] is _END_OF_INPUT:
+                jobs.pop()
+                done = True
+            if not jobs:
+                continue
+
+            start_time = time.perf_counter()
+            self.db.insert_files([job.metadata for job in jobs if not job.is_update])
+            for job in jobs:
+                if job.is_update:
+                    self.db.update_file(job.metadata)
+            self.vector_db.invalidate_retrieval_caches()
+            self._timed("metadata", len(jobs), start_time)
+            ingested_files.extend(jobs)
+            if on_file_done is not None:
+                for job in jobs:
+                    on_file_done(job)
+
+    # Files are identified by the hash of their content. A file whose content was ingested before, under any name,
+    # is skipped. A changed file with the name of an ingested one replaces it incrementally.
+    def _create_job(self, file_path: Path) -> Optional[IngestionJob]:
+        content_hash = compute_file_hash(file_path)
+        ingested_file_name = self.db.find_file_name_by_hash(content_hash)
+        if ingested_file_name is not None:
+            print(
+                f"Skipping {file_path.name=}, its content was already ingested as {ingested_file_name=}."
+            )
+            return None
+        job = IngestionJob(
+            file_path=file_path,
+            metadata=UploadedFileMetadata(
+                file_name=file_path.name,
+                file_type=file_path.suffix.lstrip(".").lower(),
+                size_on_disk=file_path.stat().st_size,
+                num_pages=0,
+                # in the precision of the database, a file is searched by its upload time, see `SearchFilter`
+                upload_time=datetime.now(timezone.utc).replace(
+                    tzinfo=None, microsecond=0
+                ),
+                content_hash=content_hash,
+            ),
+        )
+        if self.db.file_exists(file_path.name):
+            job.is_update = True
+            job.existing_chunk_ids = self.vector_db.get_document_ids(file_path.name)
+        return job
+
+    # on_file_done is called from the calling thread, so it is safe to update the streamlit page from it.
+    def run(
+        self,
+        file_paths: Iterable[Path],
+        on_file_done: Optional[Callable[[IngestionJob], None]] = None,
+    ) -> List[IngestionJob]:
+        file_paths = list(file_paths)
+        with tracer.span("upload.ingestion", num_files=len(file_paths)) as span:
+            ingested_files = self._run(file_paths, on_file_done)
+            span.set(num_ingested_files=len(ingested_files))
+            # the stages run concurrently, each one is recorded with the time it was busy
+            for stats in self.stats.values():
+                tracer.record(
+                    f"upload.{stats.stage}", stats.busy_time, num_items=stats.num_items
+                )
+        return ingested_files
+
+    def _run(
+        self,
+        file_paths: List[Path],
+        on_file_done: Optional[Callable[[IngestionJob], None]],
+    ) -> List[IngestionJob]:
+        jobs = []
+        file_names = set()
+        content_hashes = set()
+        for file_path in file_paths:
+            if file_path.name in file_names:
+                print(f"Skipping {file_path=}, a file with the same name is ingested.")
+                continue
+            job = self._create_job(file_path)
+            if job is None:
+                continue
+            if job.metadata.content_hash in content_hashes:
+                print(
+                    f"Skipping {file_path=}, a file with the same content is ingested."
+                )
+                continue
+            file_names.add(file_path.name)
+            content_hashes.add(job.metadata.content_hash)
+            jobs.append(job)
+
+        self.stats = {stage: IngestionStageStats(stage=stage) for stage in STAGES}
+        self._stop.clear()
+        self._errors = []
+        pages_queue = queue.Queue(maxsize=self.ingestion_config.page_queue_size)
+        chunks_queue = queue.Queue(maxsize=self.ingestion_config.chunk_queue_size)
+        batches_queue = queue.Queue(maxsize=self.ingestion_config.batch_queue_size)
+        metadata_queue = queue.Queue()
+        stage_threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(target, *args),
+                name=f"ingestion-{stage}",
+                daemon=True,
+            )
+            for stage, target, args in [
+                ("extract", self._extract, (jobs, pages_queue)),
+                ("chunk", self._chunk, (pages_queue, chunks_queue)),
+                ("embed", self._embed, (chunks_queue, batches_queue)),
+                ("index", self._index, (batches_queue, metadata_queue)),
+            ]
+        ]
+        for thread in stage_threads:
+            thread.start()
+
+        ingested_files = []
+        try:
+            self._run_stage(
+                self._record_metadata, metadata_queue, ingested_files, on_file_done
+            )
+        finally:
+            self._stop.set()
+            for thread in stage_threads:
+                thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return ingested_files
+
+    def stage_stats(self) -> List[IngestionStageStats]:
+        return [stats.model_copy() for stats in self.stats.values()]
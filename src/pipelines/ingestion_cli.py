@@ -0,0 +1,50 @@
+import argparse
+from pathlib import Path
+
+from common.model_registry import ModelRegistry
+from common.utils import load_config
+from data_store.uploaded_files import UploadedFilesDB
+from pipelines.ingestion import IngestionEngine, describe_job, find_supported_files
+from vector_store.base_vector_store import load_vector_store
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Ingest files or directories into the vector store without the streamlit app"
+    )
+    parser.add_argument(
+        "paths", type=Path, nargs="+", help="files or directories to ingest"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default="001_base_config.yml",
+        help="provide the name of the config yaml file (to be placed on the path 'src/common/configs')",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = load_config(config_name=args.config)
+
+    file_paths = find_supported_files(args.paths, config.supported_file_formats)
+    print(f"Ingesting {len(file_paths)} files")
+    vector_db = load_vector_store(config, model_registry=ModelRegistry(config))
+    engine = IngestionEngine(
+        config, vector_db=vector_db, db=UploadedFilesDB(config.database_config)
+    )
+    ingested_files = engine.run(
+        file_paths, on_file_done=lambda job: print(describe_job(job))
+    )
+
+    print(f"Ingested {len(ingested_files)} files")
+    for stats in engine.stage_stats():
+        print(
+            f"{stats.stage:>10}: {stats.num_items:8d} items, {stats.busy_time:8.2f}s busy, "
+            f"{stats.items_per_second:10.1f} items/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
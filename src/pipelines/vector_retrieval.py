@@ -1,12 +1,15 @@
-from typing import List
+from typing import List, Optional
 
-from common.constants import DEFAULT_TOP_K_EMBEDDINGS
-from data.data_classes import VectorDocumentChunk
-from vector_store.document_vector_store import VectorDB
+from data.data_classes import SearchFilter, VectorDocumentChunk
+from vector_store.base_vector_store import VectorStore
 
 
+# top_k defaults to use_top_k_embeddings of the config of the vector store.
 def run_vector_retrieval(
-    vector_db: VectorDB, query: str, top_k: int = DEFAULT_TOP_K_EMBEDDINGS
+    vector_db: VectorStore,
+    query: str,
+    top_k: Optional[int] = None,
+    search_filter: Optional[SearchFilter] = None,
 ) -> List[VectorDocumentChunk]:
-    retrievals = vector_db.search(query, top_k=top_k)
+    retrievals = vector_db.search(query, top_k=top_k, search_filter=search_filter)
     return retrievals
@@ -1,10 +1,14 @@
+import hashlib
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 
 from rerankers import Reranker
 
 
-from data.data_classes import VectorDocumentChunk, WebDocumentChunk
+from data.data_classes import VectorDocumentChunk, WebDocumentChunk, RerankerStats
 
 
 class ReRanker(ABC):
@@ -18,35 +22,129 @@ class ReRanker(ABC):
 
 
 class DefaultReRanker(ReRanker):
-    def __init__(self, top_k: Optional[int] = None):
+    def __init__(
+        self,
+        top_k: Optional[int] = None,
+        model_name: str = "cross-encoder",
+        batch_size: int = 16,
+        max_passage_tokens: int = 384,
+        score_cache_size: int = 50_000,
+    ):
         self.reranker = Reranker(
-            model_name="cross-encoder", model_type="cross-encoder", verbose=0
+            model_name=model_name,
+            model_type="cross-encoder",
+            batch_size=batch_size,
+            verbose=0,
         )
         self.top_k = top_k
+        self.batch_size = batch_size
+        self.max_passage_tokens = max_passage_tokens
+        self.score_cache_size = score_cache_size
+
+        self._score_cache: OrderedDict[Tuple[str, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+        # the reranker is shared between sessions, the stats are kept per calling thread
+        self._call_stats = threading.local()
+
+    @property
+    def last_call_stats(self) -> RerankerStats:
+        return getattr(self._call_stats, "stats", RerankerStats())
+
+    @staticmethod
+    def _document_key(document: VectorDocumentChunk | WebDocumentChunk) -> str:
+        doc_id = getattr(document, "id", None)
+        if doc_id is not None:
+            return doc_id
+        return hashlib.sha256(document.text.encode("utf-8")).hexdigest()
+
+    def _truncate_passages(self, passages: List[str]) -> List[str]:
+        tokenizer = getattr(self.reranker, "tokenizer", None)
+        if tokenizer is None or not tokenizer.is_fast:
+            # roughly 4 characters per token
+            return [passage[: self.max_passage_tokens * 4] for passage in passages]
+
+        encodings = tokenizer(
+            passages,
+            add_special_tokens=False,
+            truncation=True,
+            max_length=self.max_passage_tokens,
+            return_offsets_mapping=True,
+        )
+        truncated_passages = []
+        for passage, offsets in zip(passages, encodings["offset_mapping"]):
+            if len(offsets) < self.max_passage_tokens:
+                truncated_passages.append(passage)
+            else:
+                truncated_passages.append(passage[: offsets[-1][1]])
+        return truncated_passages
+
+    def _score(self, query: str, passages: List[str]) -> List[float]:
+        ranked = self.reranker.rank(
+            query=query,
+            docs=self._truncate_passages(passages),
+            doc_ids=list(range(len(passages))),
+            batch_size=self.batch_size,
+        )
+        # a single document is returned as a plain result instead of a ranked list
+        results = ranked.results if hasattr(ranked, "results") else [ranked]
+        scores = [0.0] * len(passages)
+        for result in results:
+            scores[result.document.doc_id] = result.score
+        return scores
 
     def run_reranker(
         self,
         query: str,
         documents: List[VectorDocumentChunk | WebDocumentChunk],
     ) -> List[VectorDocumentChunk | WebDocumentChunk]:
-
+        start_time = time.perf_counter()
         return_k = self.top_k if self.top_k is not None else len(documents)
 
-        document_text_list = [doc.text for doc in documents]
-        document_ids = list(range(len(documents)))
+        query_hash = hashlib.sha256(query.encode("utf-8")).hexdigest()
+        cache_keys = [(query_hash, self._document_key(doc)) for doc in documents]
 
-        reranked_results = self.reranker.rank(
-            query=query, docs=document_text_list, doc_ids=document_ids
-        ).results
+        scores = {}
+        with self._lock:
+            for cache_key in cache_keys:
+                score = self._score_cache.get(cache_key)
+                if score is not None:
+                    self._score_cache.move_to_end(cache_key)
+                    scores[cache_key] = score
+        num_cache_hits = len(scores)
 
-        reranked_document_ids = [res.document.doc_id for res in reranked_results]
+        missing = {
+            cache_key: doc.text
+            for cache_key, doc in zip(cache_keys, documents)
+            if cache_key not in scores
+        }
+        if missing:
+            new_scores = dict(
+                zip(missing.keys(), self._score(query, list(missing.values())))
+            )
+            with self._lock:
+                for cache_key, score in new_scores.items():
+                    self._score_cache[cache_key] = score
+                    self._score_cache.move_to_end(cache_key)
+                while len(self._score_cache) > self.score_cache_size:
+                    self._score_cache.popitem(last=False)
+            scores.update(new_scores)
+
+        reranked_document_ids = sorted(
+            range(len(documents)), key=lambda i: scores[cache_keys[i]], reverse=True
+        )
         reranked_documents = [documents[i] for i in reranked_document_ids]
 
+        self._call_stats.stats = RerankerStats(
+            latency=time.perf_counter() - start_time,
+            num_documents=len(documents),
+            num_scored=len(missing),
+            num_cache_hits=num_cache_hits,
+        )
         return reranked_documents[:return_k]
 
 
-def load_reranker(provider: str, top_k: int, **kwargs) -> Reranker:
+def load_reranker(provider: str, top_k: int, **kwargs) -> ReRanker:
     if provider == "default":
-        return DefaultReRanker()
+        return DefaultReRanker(top_k=top_k, **kwargs)
     else:
         print(f"No reranker implemented for {provider=}")
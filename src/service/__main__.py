@@ -0,0 +1,38 @@
+import argparse
+import os
+
+import uvicorn
+
+from service.app import CONFIG_ENV_VAR, DEFAULT_CONFIG_NAME
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve the chat and ingestion pipelines over http, without the streamlit app"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=DEFAULT_CONFIG_NAME,
+        help="provide the name of the config yaml file (to be placed on the path 'src/common/configs')",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes, each one loads its own models and caches",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # the worker processes inherit the environment, the config is loaded by each of them
+    os.environ[CONFIG_ENV_VAR] = args.config
+    uvicorn.run("service.app:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
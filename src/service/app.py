@@ -0,0 +1,228 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Literal, Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from common.model_registry import ModelRegistry
+from common.tracing import tracer
+from common.utils import load_config
+from data.data_classes import (
+    GenerationStats,
+    IngestionStageStats,
+    SearchFilter,
+    UploadedFileMetadata,
+    VectorDocumentChunk,
+    WebDocumentChunk,
+)
+from data.utils import save_file
+from data_store.uploaded_files import UploadedFilesDB
+from generator.generator_model import AsyncResponseStream
+from pipelines.async_chat_completion import (
+    AsyncChatCompletionPipeline,
+    use_worker_threads,
+)
+from pipelines.ingestion import IngestionEngine, describe_job
+from vector_store.base_vector_store import load_vector_store
+
+# name of the config yaml file in 'src/common/configs', read by every worker process when it starts
+CONFIG_ENV_VAR = "LLM_CHAT_APP_CONFIG"
+DEFAULT_CONFIG_NAME = "001_base_config.yml"
+
+
+class ChatMessage(BaseModel):
+    role: Literal["system", "user", "assistant"]
+    content: str
+
+
+class ChatCompletionRequest(BaseModel):
+    messages: List[ChatMessage]
+    stream: bool = True
+    # scopes the retrieval, e.g. to the files listed by GET /v1/documents
+    search_filter: Optional[SearchFilter] = None
+
+
+class ChatCompletionResponse(BaseModel):
+    answer: str
+    documents: List[VectorDocumentChunk | WebDocumentChunk]
+    stats: GenerationStats
+
+
+class DocumentUploadResponse(BaseModel):
+    ingested_files: List[str]
+    stage_stats: List[IngestionStageStats]
+
+
+class DocumentListResponse(BaseModel):
+    total: int
+    files: List[UploadedFileMetadata]
+
+
+# Every worker process builds its own models, vector store and caches from the config. The chat pipeline runs on
+# the event loop, the blocking model calls and the ingestion run in the worker threads of the loop.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    config = load_config(
+        config_name=os.environ.get(CONFIG_ENV_VAR, DEFAULT_CONFIG_NAME)
+    )
+    tracer.configure(
+        enabled=config.tracing_config.enabled,
+        max_traces=config.tracing_config.max_traces,
+    )
+    use_worker_threads(
+        asyncio.get_running_loop(), config.async_pipeline_config.worker_threads
+    )
+
+    model_registry = ModelRegistry(config)
+    if config.model_registry_config.warm_up_on_start:
+        await asyncio.to_thread(model_registry.warm_up)
+    vector_store = load_vector_store(config, model_registry=model_registry)
+
+    app.state.config = config
+    app.state.vector_store = vector_store
+    app.state.db = UploadedFilesDB(config.database_config)
+    app.state.pipeline = AsyncChatCompletionPipeline(
+        config, vector_store=vector_store, model_registry=model_registry
+    )
+    # an ingestion engine runs one ingestion at a time, concurrent uploads to the same worker wait for each other
+    app.state.ingestion_lock = asyncio.Lock()
+    yield
+
+
+app = FastAPI(title="LLM-CHAT-APP", lifespan=lifespan)
+
+
+def _server_sent_event(data: Dict, event: Optional[str] = None) -> str:
+    message = f"event: {event}\n" if event is not None else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+def _documents_as_json(
+    documents: List[VectorDocumentChunk | WebDocumentChunk],
+) -> List[Dict]:
+    return [document.model_dump(mode="json") for document in documents]
+
+
+# Streams every delta as a server sent event, followed by a "done" event with the documents of the context and the
+# generation stats. A generation that times out ends the stream with an "error" event.
+async def _stream_events(
+    response_stream: AsyncResponseStream,
+    documents: List[VectorDocumentChunk | WebDocumentChunk],
+) -> AsyncIterator[str]:
+    try:
+        async for delta in response_stream:
+            yield _server_sent_event({"delta": delta})
+    except TimeoutError:
+        yield _server_sent_event({"error": "The generation timed out"}, event="error")
+        return
+    yield _server_sent_event(
+        {
+            "documents": _documents_as_json(documents),
+            "stats": response_stream.stats.model_dump(),
+        },
+        event="done",
+    )
+
+
+@app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
+async def chat_completions(request: Request, chat_request: ChatCompletionRequest):
+    if not chat_request.messages or chat_request.messages[-1].role != "user":
+        raise HTTPException(
+            status_code=422, detail="The last message has to be a user message"
+        )
+    chat_history = [message.model_dump() for message in chat_request.messages]
+    response_stream, documents = (
+        await request.app.state.pipeline.astream_completion_pipeline(
+            chat_history, chat_request.search_filter
+        )
+    )
+
+    if chat_request.stream:
+        return StreamingResponse(
+            _stream_events(response_stream, documents),
+            media_type="text/event-stream",
+        )
+
+    try:
+        async for _ in response_stream:
+            pass
+    except TimeoutError:
+        raise HTTPException(status_code=504, detail="The generation timed out")
+    return ChatCompletionResponse(
+        answer=response_stream.text, documents=documents, stats=response_stream.stats
+    )
+
+
+# The uploaded files are saved and then ingested together, like the uploads of the streamlit app.
+@app.post("/v1/documents", response_model=DocumentUploadResponse)
+async def upload_documents(request: Request, files: List[UploadFile]):
+    config = request.app.state.config
+    meta_data = []
+    for uploaded_file in files:
+        file_type = Path(uploaded_file.filename).suffix.lstrip(".").lower()
+        if file_type not in config.supported_file_formats:
+            raise HTTPException(
+                status_code=415,
+                detail=f"{uploaded_file.filename} is not in {config.supported_file_formats=}",
+            )
+        meta_data.append(
+            {
+                "file_name": Path(uploaded_file.filename).name,
+                "file_type": file_type,
+                "file_size": uploaded_file.size,
+            }
+        )
+
+    async with request.app.state.ingestion_lock:
+        with tracer.trace("upload"):
+            file_paths = []
+            for uploaded_file, file_meta_data in zip(files, meta_data):
+                with tracer.span("upload.save_file", size_bytes=uploaded_file.size):
+                    file_paths.append(
+                        await asyncio.to_thread(
+                            save_file, uploaded_file.file, file_meta_data, config
+                        )
+                    )
+            engine = IngestionEngine(
+                config,
+                vector_db=request.app.state.vector_store,
+                db=request.app.state.db,
+            )
+            ingested_files = await asyncio.to_thread(engine.run, file_paths)
+
+    return DocumentUploadResponse(
+        ingested_files=[describe_job(job) for job in ingested_files],
+        stage_stats=engine.stage_stats(),
+    )
+
+
+@app.get("/v1/documents", response_model=DocumentListResponse)
+def list_documents(
+    request: Request,
+    limit: int = Query(default=50, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
+    file_name_filter: Optional[str] = None,
+):
+    db = request.app.state.db
+    return DocumentListResponse(
+        total=db.count_files(file_name_filter),
+        files=db.read_files(
+            limit=limit, offset=offset, file_name_filter=file_name_filter
+        ),
+    )
+
+
+# The metrics are collected per worker process.
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return tracer.metrics.to_prometheus_text()
+
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
@@ -3,7 +3,9 @@ import sys
 
 import streamlit as st
 
+from common.tracing import tracer
 from common.utils import load_config
+from streamlit_app.utils import get_model_registry
 
 
 def parse_args():
@@ -29,6 +31,14 @@ def run_app(config: str):
         llm_chat_config = load_config(config_name=config)
         st.session_state.config = llm_chat_config
 
+    tracing_config = st.session_state.config.tracing_config
+    tracer.configure(
+        enabled=tracing_config.enabled, max_traces=tracing_config.max_traces
+    )
+
+    if st.session_state.config.model_registry_config.warm_up_on_start:
+        get_model_registry()
+
     st.markdown(
         """
         Welcome to LLM-CHAT-APP
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pandas as pd
+import streamlit as st
+
+from common.tracing import Trace, tracer
+
+
+def render_trace(trace: Trace):
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    "span": span.name,
+                    "duration (ms)": round(1000 * span.duration, 1),
+                    **span.attributes,
+                }
+                for span in trace.spans
+            ]
+        ),
+        hide_index=True,
+    )
+
+
+# Shows the stage latencies of the most recent chat turns and uploads in the sidebar, when tracing is enabled.
+def render_debug_panel():
+    tracing_config = st.session_state.config.tracing_config
+    if not (tracing_config.enabled and tracing_config.show_debug_panel):
+        return
+
+    with st.sidebar:
+        st.subheader("Pipeline latency")
+        for trace in tracer.recent_traces():
+            start_time = datetime.fromtimestamp(trace.start_time).strftime("%H:%M:%S")
+            with st.expander(f"{trace.name} at {start_time}"):
+                render_trace(trace)
+
+        metrics_summary = tracer.metrics.summary()
+        if metrics_summary:
+            st.write("All spans since the start of the app")
+            st.dataframe(pd.DataFrame(metrics_summary), hide_index=True)
+            st.download_button(
+                "Download metrics",
+                tracer.metrics.to_prometheus_text(),
+                file_name="metrics.prom",
+                mime="text/plain",
+            )
@@ -1,8 +1,11 @@
-import time
+from datetime import datetime, time
+from typing import Optional
 
 import streamlit as st
 
-from streamlit_app.utils import get_chat_completion_pipeline
+from data.data_classes import SearchFilter
+from streamlit_app.debug_panel import render_debug_panel
+from streamlit_app.utils import get_chat_completion_pipeline, get_db
 
 
 class ChatInterface:
@@ -12,6 +15,8 @@ class ChatInterface:
     def initialize_state(self):
         if "messages" not in st.session_state:
             st.session_state.messages = []
+        if "generation_stats" not in st.session_state:
+            st.session_state.generation_stats = []
 
     def render_message(self, role: str, content: str):
         with st.chat_message(role):
@@ -21,19 +26,47 @@ class ChatInterface:
         for message in st.session_state.messages:
             self.render_message(message["role"], message["content"])
 
-    def stream_response(self, response: str):
-        for word in response.split():
-            yield word + " "
-            time.sleep(0.05)
-
-    def handle_user_input(self, pipeline):
+    # The answers are retrieved from all documents, unless a narrower scope is picked in the sidebar.
+    # Pages are numbered from 1 here, the page numbers of the chunks count from 0.
+    def render_document_scope(self) -> Optional[SearchFilter]:
+        if not st.session_state.config.use_rag:
+            return None
+        with st.sidebar:
+            st.subheader("Document scope")
+            file_names = st.multiselect(
+                "Files",
+                options=[file.file_name for file in get_db().read_all_files()],
+                placeholder="All files",
+            )
+            uploaded_since = st.date_input("Uploaded since", value=None)
+            first_page_column, last_page_column = st.columns(2)
+            first_page = first_page_column.number_input(
+                "First page", min_value=1, value=None, step=1
+            )
+            last_page = last_page_column.number_input(
+                "Last page", min_value=1, value=None, step=1
+            )
+        return SearchFilter(
+            file_names=file_names or None,
+            # the start of the day in the local time zone
+            uploaded_after=(
+                datetime.combine(uploaded_since, time.min).astimezone()
+                if uploaded_since is not None
+                else None
+            ),
+            min_page_num=first_page - 1 if first_page is not None else None,
+            max_page_num=last_page - 1 if last_page is not None else None,
+        )
+
+    def handle_user_input(self, pipeline, search_filter: Optional[SearchFilter]):
         if prompt := st.chat_input("How can I help you?", key="chat_input"):
             st.session_state.messages.append({"role": "user", "content": prompt})
             self.render_message(role="user", content=prompt)
 
             with st.spinner("Thinking..."):
-                model_response, documents = pipeline.run_completion_pipeline(
-                    chat_history=st.session_state.messages
+                response_stream, documents = pipeline.stream_completion_pipeline(
+                    chat_history=st.session_state.messages,
+                    search_filter=search_filter,
                 )
 
             with st.chat_message("assistant"):
@@ -42,8 +75,24 @@ class ChatInterface:
                 #     for i, document in enumerate(documents):
                 #         with st.expander(f"Document {i + 1}"):
                 #             st.write(document.text)
-                response = st.write_stream(self.stream_response(model_response))
-            st.session_state.messages.append({"role": "assistant", "content": response})
+                st.write_stream(response_stream)
+                stats = response_stream.stats
+                if stats.from_cache:
+                    st.caption("Answered from the cache of similar questions")
+                else:
+                    throughput = (
+                        f"{stats.deltas_per_second:.1f} chunks/s"
+                        if stats.tokens_per_second is None
+                        else f"{stats.tokens_per_second:.1f} tokens/s"
+                    )
+                    st.caption(
+                        f"Time to first token: {stats.time_to_first_token or 0:.2f}s, "
+                        f"{throughput}"
+                    )
+            st.session_state.messages.append(
+                {"role": "assistant", "content": response_stream.text}
+            )
+            st.session_state.generation_stats.append(stats)
 
     def render(self):
         st.title(self.title)
@@ -52,9 +101,13 @@ class ChatInterface:
 
         pipeline = get_chat_completion_pipeline()
 
+        search_filter = self.render_document_scope()
+
         self.render_all_messages()
 
-        self.handle_user_input(pipeline=pipeline)
+        self.handle_user_input(pipeline=pipeline, search_filter=search_filter)
+
+        render_debug_panel()
 
 
 if __name__ == "__main__":
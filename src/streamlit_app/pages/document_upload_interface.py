@@ -1,34 +1,90 @@
+import pandas as pd
 import streamlit as st
 
 from pipelines.document_upload import run_document_upload_pipeline
+from streamlit_app.debug_panel import render_debug_panel
 from streamlit_app.utils import get_db, get_vector_db
 
 
 class UploadDocumentsInterface:
-    def __init__(self):
+    def __init__(self, files_per_page: int = 50):
         self.title = "Upload files"
+        self.files_per_page = files_per_page
+
+    @staticmethod
+    def render_stage_stats(stage_stats):
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "stage": stats.stage,
+                        "items": stats.num_items,
+                        "busy time (s)": round(stats.busy_time, 2),
+                        "items/s": round(stats.items_per_second, 1),
+                    }
+                    for stats in stage_stats
+                ]
+            ),
+            hide_index=True,
+        )
 
     def render(self):
         st.title(self.title)
 
-        uploaded_file = st.file_uploader(
-            "Choose file to upload",
+        uploaded_files = st.file_uploader(
+            "Choose files to upload",
             type=st.session_state.config.supported_file_formats,
-            accept_multiple_files=False,
+            accept_multiple_files=True,
         )
+        # directories on the server are only ingested with `pipelines.ingestion_cli`, so that users of the app
+        # can't make it index files they have no access to
 
         db = get_db()
         vector_db = get_vector_db()
-        existing_files = db.read_all_files_as_df()
-        dataframe_placeholder = st.dataframe(
-            existing_files,
+        # only one page of the uploaded files is read per rerun
+        filter_column, page_column = st.columns([3, 1])
+        file_name_filter = filter_column.text_input("Filter uploaded files by name")
+        num_files = db.count_files(file_name_filter)
+        num_pages = max(1, -(-num_files // self.files_per_page))
+        page = page_column.number_input(
+            f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1
         )
 
-        if uploaded_file is not None:
-            with st.status("Processing uploaded document..."):
-                run_document_upload_pipeline(uploaded_file, vector_db=vector_db, db=db)
-            updated_files = db.read_all_files_as_df()
-            dataframe_placeholder.dataframe(updated_files)
+        def read_page():
+            return db.read_files_as_df(
+                limit=self.files_per_page,
+                offset=(page - 1) * self.files_per_page,
+                file_name_filter=file_name_filter,
+            )
+
+        dataframe_placeholder = st.dataframe(read_page())
+
+        # the uploader keeps its files across reruns, e.g. when the listing is filtered or paged,
+        # so every uploaded file is saved and ingested only on the first run after its upload
+        if "processed_file_ids" not in st.session_state:
+            st.session_state.processed_file_ids = set()
+        new_files = [
+            uploaded_file
+            for uploaded_file in uploaded_files or []
+            if uploaded_file.file_id not in st.session_state.processed_file_ids
+        ]
+
+        stage_stats = None
+        if new_files:
+            with st.status("Processing uploaded documents..."):
+                stage_stats = run_document_upload_pipeline(
+                    st.session_state.config, new_files, vector_db=vector_db, db=db
+                )
+            st.session_state.processed_file_ids.update(
+                uploaded_file.file_id for uploaded_file in new_files
+            )
+
+        if stage_stats is not None:
+            dataframe_placeholder.dataframe(read_page())
+            st.write("Throughput per ingestion stage")
+            self.render_stage_stats(stage_stats)
+
+        render_debug_panel()
 
 
 if __name__ == "__main__":
@@ -1,22 +1,38 @@
 import streamlit as st
 
+from common.model_registry import ModelRegistry
 from data_store.uploaded_files import UploadedFilesDB
 from pipelines.chat_completion import ChatCompletionPipeline
-from vector_store.document_vector_store import VectorDB
+from vector_store.base_vector_store import VectorStore, load_vector_store
 
 
 @st.cache_resource
 def get_db() -> UploadedFilesDB:
-    db = UploadedFilesDB()
+    db = UploadedFilesDB(st.session_state.config.database_config)
     return db
 
 
 @st.cache_resource
-def get_vector_db() -> VectorDB:
-    vector_db = VectorDB()
+def get_model_registry() -> ModelRegistry:
+    model_registry = ModelRegistry(st.session_state.config)
+    if st.session_state.config.model_registry_config.warm_up_on_start:
+        model_registry.warm_up()
+    return model_registry
+
+
+@st.cache_resource
+def get_vector_db() -> VectorStore:
+    vector_db = load_vector_store(
+        st.session_state.config, model_registry=get_model_registry()
+    )
     return vector_db
 
 
+@st.cache_resource
 def get_chat_completion_pipeline() -> ChatCompletionPipeline:
-    pipeline = ChatCompletionPipeline(vector_store=get_vector_db())
+    pipeline = ChatCompletionPipeline(
+        st.session_state.config,
+        vector_store=get_vector_db(),
+        model_registry=get_model_registry(),
+    )
     return pipeline
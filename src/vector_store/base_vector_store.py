@@ -0,0 +1,422 @@
+import asyncio
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, List, Optional, Set, Sized, Tuple
+
+from common.config import LLMChatConfig
+from common.model_registry import ModelRegistry
+from data.data_classes import SearchFilter, VectorDocumentChunk
+from data_store.uploaded_files import UploadedFilesDB
+from vector_store.embedding_reduction import EmbeddingTransform, embedding_reduction_dir
+from vector_store.fusion import fuse_results
+from vector_store.retrieval_cache import RetrievalCache
+
+
+# Backend independent part of a vector store: batched, pipelined embedding on ingest and cached retrieval.
+# Backends only implement how embedded documents are indexed and how the nearest neighbours of a query are found.
+# Documents and queries are embedded through the same `EmbeddingTransform`, which reduces and normalizes them.
+class VectorStore(ABC):
+    # name of the backend in config.vector_store_backend
+    backend: str
+
+    def __init__(self, config: LLMChatConfig, model_registry: ModelRegistry):
+        self.config = config
+        self.model_registry = model_registry
+        self.retrieval_cache = self._init_retrieval_cache()
+        self.embedding_transform = EmbeddingTransform(
+            config.opensearch_config, embedding_reduction_dir(config, self.backend)
+        )
+        # opened on first use, by a search scoped by upload time or the retrieval cache
+        self._uploaded_files_db: Optional[UploadedFilesDB] = None
+        # generation of the indexed documents the retrieval cache was last checked against
+        self._index_generation: Optional[int] = None
+
+    def _init_retrieval_cache(self) -> Optional[RetrievalCache]:
+        cache_config = self.config.opensearch_config.retrieval_cache_config
+        if not cache_config.enabled:
+            return None
+        return RetrievalCache(
+            max_entries=cache_config.max_entries, ttl_seconds=cache_config.ttl_seconds
+        )
+
+    @abstractmethod
+    def index_documents(
+        self, documents: List[VectorDocumentChunk], embeddings: List[List[float]]
+    ) -> int:
+        pass
+
+    @abstractmethod
+    def get_document_ids(self, file_name: str) -> Set[str]:
+        pass
+
+    # Returns the number of deleted documents.
+    @abstractmethod
+    def delete_documents(self, ids: List[str]) -> int:
+        pass
+
+    # Only the documents matching search_filter are searched, see `SearchFilter`. Its upload time range was
+    # already resolved to file names by `search`.
+    @abstractmethod
+    def search_by_vector(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[VectorDocumentChunk]:
+        pass
+
+    # Returns the scored hits of a lexical and of a vector query, which are fused by `search`.
+    @abstractmethod
+    def search_lexical_and_vector(
+        self,
+        query_text: str,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[
+        List[Tuple[VectorDocumentChunk, float]], List[Tuple[VectorDocumentChunk, float]]
+    ]:
+        pass
+
+    @property
+    def uploaded_files_db(self) -> UploadedFilesDB:
+        if self._uploaded_files_db is None:
+            self._uploaded_files_db = UploadedFilesDB(self.config.database_config)
+        return self._uploaded_files_db
+
+    # Makes the indexed and deleted documents visible to searches. Backends whose changes become visible
+    # asynchronously override it, it is called before the retrieval cache is invalidated, so that no search
+    # after the invalidation caches results from before the changes.
+    def refresh(self):
+        pass
+
+    # Called once documents were indexed or deleted. Other processes searching the same documents, e.g. the other
+    # workers of the service, keep their own retrieval caches, so the change is also counted in the files database,
+    # which every process checks before a cache lookup, see `_sync_retrieval_cache`.
+    def invalidate_retrieval_caches(self):
+        self.refresh()
+        self.uploaded_files_db.bump_index_generation()
+        if self.retrieval_cache is not None:
+            self.retrieval_cache.invalidate()
+
+    def _sync_retrieval_cache(self):
+        index_generation = self.uploaded_files_db.read_index_generation()
+        if index_generation != self._index_generation:
+            self._index_generation = index_generation
+            self.retrieval_cache.invalidate()
+
+    def encode_documents(
+        self, documents: List[VectorDocumentChunk], embedding_batch_size: int
+    ) -> List[List[float]]:
+        embeddings = []
+        with self.model_registry.use("embedder") as embedder:
+            for i in range(0, len(documents), embedding_batch_size):
+                batch_texts = [
+                    doc.text for doc in documents[i : i + embedding_batch_size]
+                ]
+                embeddings.extend(
+                    self.embedding_transform.transform(
+                        embedder.encode(batch_texts)
+                    ).tolist()
+                )
+        return embeddings
+
+    # Embedding and indexing are pipelined: while the bulk request of one batch is in flight,
+    # the next batch is already being embedded. Documents can be a lazily produced iterable,
+    # e.g. chunks of pages that are still being extracted, which is consumed one upload batch at a time.
+    # on_progress is called after every batch with the number of embedded documents and the total, if known.
+    def add_documents(
+        self,
+        documents: Iterable[VectorDocumentChunk],
+        embedding_batch_size: Optional[int] = None,
+        upload_batch_size: Optional[int] = None,
+        on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+    ) -> int:
+        if embedding_batch_size is None:
+            embedding_batch_size = self.config.opensearch_config.embedding_batch_size
+        if upload_batch_size is None:
+            upload_batch_size = self.config.opensearch_config.upload_batch_size
+
+        num_documents = len(documents) if isinstance(documents, Sized) else None
+        documents = iter(documents)
+        errors = 0
+        num_embedded = 0
+        pending_upload = None
+        with ThreadPoolExecutor(max_workers=1) as upload_executor:
+            while batch := list(islice(documents, upload_batch_size)):
+                embeddings = self.encode_documents(batch, embedding_batch_size)
+                num_embedded += len(batch)
+                if pending_upload is not None:
+                    errors += pending_upload.result()
+                pending_upload = upload_executor.submit(
+                    self.index_documents, batch, embeddings
+                )
+                if on_progress is not None:
+                    on_progress(num_embedded, num_documents)
+            if pending_upload is not None:
+                errors += pending_upload.result()
+        self.invalidate_retrieval_caches()
+        return errors
+
+    def _encode_query(self, query_text: str) -> List[float]:
+        with self.model_registry.use("embedder") as embedder:
+            query_embedding = embedder.encode(query_text)
+        return self.embedding_transform.transform(query_embedding).tolist()
+
+    # Upload times are recorded per file, so a range of upload times is resolved to the names of the files uploaded
+    # in it. The backends then filter by file name, which stays correct for updated files and existing indexes.
+    # A scope of more than max_filter_file_names files is too large for a query, its file names are returned
+    # separately, to filter the hits of the search without them.
+    def _resolve_search_filter(
+        self, search_filter: Optional[SearchFilter]
+    ) -> Tuple[Optional[SearchFilter], Optional[Set[str]]]:
+        search_filter = self._resolve_upload_times(search_filter)
+        max_filter_file_names = self.config.opensearch_config.max_filter_file_names
+        if (
+            search_filter is None
+            or search_filter.file_names is None
+            or len(search_filter.file_names) <= max_filter_file_names
+        ):
+            return search_filter, None
+        print(
+            f"The search is scoped to {len(search_filter.file_names)} files, more than {max_filter_file_names=}, "
+            f"its hits are filtered after searching all files"
+        )
+        return (
+            search_filter.model_copy(update={"file_names": None}),
+            set(search_filter.file_names),
+        )
+
+    def _resolve_upload_times(
+        self, search_filter: Optional[SearchFilter]
+    ) -> Optional[SearchFilter]:
+        if search_filter is None or (
+            search_filter.uploaded_after is None
+            and search_filter.uploaded_before is None
+        ):
+            return search_filter
+        file_names = self.uploaded_files_db.find_file_names(
+            search_filter.uploaded_after, search_filter.uploaded_before
+        )
+        if search_filter.file_names is not None:
+            picked_file_names = set(search_filter.file_names)
+            file_names = [name for name in file_names if name in picked_file_names]
+        return search_filter.model_copy(
+            update={
+                "file_names": file_names,
+                "uploaded_after": None,
+                "uploaded_before": None,
+            }
+        )
+
+    def _search_top_k(
+        self, top_k: int, post_filter_file_names: Optional[Set[str]]
+    ) -> int:
+        if post_filter_file_names is None:
+            return top_k
+        return top_k * self.config.opensearch_config.post_filter_oversampling
+
+    @staticmethod
+    def _post_filter(
+        documents: List[VectorDocumentChunk],
+        top_k: int,
+        post_filter_file_names: Optional[Set[str]],
+    ) -> List[VectorDocumentChunk]:
+        if post_filter_file_names is None:
+            return documents
+        return [
+            document
+            for document in documents
+            if document.file_name in post_filter_file_names
+        ][:top_k]
+
+    def _fuse_hits(
+        self,
+        lexical_hits: List[Tuple[VectorDocumentChunk, float]],
+        vector_hits: List[Tuple[VectorDocumentChunk, float]],
+        top_k: int,
+    ) -> List[VectorDocumentChunk]:
+        hybrid_search_config = self.config.opensearch_config.hybrid_search_config
+        return fuse_results(
+            [lexical_hits, vector_hits],
+            weights=[
+                hybrid_search_config.lexical_weight,
+                hybrid_search_config.vector_weight,
+            ],
+            fusion_method=hybrid_search_config.fusion_method,
+            top_k=top_k,
+            rrf_k=hybrid_search_config.rrf_k,
+        )
+
+    def search(
+        self,
+        query_text: str,
+        top_k: Optional[int] = None,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[VectorDocumentChunk]:
+        if top_k is None:
+            top_k = self.config.opensearch_config.use_top_k_embeddings
+        if search_filter is not None and search_filter.is_empty:
+            search_filter = None
+        response_score_threshold = (
+            self.config.opensearch_config.filter_confidence_threshold
+        )
+        if self.retrieval_cache is not None:
+            self._sync_retrieval_cache()
+            cache_key = self.retrieval_cache.make_key(
+                query_text, top_k, response_score_threshold, search_filter
+            )
+            cached_documents = self.retrieval_cache.get(cache_key)
+            if cached_documents is not None:
+                return cached_documents
+            cache_generation = self.retrieval_cache.generation
+
+        search_filter, post_filter_file_names = self._resolve_search_filter(
+            search_filter
+        )
+        search_top_k = self._search_top_k(top_k, post_filter_file_names)
+        retrieved_documents = []
+        # a scope without files has no documents to search
+        if search_filter is None or search_filter.file_names != []:
+            query_embedding = self._encode_query(query_text)
+            if self.config.opensearch_config.hybrid_search_config.enabled:
+                lexical_hits, vector_hits = self.search_lexical_and_vector(
+                    query_text,
+                    query_embedding,
+                    search_top_k,
+                    response_score_threshold,
+                    search_filter,
+                )
+                retrieved_documents = self._fuse_hits(
+                    lexical_hits, vector_hits, search_top_k
+                )
+            else:
+                retrieved_documents = self.search_by_vector(
+                    query_embedding,
+                    search_top_k,
+                    response_score_threshold,
+                    search_filter,
+                )
+            retrieved_documents = self._post_filter(
+                retrieved_documents, top_k, post_filter_file_names
+            )
+
+        if self.retrieval_cache is not None:
+            self.retrieval_cache.put(cache_key, retrieved_documents, cache_generation)
+        return retrieved_documents
+
+    # Backends with an async client override the async variants of the queries. The default runs the blocking
+    # query in a worker thread.
+    async def asearch_by_vector(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[VectorDocumentChunk]:
+        return await asyncio.to_thread(
+            self.search_by_vector,
+            query_embedding,
+            top_k,
+            score_threshold,
+            search_filter,
+        )
+
+    async def asearch_lexical_and_vector(
+        self,
+        query_text: str,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[
+        List[Tuple[VectorDocumentChunk, float]], List[Tuple[VectorDocumentChunk, float]]
+    ]:
+        return await asyncio.to_thread(
+            self.search_lexical_and_vector,
+            query_text,
+            query_embedding,
+            top_k,
+            score_threshold,
+            search_filter,
+        )
+
+    # Async variant of `search`, sharing its retrieval cache. The query is embedded in a worker thread, as the
+    # embedder may be a local model.
+    async def asearch(
+        self,
+        query_text: str,
+        top_k: Optional[int] = None,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[VectorDocumentChunk]:
+        if top_k is None:
+            top_k = self.config.opensearch_config.use_top_k_embeddings
+        if search_filter is not None and search_filter.is_empty:
+            search_filter = None
+        response_score_threshold = (
+            self.config.opensearch_config.filter_confidence_threshold
+        )
+        if self.retrieval_cache is not None:
+            await asyncio.to_thread(self._sync_retrieval_cache)
+            cache_key = self.retrieval_cache.make_key(
+                query_text, top_k, response_score_threshold, search_filter
+            )
+            cached_documents = self.retrieval_cache.get(cache_key)
+            if cached_documents is not None:
+                return cached_documents
+            cache_generation = self.retrieval_cache.generation
+
+        search_filter, post_filter_file_names = await asyncio.to_thread(
+            self._resolve_search_filter, search_filter
+        )
+        search_top_k = self._search_top_k(top_k, post_filter_file_names)
+        retrieved_documents = []
+        # a scope without files has no documents to search
+        if search_filter is None or search_filter.file_names != []:
+            query_embedding = await asyncio.to_thread(self._encode_query, query_text)
+            if self.config.opensearch_config.hybrid_search_config.enabled:
+                lexical_hits, vector_hits = await self.asearch_lexical_and_vector(
+                    query_text,
+                    query_embedding,
+                    search_top_k,
+                    response_score_threshold,
+                    search_filter,
+                )
+                retrieved_documents = self._fuse_hits(
+                    lexical_hits, vector_hits, search_top_k
+                )
+            else:
+                retrieved_documents = await self.asearch_by_vector(
+                    query_embedding,
+                    search_top_k,
+                    response_score_threshold,
+                    search_filter,
+                )
+            retrieved_documents = self._post_filter(
+                retrieved_documents, top_k, post_filter_file_names
+            )
+
+        if self.retrieval_cache is not None:
+            self.retrieval_cache.put(cache_key, retrieved_documents, cache_generation)
+        return retrieved_documents
+
+
+def load_vector_store(
+    config: LLMChatConfig, model_registry: ModelRegistry, backend: Optional[str] = None
+) -> VectorStore:
+    if backend is None:
+        backend = config.vector_store_backend
+    # imported here, as the backends themselves depend on the VectorStore base class
+    if backend == "opensearch":
+        from vector_store.document_vector_store import VectorDB
+
+        return VectorDB(config, model_registry)
+    elif backend == "local":
+        from vector_store.local_vector_store import LocalVectorDB
+
+        return LocalVectorDB(config, model_registry)
+    else:
+        print(f"No vector store implemented for {backend=}")
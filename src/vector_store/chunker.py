@@ -0,0 +1,92 @@
+import hashlib
+from bisect import bisect_right
+from typing import Iterable, Iterator
+
+from data.data_classes import VectorDocumentChunk
+
+# Split candidates in order of preference. As in `vector_store.utils.find_split_idx`, a period is preferred to have
+# smooth transitions between the chunks, then a new line, and a space has the least preference.
+_BOUNDARY_CHARS = (".", "\n", " ")
+
+
+# Returns the candidate closest to split_idx that lies strictly between lower and upper. Offsets are relative to text.
+# The search is bounded to the window, so a missing candidate never rescans the rest of the text.
+def find_split_idx(text: str, split_idx: int, lower: int, upper: int) -> int:
+    for char in _BOUNDARY_CHARS:
+        prev_candidate = text.rfind(char, lower + 1, split_idx)
+        next_candidate = text.find(char, split_idx, upper)
+        if prev_candidate != -1 and next_candidate != -1:
+            if split_idx - prev_candidate < next_candidate - split_idx:
+                return prev_candidate
+            return next_candidate
+        if prev_candidate != -1:
+            return prev_candidate
+        if next_candidate != -1:
+            return next_candidate
+    return split_idx
+
+
+# Chunk ids are derived from the file name, the position and the content of the chunk. Re-chunking an unchanged
+# part of a document therefore yields the same ids, which lets re-ingestion skip the chunks that are already indexed.
+def make_chunk_id(file_name: str, page_num: int, start_idx: int, text: str) -> str:
+    return hashlib.sha256(
+        f"{file_name}\x00{page_num}\x00{start_idx}\x00{text}".encode()
+    ).hexdigest()
+
+
+# Single pass chunking engine. Pages are consumed lazily and chunks are yielded as soon as enough text is read.
+# Only the text from the start of the current chunk onwards is buffered. page_num, start_idx and paginated_text
+# have the same meaning as in `rolling_window`: the page the chunk starts on, the offset within that page,
+# and whether the chunk continues on a following page.
+# Split points are searched within `overlap_size` around the target split index, which guarantees progress
+# and keeps the overlap between consecutive chunks at most twice the configured overlap.
+def iter_document_chunks(
+    pages: Iterable[str], file_name: str, chunk_size: int, overlap_ratio: float
+) -> Iterator[VectorDocumentChunk]:
+    overlap_size = int(chunk_size * overlap_ratio)
+    assert (
+        overlap_size < chunk_size
+    ), f"{overlap_ratio=} must be smaller than 1 to make progress"
+
+    page_offsets = []
+    text = ""
+    text_offset = 0
+    document_length = 0
+    start_idx = 0
+    last_end_idx = 0
+
+    def make_chunk(chunk_start_idx: int, chunk_end_idx: int) -> VectorDocumentChunk:
+        page_num = bisect_right(page_offsets, chunk_start_idx) - 1
+        end_page_num = bisect_right(page_offsets, chunk_end_idx - 1) - 1
+        chunk_text = text[chunk_start_idx - text_offset : chunk_end_idx - text_offset]
+        page_start_idx = chunk_start_idx - page_offsets[page_num]
+        return VectorDocumentChunk(
+            id=make_chunk_id(file_name, page_num, page_start_idx, chunk_text),
+            text=chunk_text,
+            page_num=page_num,
+            start_idx=page_start_idx,
+            paginated_text=end_page_num != page_num,
+            file_name=file_name,
+        )
+
+    for page in pages:
+        page_offsets.append(document_length)
+        text = text[start_idx - text_offset :] + page
+        text_offset = start_idx
+        document_length += len(page)
+
+        while start_idx + chunk_size <= document_length:
+            end_idx = start_idx + chunk_size
+            yield make_chunk(start_idx, end_idx)
+            last_end_idx = end_idx
+            split_idx = end_idx - overlap_size
+            start_idx = text_offset + find_split_idx(
+                text,
+                split_idx - text_offset,
+                max(start_idx, split_idx - overlap_size) - text_offset,
+                end_idx - text_offset,
+            )
+
+    # the remaining text at the end of the document is shorter than a chunk
+    if last_end_idx < document_length:
+        yield make_chunk(start_idx, document_length)
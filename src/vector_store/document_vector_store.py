@@ -1,22 +1,37 @@
 import json
+import math
 import os
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set, Tuple
 
-import streamlit as st
 from opensearchpy import OpenSearch, helpers
+from opensearchpy.exceptions import HTTP_EXCEPTIONS, TransportError
 
-from data.data_classes import VectorDocumentChunk
-from vector_store.embedder import load_embedder
+from common.config import LLMChatConfig
+from common.model_registry import ModelRegistry
+from data.data_classes import SearchFilter, VectorDocumentChunk
+from vector_store.base_vector_store import VectorStore
+from vector_store.embedding_reduction import knn_score_threshold
 
 
-class VectorDB:
-    def __init__(self):
-        self.client = OpenSearch(
+class VectorDB(VectorStore):
+    backend = "opensearch"
+
+    def __init__(self, config: LLMChatConfig, model_registry: ModelRegistry):
+        super().__init__(config, model_registry)
+        self.client = OpenSearch(**self._client_args())
+        # created on first use, as the async client belongs to the event loop it is used in
+        self._async_client: Optional["AsyncOpenSearch"] = None
+        self.index = config.opensearch_config.index_name
+        self.index_profile = config.opensearch_config.knn_index_profile
+        self._init_index(index=self.index)
+
+    def _client_args(self) -> Dict[str, Any]:
+        return dict(
             hosts=[
                 {
-                    "host": st.session_state.config.opensearch_config.host,
-                    "port": st.session_state.config.opensearch_config.port,
+                    "host": self.config.opensearch_config.host,
+                    "port": self.config.opensearch_config.port,
                 }
             ],
             http_compress=True,
@@ -27,12 +42,15 @@ class VectorDB:
             verify_certs=False,
             http_auth=("admin", os.environ["OPENSEARCH_INITIAL_ADMIN_PASSWORD"]),
         )
-        self.index = st.session_state.config.opensearch_config.index_name
-        self._init_index(index=self.index)
-        self.embedder = load_embedder(
-            provider=st.session_state.config.embedding_model_config.model_provider,
-            model_name=st.session_state.config.embedding_model_config.model_name,
-        )
+
+    @property
+    def async_client(self) -> "AsyncOpenSearch":
+        if self._async_client is None:
+            # imported here, as the async client needs aiohttp, which only the async pipeline uses
+            from opensearchpy import AsyncOpenSearch
+
+            self._async_client = AsyncOpenSearch(**self._client_args())
+        return self._async_client
 
     @staticmethod
     def _load_index_config(config_name: str) -> Dict[str, Any]:
@@ -43,57 +61,145 @@ class VectorDB:
             config = json.load(f)
         return config
 
-    def add_documents(
-        self, documents: List[VectorDocumentChunk], upload_batch_size: int = 10
+    def index_documents(
+        self, documents: List[VectorDocumentChunk], embeddings: List[List[float]]
     ) -> int:
-        errors = 0
-        progress_bar = st.progress(0, text="Embedding documents..")
-        for i in range(0, len(documents), upload_batch_size):
-            document_actions = [
-                {
-                    "_op_type": "index",
-                    "_index": self.index,
-                    "_id": doc.id,
-                    "_source": {
-                        "text": doc.text,
-                        "page_num": doc.page_num,
-                        "start_idx": doc.start_idx,
-                        "paginated_text": doc.paginated_text,
-                        "file_name": doc.file_name,
-                        "embedding": self.embedder.encode(doc.text).tolist(),
-                    },
-                }
-                for doc in documents[i : i + upload_batch_size]
-            ]
-            _, errors_ = helpers.bulk(client=self.client, actions=document_actions)
-            errors += len(errors_)
-            progress_bar.progress(
-                value=int(i / len(documents) * 100), text="Embedding documents.."
+        document_actions = [
+            {
+                "_op_type": "index",
+                "_index": self.index,
+                "_id": doc.id,
+                "_source": {
+                    "text": doc.text,
+                    "page_num": doc.page_num,
+                    "start_idx": doc.start_idx,
+                    "paginated_text": doc.paginated_text,
+                    "file_name": doc.file_name,
+                    "embedding": self._encode_vector(embedding),
+                },
+            }
+            for doc, embedding in zip(documents, embeddings)
+        ]
+        _, errors = helpers.bulk(
+            client=self.client, actions=document_actions, raise_on_error=False
+        )
+        return len(errors)
+
+    # Bulk requests are searchable after the next periodic refresh of the index, about a second later.
+    def refresh(self):
+        self.client.indices.refresh(index=self.index)
+
+    def get_document_ids(self, file_name: str) -> Set[str]:
+        return {
+            hit["_id"]
+            for hit in helpers.scan(
+                client=self.client,
+                index=self.index,
+                query={"query": {"term": {"file_name": file_name}}, "_source": False},
             )
-        progress_bar.empty()
-        return errors
+        }
+
+    def delete_documents(self, ids: List[str]) -> int:
+        num_deleted, _ = helpers.bulk(
+            client=self.client,
+            actions=(
+                {"_op_type": "delete", "_index": self.index, "_id": doc_id}
+                for doc_id in ids
+            ),
+            raise_on_error=False,
+        )
+        return num_deleted
 
-    def search(
+    # Byte encoded indexes store int8 vectors, so documents and queries are quantized the same way.
+    def _encode_vector(self, embedding: List[float]) -> List[float]:
+        if self.index_profile.vector_encoding != "byte":
+            return embedding
+        scale = self.index_profile.byte_quantization_scale
+        return [max(-128, min(127, round(value * scale))) for value in embedding]
+
+    # In the l2 space the score is 1 / (1 + squared distance). Quantizing to bytes scales all distances by
+    # byte_quantization_scale, the threshold is converted so that it keeps its meaning for float vectors,
+    # and for the innerproduct space, see `knn_score_threshold`.
+    def _knn_score_threshold(self, score_threshold: float) -> float:
+        scale = 1.0
+        if self.index_profile.vector_encoding == "byte":
+            scale = self.index_profile.byte_quantization_scale
+        return knn_score_threshold(
+            score_threshold, self.config.opensearch_config.space_type, scale=scale
+        )
+
+    @staticmethod
+    def _filter_clauses(search_filter: SearchFilter) -> List[Dict[str, Any]]:
+        clauses = []
+        if search_filter.file_names is not None:
+            clauses.append({"terms": {"file_name": search_filter.file_names}})
+        page_num_range = {
+            bound: value
+            for bound, value in (
+                ("gte", search_filter.min_page_num),
+                ("lte", search_filter.max_page_num),
+            )
+            if value is not None
+        }
+        if page_num_range:
+            clauses.append({"range": {"page_num": page_num_range}})
+        return clauses
+
+    # The filter is part of the knn query, so that faiss searches only the matching documents: OpenSearch searches
+    # small scopes exactly and larger ones through the graph, skipping the documents outside the scope. Filtering
+    # the hits afterwards would return fewer than top_k documents for narrow scopes.
+    def _knn_query(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Dict[str, Any]:
+        k = max(top_k, math.ceil(top_k * self.index_profile.k_multiplier))
+        knn_query = {
+            "vector": self._encode_vector(query_embedding),
+            "k": k,
+            # the search list has to hold at least k candidates
+            "method_parameters": {"ef_search": max(self.index_profile.ef_search, k)},
+        }
+        if search_filter is not None:
+            knn_query["filter"] = {
+                "bool": {"filter": self._filter_clauses(search_filter)}
+            }
+        return {
+            "_source": {"exclude": ["embedding"]},
+            "size": top_k,
+            "query": {"knn": {"embedding": knn_query}},
+        }
+
+    def _lexical_query(
         self,
         query_text: str,
-        top_k: int = st.session_state.config.opensearch_config.use_top_k_embeddings,
-    ) -> List[VectorDocumentChunk]:
-        retrieved_documents = []
-        query_embedding = self.embedder.encode(query_text).tolist()
-        query = {
+        top_k: int,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Dict[str, Any]:
+        query = {"match": {"text": query_text}}
+        if search_filter is not None:
+            query = {
+                "bool": {
+                    "must": [query],
+                    "filter": self._filter_clauses(search_filter),
+                }
+            }
+        return {
             "_source": {"exclude": ["embedding"]},
             "size": top_k,
-            "query": {"knn": {"embedding": {"vector": query_embedding, "k": 20}}},
+            "query": query,
         }
-        response = self.client.search(index=self.index, body=query)
-        response_score_threshold = (
-            st.session_state.config.opensearch_config.filter_confidence_threshold
-        )
 
+    @staticmethod
+    def _parse_hits(
+        response: Dict[str, Any], score_threshold: Optional[float] = None
+    ) -> List[Tuple[VectorDocumentChunk, float]]:
+        retrieved_documents = []
         if response["hits"]:
             hits = response["hits"]["hits"]
             for hit in hits:
-                if hit["_score"] > response_score_threshold:
+                if score_threshold is None or hit["_score"] > score_threshold:
                     doc = VectorDocumentChunk(
                         id=hit["_id"],
                         text=hit["_source"]["text"],
@@ -102,9 +208,111 @@ class VectorDB:
                         paginated_text=hit["_source"]["paginated_text"],
                         file_name=hit["_source"]["file_name"],
                     )
-                    retrieved_documents.append(doc)
+                    retrieved_documents.append((doc, hit["_score"]))
         return retrieved_documents
 
+    # A failed query of an msearch request is answered with an error object in place of its hits, it is raised
+    # like the error of a single search.
+    @staticmethod
+    def _check_msearch_responses(
+        responses: List[Dict[str, Any]],
+    ) -> List[Dict[str, Any]]:
+        for response in responses:
+            if "error" in response:
+                status = response.get("status", "N/A")
+                error = response["error"]
+                error_type = error.get("type") if isinstance(error, dict) else error
+                raise HTTP_EXCEPTIONS.get(status, TransportError)(
+                    status, error_type, response
+                )
+        return responses
+
+    def search_by_vector(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[VectorDocumentChunk]:
+        response = self.client.search(
+            index=self.index,
+            body=self._knn_query(query_embedding, top_k, search_filter),
+        )
+        return [
+            doc
+            for doc, _ in self._parse_hits(
+                response, self._knn_score_threshold(score_threshold)
+            )
+        ]
+
+    async def asearch_by_vector(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[VectorDocumentChunk]:
+        response = await self.async_client.search(
+            index=self.index,
+            body=self._knn_query(query_embedding, top_k, search_filter),
+        )
+        return [
+            doc
+            for doc, _ in self._parse_hits(
+                response, self._knn_score_threshold(score_threshold)
+            )
+        ]
+
+    # Both queries are sent in a single round trip with the multi search API.
+    def search_lexical_and_vector(
+        self,
+        query_text: str,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[
+        List[Tuple[VectorDocumentChunk, float]], List[Tuple[VectorDocumentChunk, float]]
+    ]:
+        lexical_response, vector_response = self._check_msearch_responses(
+            self.client.msearch(
+                body=[
+                    {"index": self.index},
+                    self._lexical_query(query_text, top_k, search_filter),
+                    {"index": self.index},
+                    self._knn_query(query_embedding, top_k, search_filter),
+                ]
+            )["responses"]
+        )
+        return self._parse_hits(lexical_response), self._parse_hits(
+            vector_response, self._knn_score_threshold(score_threshold)
+        )
+
+    async def asearch_lexical_and_vector(
+        self,
+        query_text: str,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[
+        List[Tuple[VectorDocumentChunk, float]], List[Tuple[VectorDocumentChunk, float]]
+    ]:
+        response = await self.async_client.msearch(
+            body=[
+                {"index": self.index},
+                self._lexical_query(query_text, top_k, search_filter),
+                {"index": self.index},
+                self._knn_query(query_embedding, top_k, search_filter),
+            ]
+        )
+        lexical_response, vector_response = self._check_msearch_responses(
+            response["responses"]
+        )
+        return self._parse_hits(lexical_response), self._parse_hits(
+            vector_response, self._knn_score_threshold(score_threshold)
+        )
+
     def _init_index(
         self,
         index,
@@ -112,7 +320,24 @@ class VectorDB:
     ):
         if not self.client.indices.exists(index=index):
             index_config = self._load_index_config(config_name)
-            index_config["mappings"]["properties"]["embedding"][
-                "dimension"
-            ] = st.session_state.config.opensearch_config.embedding_dimension
+            embedding_mapping = index_config["mappings"]["properties"]["embedding"]
+            embedding_mapping["dimension"] = (
+                self.config.opensearch_config.index_dimension
+            )
+            embedding_mapping["space_type"] = self.config.opensearch_config.space_type
+            method_parameters = {
+                "m": self.index_profile.m,
+                "ef_construction": self.index_profile.ef_construction,
+            }
+            if self.index_profile.vector_encoding == "fp16":
+                method_parameters["encoder"] = {
+                    "name": "sq",
+                    "parameters": {"type": "fp16"},
+                }
+            elif self.index_profile.vector_encoding == "byte":
+                embedding_mapping["data_type"] = "byte"
+            embedding_mapping["method"]["parameters"] = method_parameters
+            index_config["settings"]["index"][
+                "knn.algo_param.ef_search"
+            ] = self.index_profile.ef_search
             self.client.indices.create(index=index, body=index_config)
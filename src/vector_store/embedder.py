@@ -1,14 +1,26 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import numpy as np
-import streamlit as st
+import requests
 
-from typing import List
-from openai import OpenAI
+from pathlib import Path
+from typing import List, Optional
+from openai import APIConnectionError, OpenAI
 from abc import ABC, abstractmethod
 from huggingface_hub import InferenceClient
 from sentence_transformers import SentenceTransformer
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception,
+    wait_random_exponential,
+    stop_after_attempt,
+)
+
+from common.config import EmbeddingCacheConfig
+from common.constants import DEFAULT_EMBEDDING_MODEL_CACHE_DIR
 
 
 class Embedder(ABC):
@@ -18,16 +30,16 @@ class Embedder(ABC):
 
 
 class SentenceTransformerEmbedder(Embedder):
-    def __init__(self, model_identifier: str, trust_remote_code=False):
-        self.embedder = self._load_pretrained_mode(model_identifier, trust_remote_code)
+    def __init__(self, model_identifier: str, cache_dir: Path, trust_remote_code=False):
+        self.embedder = self._load_pretrained_mode(
+            model_identifier, cache_dir, trust_remote_code
+        )
 
     @staticmethod
     def _load_pretrained_mode(
-        model_identifier: str, trust_remote_code: bool = False
+        model_identifier: str, cache_dir: Path, trust_remote_code: bool = False
     ) -> SentenceTransformer:
-        pretrained_model_dir = (
-            st.session_state.config.embedding_model_config.cache_dir / model_identifier
-        )
+        pretrained_model_dir = cache_dir / model_identifier
         if not pretrained_model_dir.exists():
             embedder = SentenceTransformer(
                 model_name_or_path=model_identifier,
@@ -44,44 +56,160 @@ class SentenceTransformerEmbedder(Embedder):
         return encoding
 
 
-class HFAPIEmbedder(Embedder):
-    def __init__(self, model_identifier: str):
-        hf_api_token = os.getenv("LLM_CHAT_APP_HF_API_TOKEN")
-        self.embedder = InferenceClient(model_identifier, token=hf_api_token)
-
-    def encode(self, sentences: List[str]) -> np.array:
-        encoding = [
-            self.embedder.feature_extraction(sentence) for sentence in sentences
-        ]
-        encoding = np.asarray(encoding)
-        return encoding
+def _get_retry_after(exception: BaseException) -> Optional[float]:
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_status_code(exception: BaseException) -> Optional[int]:
+    status_code = getattr(exception, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(exception, "response", None), "status_code", None)
+    return status_code
+
+
+# Only rate limits, server errors and failed connections are worth another attempt. Client errors, e.g. a wrong
+# api key or an input longer than the model accepts, fail the same way every time.
+def is_retryable_error(exception: BaseException) -> bool:
+    status_code = _get_status_code(exception)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(
+        exception,
+        (
+            ConnectionError,
+            TimeoutError,
+            requests.ConnectionError,
+            requests.Timeout,
+            APIConnectionError,
+        ),
+    )
+
+
+_wait_exponential = wait_random_exponential(min=1, max=20)
+
+
+# Rate limited responses tell us how long to wait through the Retry-After header.
+# If it is not present, fall back to a random exponential backoff.
+def wait_for_rate_limit(retry_state: RetryCallState) -> float:
+    retry_after = _get_retry_after(retry_state.outcome.exception())
+    if retry_after is not None:
+        return retry_after
+    return _wait_exponential(retry_state)
+
+
+# The last error is raised as it is once the attempts are used up.
+retry_api_request = retry(
+    retry=retry_if_exception(is_retryable_error),
+    wait=wait_for_rate_limit,
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+
+
+# Base class for embedders backed by a remote API. Sentences are packed into batches of request_batch_size,
+# which are sent concurrently through a bounded thread pool. The output order matches the input order.
+class BatchedAPIEmbedder(Embedder):
+    def __init__(self, request_batch_size: int = 64, max_concurrent_requests: int = 4):
+        self.request_batch_size = request_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_requests)
 
+    @abstractmethod
+    def encode_batch(self, sentences: List[str]) -> np.array:
+        pass
 
-class OpenAIEmbedder(Embedder):
-    def __init__(self, model_name: str = "text-embedding-3-small"):
-        self.client = OpenAI()
-        self.model = model_name
+    def encode(self, sentences: str | List[str]) -> np.array:
+        single_sentence = isinstance(sentences, str)
+        if single_sentence:
+            sentences = [sentences]
 
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
-    def get_embedding(self, text: str) -> list[float]:
-        return (
-            self.client.embeddings.create(input=[text], model=self.model)
-            .data[0]
-            .embedding
+        batches = [
+            sentences[i : i + self.request_batch_size]
+            for i in range(0, len(sentences), self.request_batch_size)
+        ]
+        encodings = [
+            np.asarray(encoding)
+            for encoding in self.executor.map(self.encode_batch, batches)
+        ]
+        if len(encodings) == 0:
+            return np.empty((0,))
+        encoding = np.concatenate(encodings)
+        return encoding[0] if single_sentence else encoding
+
+
+class HFAPIEmbedder(BatchedAPIEmbedder):
+    def __init__(
+        self,
+        model_identifier: str,
+        base_url: Optional[str] = None,
+        request_batch_size: int = 64,
+        max_concurrent_requests: int = 4,
+    ):
+        super().__init__(request_batch_size, max_concurrent_requests)
+        hf_api_token = os.getenv("LLM_CHAT_APP_HF_API_TOKEN")
+        self.embedder = InferenceClient(
+            base_url or model_identifier, token=hf_api_token
         )
 
-    def encode(self, sentences: List[str]) -> np.array:
-        encoding = [self.get_embedding(sentence) for sentence in sentences]
-        encoding = np.asarray(encoding)
-        return encoding
-
+    # the feature extraction endpoint accepts a list of inputs and returns one embedding per input
+    @retry_api_request
+    def encode_batch(self, sentences: List[str]) -> np.array:
+        return self.embedder.feature_extraction(sentences)
+
+
+class OpenAIEmbedder(BatchedAPIEmbedder):
+    def __init__(
+        self,
+        model_name: str = "text-embedding-3-small",
+        base_url: Optional[str] = None,
+        request_batch_size: int = 64,
+        max_concurrent_requests: int = 4,
+    ):
+        super().__init__(request_batch_size, max_concurrent_requests)
+        # the retries are left to encode_batch, the client would otherwise retry every attempt again
+        self.client = OpenAI(base_url=base_url, max_retries=0)
+        self.model = model_name
 
-def load_embedder(provider: str, model_name: str) -> Embedder:
+    @retry_api_request
+    def encode_batch(self, sentences: List[str]) -> np.array:
+        response = self.client.embeddings.create(input=sentences, model=self.model)
+        embeddings = sorted(response.data, key=lambda embedding: embedding.index)
+        return np.asarray([embedding.embedding for embedding in embeddings])
+
+
+def load_embedder(
+    provider: str,
+    model_name: str,
+    cache_config: Optional[EmbeddingCacheConfig] = None,
+    base_url: Optional[str] = None,
+    request_batch_size: int = 64,
+    max_concurrent_requests: int = 4,
+    model_cache_dir: Path = DEFAULT_EMBEDDING_MODEL_CACHE_DIR,
+    trust_remote_code: bool = False,
+) -> Embedder:
     if provider == "sentence_transformer":
-        return SentenceTransformerEmbedder(model_name)
+        embedder = SentenceTransformerEmbedder(
+            model_name, model_cache_dir, trust_remote_code
+        )
     elif provider == "hf_api":
-        return HFAPIEmbedder(model_name)
+        embedder = HFAPIEmbedder(
+            model_name, base_url, request_batch_size, max_concurrent_requests
+        )
     elif provider == "open_ai":
-        return OpenAIEmbedder(model_name)
+        embedder = OpenAIEmbedder(
+            model_name, base_url, request_batch_size, max_concurrent_requests
+        )
     else:
         print(f"No embedder implemented for {provider=}")
+        return
+
+    if cache_config is not None and cache_config.enabled:
+        # imported here, as the cache module itself depends on the Embedder base class
+        from vector_store.embedding_cache import CachedEmbedder
+
+        embedder = CachedEmbedder(embedder, provider, model_name, cache_config)
+    return embedder
@@ -0,0 +1,209 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+import numpy as np
+from pydantic import BaseModel
+
+from common.config import EmbeddingCacheConfig
+from vector_store.embedder import Embedder
+
+
+class EmbeddingCacheStats(BaseModel):
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0
+
+
+# Content addressed cache in front of an embedder. Vectors are keyed by (provider, model_name, text hash)
+# and stored as raw float32 blobs in sqlite, with a bounded in-memory LRU tier on top.
+# When the disk tier grows beyond its size limit, the least recently accessed vectors are evicted.
+class CachedEmbedder(Embedder):
+    def __init__(
+        self,
+        embedder: Embedder,
+        provider: str,
+        model_name: str,
+        cache_config: EmbeddingCacheConfig,
+    ):
+        self.embedder = embedder
+        self.provider = provider
+        self.model_name = model_name
+        self.memory_cache_size = cache_config.memory_cache_size
+        self.max_disk_size_bytes = cache_config.max_disk_size_mb * 1024 * 1024
+        self.stats = EmbeddingCacheStats()
+
+        self._memory_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+        cache_config.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            cache_config.cache_dir / "embeddings.db", check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._create_table()
+        self._disk_size_bytes = self._read_disk_size()
+
+    def _create_table(self):
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings(
+                    provider TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (provider, model_name, text_hash)
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)"
+            )
+
+    def _read_disk_size(self) -> int:
+        row = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings"
+        ).fetchone()
+        return row[0]
+
+    @staticmethod
+    def _hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _remember(self, text_hash: str, embedding: np.ndarray):
+        self._memory_cache[text_hash] = embedding
+        self._memory_cache.move_to_end(text_hash)
+        while len(self._memory_cache) > self.memory_cache_size:
+            self._memory_cache.popitem(last=False)
+
+    def _read_from_disk(self, text_hashes: List[str]) -> Dict[str, np.ndarray]:
+        embeddings = {}
+        # stay below the sqlite limit on the number of query parameters
+        for i in range(0, len(text_hashes), 500):
+            batch = text_hashes[i : i + 500]
+            rows = self._conn.execute(
+                f"""
+                SELECT text_hash, embedding FROM embeddings
+                WHERE provider = ? AND model_name = ? AND text_hash IN ({",".join("?" * len(batch))})
+                """,
+                (self.provider, self.model_name, *batch),
+            ).fetchall()
+            for text_hash, blob in rows:
+                embeddings[text_hash] = np.frombuffer(blob, dtype=np.float32)
+        if embeddings:
+            now = time.time()
+            with self._conn:
+                self._conn.executemany(
+                    """
+                    UPDATE embeddings SET last_access = ?
+                    WHERE provider = ? AND model_name = ? AND text_hash = ?
+                    """,
+                    [
+                        (now, self.provider, self.model_name, text_hash)
+                        for text_hash in embeddings
+                    ],
+                )
+        return embeddings
+
+    def _write_to_disk(self, embeddings: Dict[str, np.ndarray]):
+        now = time.time()
+        rows = [
+            (self.provider, self.model_name, text_hash, embedding.tobytes(), now)
+            for text_hash, embedding in embeddings.items()
+        ]
+        with self._conn:
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO embeddings (provider, model_name, text_hash, embedding, last_access)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+        self._disk_size_bytes += sum(len(row[3]) for row in rows)
+        if self._disk_size_bytes > self.max_disk_size_bytes:
+            self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        # evict down to 90% of the limit, so that eviction does not run on every write
+        target_size_bytes = int(self.max_disk_size_bytes * 0.9)
+        with self._conn:
+            while self._disk_size_bytes > target_size_bytes:
+                rows = self._conn.execute(
+                    """
+                    SELECT rowid, LENGTH(embedding) FROM embeddings
+                    ORDER BY last_access ASC LIMIT 1000
+                    """
+                ).fetchall()
+                if not rows:
+                    self._disk_size_bytes = 0
+                    break
+                evicted_row_ids = []
+                for row_id, size_bytes in rows:
+                    evicted_row_ids.append((row_id,))
+                    self._disk_size_bytes -= size_bytes
+                    if self._disk_size_bytes <= target_size_bytes:
+                        break
+                self._conn.executemany(
+                    "DELETE FROM embeddings WHERE rowid = ?", evicted_row_ids
+                )
+
+    def encode(self, sentences: str | List[str]) -> np.array:
+        single_sentence = isinstance(sentences, str)
+        if single_sentence:
+            sentences = [sentences]
+        if len(sentences) == 0:
+            return np.empty((0,), dtype=np.float32)
+
+        text_hashes = [self._hash_text(sentence) for sentence in sentences]
+        embeddings: Dict[str, np.ndarray] = {}
+
+        with self._lock:
+            for text_hash in text_hashes:
+                if text_hash in embeddings:
+                    continue
+                embedding = self._memory_cache.get(text_hash)
+                if embedding is not None:
+                    self._memory_cache.move_to_end(text_hash)
+                    embeddings[text_hash] = embedding
+                    self.stats.memory_hits += 1
+
+            disk_lookup_hashes = list(
+                {h: None for h in text_hashes if h not in embeddings}
+            )
+            if disk_lookup_hashes:
+                disk_embeddings = self._read_from_disk(disk_lookup_hashes)
+                for text_hash, embedding in disk_embeddings.items():
+                    self._remember(text_hash, embedding)
+                embeddings.update(disk_embeddings)
+                self.stats.disk_hits += len(disk_embeddings)
+
+        missing_sentences = {}
+        for text_hash, sentence in zip(text_hashes, sentences):
+            if text_hash not in embeddings:
+                missing_sentences[text_hash] = sentence
+
+        if missing_sentences:
+            new_embeddings = np.asarray(
+                self.embedder.encode(list(missing_sentences.values())),
+                dtype=np.float32,
+            )
+            new_embeddings = dict(zip(missing_sentences.keys(), new_embeddings))
+            with self._lock:
+                self.stats.misses += len(new_embeddings)
+                for text_hash, embedding in new_embeddings.items():
+                    self._remember(text_hash, embedding)
+                self._write_to_disk(new_embeddings)
+            embeddings.update(new_embeddings)
+
+        encoding = np.stack([embeddings[text_hash] for text_hash in text_hashes])
+        return encoding[0] if single_sentence else encoding
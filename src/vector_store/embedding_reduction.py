@@ -0,0 +1,175 @@
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from common.config import EmbeddingReductionConfig, LLMChatConfig, OpenSearchConfig
+
+PCA_PROJECTION_FILE_NAME = "pca_projection.npz"
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# Score of the OpenSearch innerproduct space for faiss, which has to be positive.
+def innerproduct_score(inner_product: np.ndarray | float) -> np.ndarray | float:
+    return np.where(
+        inner_product >= 0, 1 + inner_product, 1 / (1 - np.minimum(inner_product, 0))
+    )
+
+
+# The confidence threshold is configured as a score of the l2 space, 1 / (1 + squared distance), for float vectors.
+# For normalized vectors the squared distance is 2 - 2 * inner product, which gives the score of the same threshold
+# in the innerproduct space. scale is the factor the stored vectors are multiplied by, e.g. for byte encoding.
+def knn_score_threshold(
+    score_threshold: float, space_type: str, scale: float = 1.0
+) -> float:
+    if score_threshold <= 0:
+        return score_threshold
+    squared_distance = 1 / score_threshold - 1
+    if space_type == "innerproduct":
+        inner_product = (1 - squared_distance / 2) * scale**2
+        return float(innerproduct_score(inner_product))
+    return 1 / (1 + squared_distance * scale**2)
+
+
+class EmbeddingReducer(ABC):
+    @abstractmethod
+    def reduce(self, embeddings: np.ndarray) -> np.ndarray:
+        pass
+
+
+# Models trained with a matryoshka loss, e.g. nomic-embed-text-v1.5, keep most of the information in the
+# leading dimensions, so the truncated embeddings stay useful without any fitting.
+class MatryoshkaReducer(EmbeddingReducer):
+    def __init__(self, dimension: int):
+        self.dimension = dimension
+
+    def reduce(self, embeddings: np.ndarray) -> np.ndarray:
+        return embeddings[..., : self.dimension]
+
+
+# Projects the embeddings on the principal components of a corpus sample. Works for any model, but the
+# projection has to be fitted before the first document is indexed and stays fixed for the index.
+class PCAReducer(EmbeddingReducer):
+    def __init__(
+        self,
+        mean: np.ndarray,
+        components: np.ndarray,
+        explained_variance_ratio: float = 1.0,
+    ):
+        self.mean = mean.astype(np.float32)
+        self.components = components.astype(np.float32)
+        self.explained_variance_ratio = explained_variance_ratio
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray, dimension: int) -> "PCAReducer":
+        assert (
+            len(embeddings) >= dimension
+        ), f"The projection to {dimension=} needs at least as many sample embeddings, got {len(embeddings)}"
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        mean = embeddings.mean(axis=0)
+        centered = embeddings - mean
+        # the covariance matrix is only embedding_dimension x embedding_dimension, whatever the sample size
+        eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        order = np.argsort(eigenvalues)[::-1][:dimension]
+        explained_variance_ratio = eigenvalues[order].sum() / max(
+            eigenvalues.sum(), 1e-12
+        )
+        return cls(mean, eigenvectors[:, order].T, float(explained_variance_ratio))
+
+    def reduce(self, embeddings: np.ndarray) -> np.ndarray:
+        return (embeddings - self.mean) @ self.components.T
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            path,
+            mean=self.mean,
+            components=self.components,
+            explained_variance_ratio=self.explained_variance_ratio,
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "PCAReducer":
+        with np.load(path) as data:
+            return cls(
+                data["mean"],
+                data["components"],
+                float(data["explained_variance_ratio"]),
+            )
+
+
+# Directory of the fitted projection of an index, next to the index itself for the local backend.
+def embedding_reduction_dir(config: LLMChatConfig, backend: str) -> Path:
+    index_name = config.opensearch_config.index_name
+    if backend == "local":
+        return config.local_vector_store_config.storage_dir / index_name
+    return config.root_storage_dir / "embedding_reduction" / index_name
+
+
+def load_embedding_reducer(
+    reduction_config: EmbeddingReductionConfig,
+    embedding_dimension: int,
+    reduction_dir: Path,
+) -> Optional[EmbeddingReducer]:
+    if reduction_config.method is None:
+        return None
+    assert (
+        reduction_config.reduced_dimension is not None
+        and reduction_config.reduced_dimension <= embedding_dimension
+    ), f"{reduction_config.reduced_dimension=} has to be set, at most {embedding_dimension=}"
+    if reduction_config.method == "matryoshka":
+        return MatryoshkaReducer(reduction_config.reduced_dimension)
+    elif reduction_config.method == "pca":
+        projection_path = reduction_dir / PCA_PROJECTION_FILE_NAME
+        if not projection_path.exists():
+            raise FileNotFoundError(
+                f"No pca projection at {projection_path}, fit it on the corpus with "
+                f"`python -m pipelines.embedding_reduction_cli fit` before indexing"
+            )
+        reducer = PCAReducer.load(projection_path)
+        assert (
+            reducer.components.shape[0] == reduction_config.reduced_dimension
+        ), f"The projection at {projection_path} was fitted for {reducer.components.shape[0]} dimensions"
+        return reducer
+    else:
+        print(f"No embedding reduction implemented for {reduction_config.method=}")
+
+
+# Turns embeddings into the vectors of the index, for documents and queries alike: the reduction, then the
+# normalization. The pca projection is loaded on first use, as it may be fitted after the vector store was created.
+class EmbeddingTransform:
+    def __init__(self, opensearch_config: OpenSearchConfig, reduction_dir: Path):
+        self.reduction_config = opensearch_config.embedding_reduction_config
+        self.embedding_dimension = opensearch_config.embedding_dimension
+        self.normalize = opensearch_config.normalize_embeddings
+        self.reduction_dir = reduction_dir
+        self._reducer: Optional[EmbeddingReducer] = None
+        self._lock = threading.Lock()
+
+    @property
+    def reducer(self) -> Optional[EmbeddingReducer]:
+        if self._reducer is None and self.reduction_config.method is not None:
+            with self._lock:
+                if self._reducer is None:
+                    self._reducer = load_embedding_reducer(
+                        self.reduction_config,
+                        self.embedding_dimension,
+                        self.reduction_dir,
+                    )
+        return self._reducer
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.reduction_config.method is None and not self.normalize:
+            return embeddings
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self.reduction_config.method is not None:
+            vectors = self.reducer.reduce(vectors)
+        if self.normalize:
+            vectors = normalize_vectors(vectors)
+        return vectors
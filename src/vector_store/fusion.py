@@ -0,0 +1,62 @@
+from typing import Dict, List, Tuple
+
+from data.data_classes import VectorDocumentChunk
+
+
+# Reciprocal rank fusion only looks at the rank of a document in each result list,
+# so lexical (BM25) and vector scores don't need to be on the same scale.
+def reciprocal_rank_fusion(
+    ranked_ids: List[List[str]], weights: List[float], rrf_k: int = 60
+) -> Dict[str, float]:
+    fused_scores = {}
+    for ids, weight in zip(ranked_ids, weights):
+        for rank, doc_id in enumerate(ids):
+            fused_scores[doc_id] = fused_scores.get(doc_id, 0.0) + weight / (
+                rrf_k + rank + 1
+            )
+    return fused_scores
+
+
+# Scores of each result list are min-max normalized to [0, 1] before they are weighted and summed.
+def weighted_score_fusion(
+    scored_ids: List[List[Tuple[str, float]]], weights: List[float]
+) -> Dict[str, float]:
+    fused_scores = {}
+    for results, weight in zip(scored_ids, weights):
+        if len(results) == 0:
+            continue
+        scores = [score for _, score in results]
+        min_score, max_score = min(scores), max(scores)
+        score_range = max_score - min_score
+        for doc_id, score in results:
+            normalized_score = (
+                (score - min_score) / score_range if score_range > 0 else 1.0
+            )
+            fused_scores[doc_id] = fused_scores.get(doc_id, 0.0) + (
+                weight * normalized_score
+            )
+    return fused_scores
+
+
+def fuse_results(
+    results: List[List[Tuple[VectorDocumentChunk, float]]],
+    weights: List[float],
+    fusion_method: str,
+    top_k: int,
+    rrf_k: int = 60,
+) -> List[VectorDocumentChunk]:
+    documents = {doc.id: doc for result in results for doc, _ in result}
+    if fusion_method == "rrf":
+        fused_scores = reciprocal_rank_fusion(
+            [[doc.id for doc, _ in result] for result in results], weights, rrf_k
+        )
+    elif fusion_method == "weighted":
+        fused_scores = weighted_score_fusion(
+            [[(doc.id, score) for doc, score in result] for result in results],
+            weights,
+        )
+    else:
+        raise ValueError(f"Unknown {fusion_method=}")
+
+    ranked_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)
+    return [documents[doc_id] for doc_id in ranked_ids[:top_k]]
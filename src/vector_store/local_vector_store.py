@@ -0,0 +1,562 @@
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from common.config import LLMChatConfig
+from common.model_registry import ModelRegistry
+from data.data_classes import SearchFilter, VectorDocumentChunk
+from vector_store.base_vector_store import VectorStore
+from vector_store.embedding_reduction import innerproduct_score, knn_score_threshold
+
+# rows of a segment converted to float32 at a time by a full scan, so that the copy stays small and in cache
+_SCAN_BLOCK_ROWS = 4096
+
+
+# Vectors are appended to fixed size, memory mapped segment files. Segments are never resized,
+# so mappings stay valid while new vectors are added.
+class VectorSegments:
+    def __init__(
+        self, storage_dir: Path, dimension: int, dtype: str, segment_size: int
+    ):
+        self.storage_dir = storage_dir
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.segment_size = segment_size
+        self.segments: List[np.memmap] = []
+        while self._segment_path(len(self.segments)).exists():
+            self.segments.append(self._open_segment(len(self.segments)))
+
+    def _segment_path(self, segment_idx: int) -> Path:
+        return self.storage_dir / f"vectors_{segment_idx:05d}.bin"
+
+    def _open_segment(self, segment_idx: int) -> np.memmap:
+        segment_path = self._segment_path(segment_idx)
+        return np.memmap(
+            segment_path,
+            dtype=self.dtype,
+            mode="r+" if segment_path.exists() else "w+",
+            shape=(self.segment_size, self.dimension),
+        )
+
+    def write(self, start_row: int, vectors: np.ndarray):
+        written = 0
+        while written < len(vectors):
+            segment_idx, offset = divmod(start_row + written, self.segment_size)
+            while segment_idx >= len(self.segments):
+                self.segments.append(self._open_segment(len(self.segments)))
+            count = min(self.segment_size - offset, len(vectors) - written)
+            self.segments[segment_idx][offset : offset + count] = vectors[
+                written : written + count
+            ]
+            self.segments[segment_idx].flush()
+            written += count
+
+    def blocks(self, num_rows: int):
+        for segment_idx, segment in enumerate(self.segments):
+            start_row = segment_idx * self.segment_size
+            if start_row >= num_rows:
+                break
+            yield start_row, segment[: min(self.segment_size, num_rows - start_row)]
+
+    def take(self, rows: np.ndarray) -> np.ndarray:
+        vectors = np.empty((len(rows), self.dimension), dtype=np.float32)
+        segment_ids, offsets = np.divmod(rows, self.segment_size)
+        for segment_idx in np.unique(segment_ids):
+            mask = segment_ids == segment_idx
+            vectors[mask] = self.segments[segment_idx][offsets[mask]]
+        return vectors
+
+
+# Approximate search for large corpora: vectors are clustered with k-means and only the lists of the
+# clusters closest to the query are scanned exactly. The assignments of added vectors are appended to a raw
+# int32 file, so saving after a batch writes the batch only.
+class IVFIndex:
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray):
+        self.centroids = centroids
+        self.assignments = assignments
+        self._inverted_lists: Optional[List[np.ndarray]] = None
+        self._num_saved_assignments = 0
+
+    @classmethod
+    def train(
+        cls,
+        segments: VectorSegments,
+        num_rows: int,
+        num_lists: int,
+        num_iterations: int = 10,
+        sample_size_per_list: int = 64,
+    ) -> "IVFIndex":
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(
+            rng.choice(
+                num_rows,
+                size=min(num_rows, num_lists * sample_size_per_list),
+                replace=False,
+            )
+        )
+        sample = segments.take(sample_rows)
+        # a configured ivf_num_lists may exceed the number of vectors
+        num_lists = min(num_lists, len(sample))
+        centroids = sample[rng.choice(len(sample), size=num_lists, replace=False)]
+        for _ in range(num_iterations):
+            sample_assignments = cls._nearest_centroids(sample, centroids)
+            for list_idx in range(num_lists):
+                members = sample[sample_assignments == list_idx]
+                if len(members) > 0:
+                    centroids[list_idx] = members.mean(axis=0)
+
+        index = cls(centroids, np.empty((0,), dtype=np.int32))
+        for _, block in segments.blocks(num_rows):
+            index.add(np.asarray(block, dtype=np.float32))
+        return index
+
+    @staticmethod
+    def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # the norm of the vectors themselves does not change the ranking
+        distances = np.sum(centroids**2, axis=1)[None, :] - 2 * vectors @ centroids.T
+        return np.argmin(distances, axis=1).astype(np.int32)
+
+    def add(self, vectors: np.ndarray):
+        self.assignments = np.concatenate(
+            [self.assignments, self._nearest_centroids(vectors, self.centroids)]
+        )
+        self._inverted_lists = None
+
+    def candidate_rows(self, query: np.ndarray, num_probes: int) -> np.ndarray:
+        if self._inverted_lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            boundaries = np.searchsorted(
+                self.assignments[order], np.arange(len(self.centroids) + 1)
+            )
+            self._inverted_lists = [
+                order[boundaries[i] : boundaries[i + 1]]
+                for i in range(len(self.centroids))
+            ]
+        centroid_distances = np.sum((self.centroids - query) ** 2, axis=1)
+        probes = np.argsort(centroid_distances)[:num_probes]
+        return np.sort(np.concatenate([self._inverted_lists[i] for i in probes]))
+
+    # The centroids and all assignments are written after training, later only the new assignments.
+    def save(self, storage_dir: Path):
+        if self._num_saved_assignments == 0:
+            np.save(storage_dir / "ivf_centroids.npy", self.centroids)
+        with open(
+            storage_dir / "ivf_assignments.bin",
+            "ab" if self._num_saved_assignments else "wb",
+        ) as assignments_file:
+            self.assignments[self._num_saved_assignments :].tofile(assignments_file)
+        self._num_saved_assignments = len(self.assignments)
+
+    # The saved assignments are brought in line with the indexed rows, they miss the last batch if the process
+    # stopped before they were saved.
+    @classmethod
+    def load(
+        cls, storage_dir: Path, segments: VectorSegments, num_rows: int
+    ) -> Optional["IVFIndex"]:
+        centroids_path = storage_dir / "ivf_centroids.npy"
+        if not centroids_path.exists():
+            return None
+        assignments = np.fromfile(storage_dir / "ivf_assignments.bin", dtype=np.int32)
+        index = cls(np.load(centroids_path), assignments[:num_rows])
+        index._num_saved_assignments = len(index.assignments)
+        if len(assignments) != num_rows:
+            if len(assignments) < num_rows:
+                index.add(segments.take(np.arange(len(assignments), num_rows)))
+            else:
+                index._num_saved_assignments = 0
+            index.save(storage_dir)
+        return index
+
+
+# Returns the sql condition of the chunks in the scope of the filter and its parameters, for the vector and the
+# lexical search.
+def _filter_clause(search_filter: SearchFilter) -> Tuple[str, list]:
+    conditions, params = [], []
+    if search_filter.file_names is not None:
+        conditions.append(
+            f"chunks.file_name IN ({','.join('?' * len(search_filter.file_names))})"
+        )
+        params.extend(search_filter.file_names)
+    for condition, value in (
+        ("chunks.page_num >= ?", search_filter.min_page_num),
+        ("chunks.page_num <= ?", search_filter.max_page_num),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    return " AND ".join(conditions) or "1", params
+
+
+# In-process vector store. Vectors live in memory mapped float32/float16 segment files and the chunk metadata
+# in sqlite. Small corpora are searched exactly with NumPy, larger ones through an IVF index.
+# Scores follow the OpenSearch l2 or innerproduct space, so the same confidence threshold applies.
+# Filtered searches scan only the rows in scope, exactly if there are few enough of them, like the efficient
+# filtering of OpenSearch.
+class LocalVectorDB(VectorStore):
+    backend = "local"
+
+    def __init__(self, config: LLMChatConfig, model_registry: ModelRegistry):
+        super().__init__(config, model_registry)
+        self.space_type = config.opensearch_config.space_type
+        local_config = config.local_vector_store_config
+        self.storage_dir = (
+            local_config.storage_dir / config.opensearch_config.index_name
+        )
+        self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.exact_search_max_vectors = local_config.exact_search_max_vectors
+        self.ivf_num_lists = local_config.ivf_num_lists
+        self.ivf_num_probes = local_config.ivf_num_probes
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            self.storage_dir / "metadata.db", check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._create_table()
+
+        self.segments = VectorSegments(
+            self.storage_dir,
+            config.opensearch_config.index_dimension,
+            local_config.vector_dtype,
+            local_config.segment_size,
+        )
+        self.num_rows = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        self.deleted = np.zeros(self.num_rows, dtype=bool)
+        deleted_rows = self._conn.execute(
+            "SELECT row_idx FROM chunks WHERE deleted = 1"
+        ).fetchall()
+        self.deleted[[row[0] for row in deleted_rows]] = True
+        self.norms = np.concatenate(
+            [np.zeros(0, dtype=np.float32)]
+            + [
+                np.sum(np.asarray(block, dtype=np.float32) ** 2, axis=1)
+                for _, block in self.segments.blocks(self.num_rows)
+            ]
+        )
+        self.ivf_index = IVFIndex.load(self.storage_dir, self.segments, self.num_rows)
+
+    def _create_table(self):
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chunks(
+                    row_idx INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    page_num INTEGER NOT NULL,
+                    start_idx INTEGER NOT NULL,
+                    paginated_text INTEGER NOT NULL,
+                    file_name TEXT NOT NULL,
+                    deleted INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_id ON chunks(id)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chunks_file_name ON chunks(file_name)"
+            )
+            # full text index over the chunk texts, used for the lexical part of hybrid search
+            fts_table_exists = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'"
+            ).fetchone()
+            self._conn.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts
+                USING fts5(text, content='chunks', content_rowid='row_idx')
+                """
+            )
+            if not fts_table_exists:
+                self._conn.execute(
+                    "INSERT INTO chunks_fts(chunks_fts) VALUES('rebuild')"
+                )
+
+    def index_documents(
+        self, documents: List[VectorDocumentChunk], embeddings: List[List[float]]
+    ) -> int:
+        # the vectors as stored, so that the norms and ivf assignments of float16 vectors match the searched ones
+        vectors = (
+            np.asarray(embeddings, dtype=np.float32)
+            .astype(self.segments.dtype)
+            .astype(np.float32)
+        )
+        with self._lock:
+            start_row = self.num_rows
+            # re-indexing a chunk id replaces the previous version, as in OpenSearch
+            replaced_rows = self._find_rows([doc.id for doc in documents])
+            self.segments.write(start_row, vectors)
+            with self._conn:
+                if replaced_rows:
+                    self._conn.executemany(
+                        "UPDATE chunks SET deleted = 1 WHERE row_idx = ?",
+                        [(row,) for row in replaced_rows],
+                    )
+                self._conn.executemany(
+                    """
+                    INSERT INTO chunks (row_idx, id, text, page_num, start_idx, paginated_text, file_name)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            start_row + i,
+                            doc.id,
+                            doc.text,
+                            doc.page_num,
+                            doc.start_idx,
+                            doc.paginated_text,
+                            doc.file_name,
+                        )
+                        for i, doc in enumerate(documents)
+                    ],
+                )
+                self._conn.executemany(
+                    "INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)",
+                    [(start_row + i, doc.text) for i, doc in enumerate(documents)],
+                )
+            self.deleted = np.concatenate(
+                [self.deleted, np.zeros(len(documents), dtype=bool)]
+            )
+            self.deleted[replaced_rows] = True
+            self.norms = np.concatenate([self.norms, np.sum(vectors**2, axis=1)])
+            self.num_rows += len(documents)
+            self._update_ivf_index(vectors)
+        return 0
+
+    def get_document_ids(self, file_name: str) -> Set[str]:
+        with self._lock:
+            return {
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT id FROM chunks WHERE deleted = 0 AND file_name = ?",
+                    (file_name,),
+                ).fetchall()
+            }
+
+    # Deleted rows are only masked, their vectors stay in the segment files.
+    def delete_documents(self, ids: List[str]) -> int:
+        with self._lock:
+            deleted_rows = self._find_rows(ids)
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE chunks SET deleted = 1 WHERE row_idx = ?",
+                    [(row,) for row in deleted_rows],
+                )
+            # searches use the mask outside of the lock, so it is replaced instead of updated in place
+            deleted = self.deleted.copy()
+            deleted[deleted_rows] = True
+            self.deleted = deleted
+        return len(deleted_rows)
+
+    def _find_rows(self, ids: List[str]) -> List[int]:
+        rows = []
+        for i in range(0, len(ids), 500):
+            batch = ids[i : i + 500]
+            rows.extend(
+                row[0]
+                for row in self._conn.execute(
+                    f"SELECT row_idx FROM chunks WHERE deleted = 0 AND id IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+            )
+        return rows
+
+    def _update_ivf_index(self, vectors: np.ndarray):
+        if self.ivf_index is not None and self.num_rows <= 4 * len(
+            self.ivf_index.assignments
+        ):
+            self.ivf_index.add(vectors)
+        elif self.num_rows > self.exact_search_max_vectors:
+            # (re)train once the corpus outgrows exact search, or grew a lot since the last training
+            num_lists = self.ivf_num_lists or int(np.sqrt(self.num_rows))
+            self.ivf_index = IVFIndex.train(self.segments, self.num_rows, num_lists)
+        else:
+            return
+        self.ivf_index.save(self.storage_dir)
+
+    # Squared distances in the l2 space, negated inner products in the innerproduct space, smaller is closer.
+    def _distances(
+        self, vectors: np.ndarray, norms: np.ndarray, query: np.ndarray
+    ) -> np.ndarray:
+        if self.space_type == "innerproduct":
+            return -(vectors @ query)
+        return np.maximum(norms - 2 * vectors @ query + query @ query, 0.0)
+
+    # Rows of the chunks in the scope of the filter, deleted chunks are never in scope.
+    def _filtered_rows(self, search_filter: SearchFilter) -> np.ndarray:
+        filter_clause, params = _filter_clause(search_filter)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT row_idx FROM chunks WHERE deleted = 0 AND {filter_clause}",
+                params,
+            ).fetchall()
+        return np.array([row[0] for row in rows], dtype=np.int64)
+
+    def _nearest_rows(
+        self,
+        query: np.ndarray,
+        top_k: int,
+        num_rows: int,
+        deleted: np.ndarray,
+        filtered_rows: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        if filtered_rows is not None and (
+            self.ivf_index is None
+            or len(filtered_rows) <= self.exact_search_max_vectors
+        ):
+            candidate_rows = filtered_rows[filtered_rows < num_rows]
+            distances = self._distances(
+                self.segments.take(candidate_rows), self.norms[candidate_rows], query
+            )
+        elif self.ivf_index is not None and num_rows > self.exact_search_max_vectors:
+            candidate_rows = self.ivf_index.candidate_rows(query, self.ivf_num_probes)
+            candidate_rows = candidate_rows[candidate_rows < num_rows]
+            candidate_rows = candidate_rows[~deleted[candidate_rows]]
+            if filtered_rows is not None:
+                candidate_rows = candidate_rows[
+                    np.isin(candidate_rows, filtered_rows, assume_unique=True)
+                ]
+            distances = self._distances(
+                self.segments.take(candidate_rows), self.norms[candidate_rows], query
+            )
+        else:
+            distances = np.empty(num_rows, dtype=np.float32)
+            for segment_start_row, segment in self.segments.blocks(num_rows):
+                # float32 segments are used in place, float16 ones are converted a few rows at a time
+                for offset in range(0, len(segment), _SCAN_BLOCK_ROWS):
+                    block = segment[offset : offset + _SCAN_BLOCK_ROWS]
+                    start_row = segment_start_row + offset
+                    distances[start_row : start_row + len(block)] = self._distances(
+                        np.asarray(block, dtype=np.float32),
+                        self.norms[start_row : start_row + len(block)],
+                        query,
+                    )
+            distances[deleted] = np.inf
+            candidate_rows = np.arange(num_rows)
+
+        top_k = min(top_k, len(candidate_rows))
+        if top_k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top_idx = np.argpartition(distances, top_k - 1)[:top_k]
+        top_idx = top_idx[np.argsort(distances[top_idx])]
+        top_idx = top_idx[np.isfinite(distances[top_idx])]
+        return candidate_rows[top_idx], distances[top_idx]
+
+    def _fetch_documents(self, rows: List[int]) -> List[VectorDocumentChunk]:
+        with self._lock:
+            metadata = {
+                row[0]: row[1:]
+                for row in self._conn.execute(
+                    f"""
+                    SELECT row_idx, id, text, page_num, start_idx, paginated_text, file_name
+                    FROM chunks WHERE row_idx IN ({','.join('?' * len(rows))})
+                    """,
+                    rows,
+                ).fetchall()
+            }
+        retrieved_documents = []
+        for row in rows:
+            doc_id, text, page_num, start_idx, paginated_text, file_name = metadata[row]
+            retrieved_documents.append(
+                VectorDocumentChunk(
+                    id=doc_id,
+                    text=text,
+                    page_num=page_num,
+                    start_idx=start_idx,
+                    paginated_text=bool(paginated_text),
+                    file_name=file_name,
+                )
+            )
+        return retrieved_documents
+
+    def _vector_hits(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[Tuple[VectorDocumentChunk, float]]:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        with self._lock:
+            num_rows, deleted = self.num_rows, self.deleted
+        filtered_rows = None
+        if search_filter is not None:
+            filtered_rows = self._filtered_rows(search_filter)
+
+        rows, distances = self._nearest_rows(
+            query, top_k, num_rows, deleted, filtered_rows
+        )
+        if self.space_type == "innerproduct":
+            scores = innerproduct_score(-distances)
+        else:
+            scores = 1.0 / (1.0 + distances)
+        score_threshold = knn_score_threshold(score_threshold, self.space_type)
+        hits = [
+            (int(row), float(score))
+            for row, score in zip(rows, scores)
+            if score > score_threshold
+        ]
+        if not hits:
+            return []
+        documents = self._fetch_documents([row for row, _ in hits])
+        return list(zip(documents, [score for _, score in hits]))
+
+    def _lexical_hits(
+        self,
+        query_text: str,
+        top_k: int,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[Tuple[VectorDocumentChunk, float]]:
+        # quote every term, so that user input can't be interpreted as fts5 query syntax
+        terms = re.findall(r"\w+", query_text)
+        if not terms:
+            return []
+        match_query = " OR ".join(f'"{term}"' for term in terms)
+        filter_clause, params = "", []
+        if search_filter is not None:
+            filter_clause, params = _filter_clause(search_filter)
+            filter_clause = " AND " + filter_clause
+        with self._lock:
+            hits = self._conn.execute(
+                f"""
+                SELECT chunks.row_idx, -bm25(chunks_fts) FROM chunks_fts
+                JOIN chunks ON chunks.row_idx = chunks_fts.rowid
+                WHERE chunks_fts MATCH ? AND chunks.deleted = 0{filter_clause}
+                ORDER BY bm25(chunks_fts) LIMIT ?
+                """,
+                (match_query, *params, top_k),
+            ).fetchall()
+        if not hits:
+            return []
+        documents = self._fetch_documents([row for row, _ in hits])
+        return list(zip(documents, [score for _, score in hits]))
+
+    def search_by_vector(
+        self,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> List[VectorDocumentChunk]:
+        return [
+            doc
+            for doc, _ in self._vector_hits(
+                query_embedding, top_k, score_threshold, search_filter
+            )
+        ]
+
+    def search_lexical_and_vector(
+        self,
+        query_text: str,
+        query_embedding: List[float],
+        top_k: int,
+        score_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple[
+        List[Tuple[VectorDocumentChunk, float]], List[Tuple[VectorDocumentChunk, float]]
+    ]:
+        return self._lexical_hits(query_text, top_k, search_filter), self._vector_hits(
+            query_embedding, top_k, score_threshold, search_filter
+        )
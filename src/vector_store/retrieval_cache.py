@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from data.data_classes import SearchFilter, VectorDocumentChunk
+
+
+def normalize_query(query_text: str) -> str:
+    return " ".join(query_text.casefold().split())
+
+
+# Caches search results keyed by the normalized query text and the search parameters.
+# Every entry remembers the generation of the index it was computed on. Adding documents bumps the generation,
+# which invalidates all entries computed before the upload.
+class RetrievalCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[
+            Tuple, Tuple[int, float, List[VectorDocumentChunk]]
+        ] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(
+        query_text: str,
+        top_k: int,
+        confidence_threshold: float,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> Tuple:
+        return (
+            normalize_query(query_text),
+            top_k,
+            confidence_threshold,
+            search_filter.model_dump_json() if search_filter is not None else None,
+        )
+
+    def get(self, key: Tuple) -> Optional[List[VectorDocumentChunk]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            generation, created_at, documents = entry
+            if (
+                generation != self.generation
+                or time.monotonic() - created_at > self.ttl_seconds
+            ):
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(documents)
+
+    def put(self, key: Tuple, documents: List[VectorDocumentChunk], generation: int):
+        with self._lock:
+            # results computed on an older generation of the index are never stored
+            if generation != self.generation:
+                return
+            self._entries[key] = (generation, time.monotonic(), list(documents))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
@@ -1,5 +1,9 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import fitz
 
@@ -12,6 +16,53 @@ def extract_text_pages_from_pdf(pdf_path: Path) -> List[str]:
     return pages
 
 
+# Runs in a worker process, every worker opens its own handle of the document.
+def _extract_text_page_range(
+    pdf_path: Path, start_page: int, end_page: int
+) -> List[str]:
+    with fitz.open(pdf_path) as doc:
+        return [doc[page_num].get_text() for page_num in range(start_page, end_page)]
+
+
+# Yields the text of the pages in order, while later page ranges are still being extracted by a process pool.
+# At most max_pending_tasks page ranges are submitted ahead of the consumer, which bounds the memory used
+# when chunking and embedding are slower than the extraction.
+def iter_text_pages_from_pdf(
+    pdf_path: Path,
+    parallel_min_pages: int = 64,
+    num_workers: Optional[int] = None,
+    pages_per_task: int = 16,
+    max_pending_tasks: int = 8,
+) -> Iterator[str]:
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    with fitz.open(pdf_path) as doc:
+        num_pages = doc.page_count
+        if num_pages < parallel_min_pages or num_workers < 2:
+            for page in doc:
+                yield page.get_text()
+            return
+
+    page_ranges = deque(
+        (start_page, min(start_page + pages_per_task, num_pages))
+        for start_page in range(0, num_pages, pages_per_task)
+    )
+    # workers are spawned instead of forked, as forking the multithreaded streamlit process is not safe
+    with ProcessPoolExecutor(
+        max_workers=min(num_workers, len(page_ranges)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        pending_tasks = deque()
+        while page_ranges or pending_tasks:
+            while page_ranges and len(pending_tasks) < max(max_pending_tasks, 1):
+                pending_tasks.append(
+                    executor.submit(
+                        _extract_text_page_range, pdf_path, *page_ranges.popleft()
+                    )
+                )
+            yield from pending_tasks.popleft().result()
+
+
 # split index is decided based on the nearest period(.) To have a smooth transition between the chunks.
 # if no period is found near the split index, then the preference is given to a new line,
 # and then a space has the least preference
@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from common.config import WebPageCacheConfig
+
+
+# Caches the text extracted from fetched pages on disk, keyed by the url. A page fetched longer than ttl_seconds
+# ago is treated as missing and is replaced by the next fetch; expired pages are deleted when the cache is opened.
+class WebPageCache:
+    def __init__(self, cache_config: WebPageCacheConfig):
+        self.ttl_seconds = cache_config.ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        cache_config.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            cache_config.cache_dir / "web_pages.db", check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._create_table()
+        self._delete_expired()
+
+    def _create_table(self):
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS web_pages(
+                    url TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _delete_expired(self):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM web_pages WHERE fetched_at < ?",
+                (time.time() - self.ttl_seconds,),
+            )
+
+    def get(self, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text FROM web_pages WHERE url = ? AND fetched_at >= ?",
+                (url, time.time() - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, url: str, text: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO web_pages (url, text, fetched_at) VALUES (?, ?, ?)",
+                (url, text, time.time()),
+            )
@@ -0,0 +1,305 @@
+import asyncio
+import codecs
+import ipaddress
+import socket
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from itertools import islice
+from typing import List, Optional
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.config import WebSearchConfig
+from common.tracing import tracer
+from data.data_classes import WebDocumentChunk, WebSearchResult
+from vector_store.chunker import iter_document_chunks
+from web_search.page_cache import WebPageCache
+
+# elements whose text is not part of the readable content of a page
+_SKIPPED_TAGS = {"head", "script", "style", "noscript", "template", "svg", "nav"}
+# elements that start a new line of text
+_BLOCK_TAGS = {
+    "address",
+    "article",
+    "blockquote",
+    "br",
+    "dd",
+    "div",
+    "dt",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "li",
+    "p",
+    "pre",
+    "section",
+    "table",
+    "td",
+    "th",
+    "tr",
+}
+_TEXT_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+_REDIRECT_STATUS_CODES = {301, 302, 303, 307, 308}
+
+
+class BlockedUrlError(requests.RequestException):
+    pass
+
+
+# Rejects the urls a search result could use to reach the machine of the app or its network: other schemes than
+# http(s) and hosts that resolve to a loopback, link-local, private or otherwise non-public address. The host is
+# resolved here and again by requests, a host that changes its records in between is not caught.
+def check_public_url(url: str):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise BlockedUrlError(f"Only http(s) urls with a host are fetched, got {url=}")
+    try:
+        addresses = socket.getaddrinfo(
+            parts.hostname, parts.port or 0, proto=socket.IPPROTO_TCP
+        )
+    except socket.gaierror as e:
+        raise requests.ConnectionError(f"Cannot resolve {parts.hostname}: {e}")
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if not address.is_global or address.is_multicast:
+            raise BlockedUrlError(
+                f"{parts.hostname} resolves to {address=}, which is not public"
+            )
+
+
+def _decode(content: bytes, encoding: Optional[str]) -> str:
+    try:
+        codecs.lookup(encoding)
+    except (LookupError, TypeError):
+        encoding = "utf-8"
+    return content.decode(encoding, errors="replace")
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag: str, attrs):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag: str):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data: str):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+# Returns the readable text of an html page, one line per block element with the whitespace collapsed.
+def extract_text_from_html(html: str) -> str:
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    lines = (" ".join(line.split()) for line in "".join(extractor.parts).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+class WebSearchEngine(ABC):
+    @abstractmethod
+    def search(self, query: str, num_results: int) -> List[WebSearchResult]:
+        pass
+
+
+# Queries the json api of a searxng instance, which aggregates the results of several search engines
+# and needs no api key.
+class SearxNGSearchEngine(WebSearchEngine):
+    def __init__(
+        self, search_url: str, timeout_seconds: float = 5.0, user_agent: str = ""
+    ):
+        self.search_url = search_url
+        self.timeout_seconds = timeout_seconds
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+
+    def search(self, query: str, num_results: int) -> List[WebSearchResult]:
+        response = self.session.get(
+            self.search_url,
+            params={"q": query, "format": "json"},
+            timeout=self.timeout_seconds,
+        )
+        response.raise_for_status()
+        return [
+            WebSearchResult(
+                url=result["url"],
+                title=result.get("title") or "",
+                snippet=result.get("content") or "",
+            )
+            for result in response.json().get("results", [])[:num_results]
+        ]
+
+
+# Retrieves web documents for a query: the result pages of the search engine are fetched concurrently through a
+# bounded thread pool, their text is extracted and chunked like the uploaded files. A page that is not fetched
+# within fetch_timeout_seconds, is too large or is no text is represented by the snippet of its search result.
+# Fetched pages are cached on disk, see `WebPageCache`.
+class WebRetriever:
+    def __init__(
+        self,
+        search_engine: WebSearchEngine,
+        config: WebSearchConfig,
+        page_cache: Optional[WebPageCache] = None,
+    ):
+        self.search_engine = search_engine
+        self.page_cache = page_cache
+        self.num_results = config.num_results
+        self.fetch_timeout_seconds = config.fetch_timeout_seconds
+        self.max_page_size_bytes = int(config.max_page_size_mb * 1024 * 1024)
+        self.max_redirects = config.max_redirects
+        self.allow_private_hosts = config.allow_private_hosts
+        self.chunk_size = config.chunk_size
+        self.overlap_ratio = config.overlap_ratio
+        self.max_chunks_per_page = config.max_chunks_per_page
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.max_concurrent_fetches, thread_name_prefix="web-fetch"
+        )
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = config.user_agent
+        adapter = HTTPAdapter(pool_maxsize=config.max_concurrent_fetches)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # Follows the redirects itself, so that every location is checked before it is requested.
+    def _get(self, url: str) -> requests.Response:
+        for _ in range(self.max_redirects + 1):
+            if not self.allow_private_hosts:
+                check_public_url(url)
+            response = self.session.get(
+                url,
+                timeout=self.fetch_timeout_seconds,
+                stream=True,
+                allow_redirects=False,
+            )
+            location = response.headers.get("Location")
+            if response.status_code not in _REDIRECT_STATUS_CODES or not location:
+                return response
+            response.close()
+            url = urljoin(url, location)
+        raise requests.TooManyRedirects(f"Exceeded {self.max_redirects} redirects")
+
+    def _download_page(self, url: str) -> Optional[str]:
+        # the timeout of requests applies to every read, the deadline bounds the complete download
+        deadline = time.monotonic() + self.fetch_timeout_seconds
+        with self._get(url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "")
+            if not content_type.startswith(_TEXT_CONTENT_TYPES):
+                print(f"Skipping {url=}, {content_type=} is not supported.")
+                return None
+            content = bytearray()
+            for block in response.iter_content(chunk_size=64 * 1024):
+                content += block
+                if len(content) > self.max_page_size_bytes:
+                    print(
+                        f"Skipping {url=}, it is larger than {self.max_page_size_bytes} bytes."
+                    )
+                    return None
+                if time.monotonic() > deadline:
+                    raise requests.Timeout(
+                        f"Download did not finish within {self.fetch_timeout_seconds}s"
+                    )
+            encoding = response.encoding if "charset" in content_type else "utf-8"
+        text = _decode(content, encoding)
+        if content_type.startswith("text/plain"):
+            return text
+        return extract_text_from_html(text)
+
+    def fetch_page(self, url: str) -> Optional[str]:
+        if self.page_cache is not None:
+            text = self.page_cache.get(url)
+            if text is not None:
+                return text
+        # any failure only loses this page, the other results and the snippet of this one are still used
+        try:
+            text = self._download_page(url)
+        except Exception as e:
+            print(f"Fetching {url=} failed: {e!r}")
+            return None
+        if text is not None and self.page_cache is not None:
+            self.page_cache.put(url, text)
+        return text
+
+    def _chunk_page(
+        self, query_text: str, result: WebSearchResult, text: str
+    ) -> List[WebDocumentChunk]:
+        chunks = iter_document_chunks(
+            [text],
+            file_name=result.url,
+            chunk_size=self.chunk_size,
+            overlap_ratio=self.overlap_ratio,
+        )
+        return [
+            WebDocumentChunk(
+                id=chunk.id,
+                user_query=query_text,
+                url=result.url,
+                text=chunk.text,
+                summary=result.snippet,
+                title=result.title,
+            )
+            for chunk in islice(chunks, self.max_chunks_per_page)
+        ]
+
+    def search(self, query_text: str) -> List[WebDocumentChunk]:
+        with tracer.span("web_search.search") as span:
+            try:
+                results = self.search_engine.search(query_text, self.num_results)
+            except requests.RequestException as e:
+                print(f"Web search failed: {e!r}")
+                return []
+            span.set(num_results=len(results))
+
+        with tracer.span("web_search.fetch", num_pages=len(results)) as span:
+            pages = list(
+                self.executor.map(self.fetch_page, [result.url for result in results])
+            )
+            span.set(num_fetched=sum(page is not None for page in pages))
+
+        documents = []
+        for result, page in zip(results, pages):
+            if page:
+                documents.extend(self._chunk_page(query_text, result, page))
+            elif result.snippet:
+                documents.extend(self._chunk_page(query_text, result, result.snippet))
+        return documents
+
+    async def asearch(self, query_text: str) -> List[WebDocumentChunk]:
+        return await asyncio.to_thread(self.search, query_text)
+
+
+def load_web_retriever(config: WebSearchConfig) -> WebRetriever:
+    if config.search_engine == "searxng":
+        search_engine = SearxNGSearchEngine(
+            config.search_url,
+            timeout_seconds=config.search_timeout_seconds,
+            user_agent=config.user_agent,
+        )
+    else:
+        print(f"No web search engine implemented for {config.search_engine=}")
+        return
+
+    page_cache = None
+    if config.page_cache_config.enabled:
+        page_cache = WebPageCache(config.page_cache_config)
+    return WebRetriever(search_engine, config, page_cache=page_cache)